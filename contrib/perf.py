@@ -1007,12 +1007,19 @@ def perfrevlogrevisions(ui, repo, file_=None, startrev=0, reverse=False,
     the specified revlog.
 
     The start revision can be defined via ``-s/--startrev``.
+
+    When the revision cache is enabled, its statistics for the last run are
+    reported.
     """
     rl = cmdutil.openrevlog(repo, 'perfrevlogrevisions', file_, opts)
     rllen = getlen(ui)(rl)
+    revcache = getattr(rl, '_revisioncache', None)
 
     def d():
         rl.clearcaches()
+        if revcache is not None:
+            # start each run with an empty cache and fresh statistics
+            revcache.clear()
 
         beginrev = startrev
         endrev = rllen
@@ -1031,6 +1038,12 @@ def perfrevlogrevisions(ui, repo, file_=None, startrev=0, reverse=False,
     timer(d)
     fm.end()
 
+    # statistics of the last run
+    if revcache is not None:
+        ui.write(('revision cache: %d hits, %d base hits, %d misses, '
+                  '%d bytes\n') % (revcache.hits, revcache.basehits,
+                                   revcache.misses, revcache.totalcost))
+
 @command('perfrevlogchunks', revlogopts + formatteropts +
          [('e', 'engines', '', 'compression engines to use'),
           ('s', 'startrev', 0, 'revision to start at')],
@@ -1162,6 +1175,10 @@ def perfrevlogrevision(ui, repo, file_, rev=None, cache=None, **opts):
     5. Verify hash of fulltext
 
     This command measures the time spent in each of these phases.
+
+    When supported by the revlog, the chain is also read in slices as done
+    by sparse reads, and the amount of data read is compared to the size
+    of the chunks in the chain.
     """
     if opts.get('changelog') or opts.get('manifest'):
         file_, rev = None, file_
@@ -1209,6 +1226,12 @@ def perfrevlogrevision(ui, repo, file_, rev=None, cache=None, **opts):
             r.clearcaches()
         segmentforrevs(chain[0], chain[-1])
 
+    def doreadsparse(slicedchain):
+        if not cache:
+            r.clearcaches()
+        for revs in slicedchain:
+            segmentforrevs(revs[0], revs[-1])
+
     def dorawchunks(data, chain):
         if not cache:
             r.clearcaches()
@@ -1252,6 +1275,18 @@ def perfrevlogrevision(ui, repo, file_, rev=None, cache=None, **opts):
         (lambda: dohash(text), 'hash'),
     ]
 
+    slicechunk = getattr(revlog, '_slicechunk', None)
+    if slicechunk is not None:
+        slicedchain = tuple(slicechunk(r, chain))
+        used = sum(r.length(cr) for cr in chain)
+        span = r.end(chain[-1]) - r.start(chain[0])
+        sparse = sum(r.end(revs[-1]) - r.start(revs[0])
+                     for revs in slicedchain)
+        ui.write(('chain: %d revisions, %d bytes used, %d bytes read, '
+                  '%d bytes read in %d sparse reads\n')
+                 % (len(chain), used, span, sparse, len(slicedchain)))
+        benches.insert(3, (lambda: doreadsparse(slicedchain), 'read sparse'))
+
     for fn, title in benches:
         timer, fm = gettimer(ui, opts)
         timer(fn, title=title)
@@ -58,6 +58,18 @@ false. You may wish to set this to true if you have a very fast filesystem
 that can outpace the IPC overhead of getting the result data for the full repo
 from Watchman. Defaults to false.
 
+::
+
+    [fsmonitor]
+    backend = {watchman, inotify}
+
+Which service to get the changed files from. With `backend = inotify`,
+fsmonitor does not need Watchman: on Linux, a watcher built into Mercurial
+keeps a journal of the changes made to the working copy, using inotify. It
+is started when needed and runs in the background until the repository is
+removed; `hg debugfsmonitorwatcher` runs it in the foreground. Defaults to
+`watchman`.
+
 fsmonitor is incompatible with the largefiles and eol extensions, and
 will disable itself if any of those are active.
 
@@ -107,12 +119,15 @@ from mercurial import (
     merge,
     pathutil,
     pycompat,
+    registrar,
     scmutil,
+    server,
     util,
 )
 from mercurial import match as matchmod
 
 from . import (
+    inotifywatcher,
     pywatchman,
     state,
     watchmanclient,
@@ -124,6 +139,9 @@ from . import (
 # leave the attribute unspecified.
 testedwith = 'ships-with-hg-core'
 
+cmdtable = {}
+command = registrar.command(cmdtable)
+
 # This extension is incompatible with the following blacklisted extensions
 # and will disable itself when encountering one of these:
 _blacklist = ['largefiles', 'eol']
@@ -139,6 +157,11 @@ def _handleunavailable(ui, state, ex):
     else:
         ui.log('fsmonitor', 'Watchman exception: %s\n', ex)
 
+_clients = {
+    'inotify': inotifywatcher.client,
+    'watchman': watchmanclient.client,
+}
+
 def _hashignore(ignore):
     """Calculate hash for ignore patterns and filenames
 
@@ -231,7 +254,7 @@ def overridewalk(orig, self, match, subrepos, unknown, ignored, full=True):
     dmap = self._map
     nonnormalset = getattr(self, '_nonnormalset', None)
 
-    copymap = self._copymap
+    copymap = self._map.copymap
     getkind = stat.S_IFMT
     dirkind = stat.S_IFDIR
     regkind = stat.S_IFREG
@@ -414,7 +437,7 @@ def overridestatus(
                 f = open(fn, 'wb')
             else:
                 fn = 'fsmonitorfail.log'
-                f = self.opener(fn, 'wb')
+                f = self.vfs(fn, 'wb')
         except (IOError, OSError):
             self.ui.warn(_('warning: unable to write to %s\n') % fn)
             return
@@ -689,8 +712,13 @@ def reposetup(ui, repo):
         if fsmonitorstate.mode == 'off':
             return
 
+        backend = ui.config('fsmonitor', 'backend', default='watchman')
+        if backend not in _clients:
+            ui.warn(_("fsmonitor: unknown backend '%s'\n") % backend)
+            return
+
         try:
-            client = watchmanclient.client(repo)
+            client = _clients[backend](repo)
         except Exception as ex:
             _handleunavailable(ui, fsmonitorstate, ex)
             return
@@ -710,3 +738,23 @@ def reposetup(ui, repo):
                 return overridestatus(orig, self, *args, **kwargs)
 
         repo.__class__ = fsmonitorrepo
+
+@command('debugfsmonitorwatcher',
+    [('d', 'daemon', None, _('run the watcher in the background')),
+     ('', 'daemon-postexec', [], _('used internally by daemon mode')),
+     ('', 'pid-file', '', _('name of file to write process ID to'), _('FILE'))],
+    '[-d] [--pid-file FILE]')
+def debugfsmonitorwatcher(ui, repo, **opts):
+    """watch the working copy with inotify for the inotify backend
+
+    The watcher is started automatically when fsmonitor needs it.
+    """
+    if not inotifywatcher.supported():
+        raise error.Abort(_('inotify is not supported on this system'))
+    service = inotifywatcher.server(ui, repo)
+    def init():
+        service.init()
+        if not opts['daemon']:
+            ui.status(_('watching %s\n') % repo.root)
+            ui.flush()
+    return server.runservice(opts, initfn=init, runfn=service.run)
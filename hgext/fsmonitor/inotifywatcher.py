@@ -0,0 +1,493 @@
+# inotifywatcher.py - built-in inotify file watcher for the fsmonitor extension
+#
+# Copyright 2017 Mercurial Contributors
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""inotify based replacement for the Watchman service on Linux
+
+The watcher is a daemon, one per working copy, listening on
+``.hg/fsmonitor.sock``. It keeps a journal of the paths changed since it
+started, and answers the subset of the Watchman protocol used by
+fsmonitor: ``clock`` returns the current position in the journal, and
+``query`` with a ``since`` clock returns the paths changed after it, along
+with their ``mode``, ``mtime``, ``size`` and ``exists`` fields. A clock
+from another instance of the watcher, or from before the journal had to
+be dropped, gets the whole working copy as a fresh instance, just as
+Watchman does after a restart.
+
+Messages are encoded with BSER, so that the Watchman client can talk to
+the watcher as it would to Watchman.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import stat
+import struct
+import time
+
+from mercurial.i18n import _
+from mercurial import (
+    error,
+    pycompat,
+    util,
+)
+
+from . import (
+    pywatchman,
+    watchmanclient,
+)
+
+bser = pywatchman.bser
+
+_sockname = 'fsmonitor.sock'
+
+# from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_watchmask = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_eventheader = struct.Struct('iIII')
+
+# how often the watcher checks that its socket is still in place, in seconds
+_checkinterval = 10
+
+_libc = None
+
+def _loadlibc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+def supported():
+    """Whether inotify is available on this system"""
+    if not pycompat.sysplatform.startswith('linux'):
+        return False
+    try:
+        return util.safehasattr(_loadlibc(), 'inotify_init1')
+    except OSError:
+        return False
+
+def _inotifyinit():
+    fd = _loadlibc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return fd
+
+def _inotifyaddwatch(fd, path, mask):
+    wd = _loadlibc().inotify_add_watch(fd, path, mask)
+    if wd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return wd
+
+class watcher(object):
+    """Journal of the paths changed in a working copy, fed by inotify
+
+    Positions in the journal are handed out as clocks of the form
+    ``c:<instance>:<tick>``. The instance changes whenever the journal is
+    dropped, e.g. when the kernel queue overflowed or a directory was
+    moved, since the paths below it are not reported one by one.
+    """
+
+    def __init__(self, ui, root):
+        self._ui = ui
+        self._root = root
+        self._fd = None
+        self._generation = 0
+        self._started = '%d.%d' % (util.getpid(), int(time.time()))
+        # wd -> directory, relative to the root
+        self._dirs = {}
+        # path -> tick of its last change
+        self._changed = {}
+        self._tick = 0
+        self.stopped = False
+        self._reset()
+
+    @property
+    def clock(self):
+        return 'c:%s.%d:%d' % (self._started, self._generation, self._tick)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def fileno(self):
+        return self._fd
+
+    def _reset(self):
+        """Start a new journal, with a new inotify instance"""
+        self.close()
+        self._generation += 1
+        self._dirs.clear()
+        self._changed.clear()
+        self._tick = 0
+        self._fd = _inotifyinit()
+        self._addwatches('', False)
+
+    def _record(self, path):
+        self._tick += 1
+        self._changed[path] = self._tick
+
+    def _addwatches(self, dirname, record):
+        """Watch dirname and the directories below it
+
+        If record is True, the entries found are recorded as changed: they
+        may have been created before the directory was watched.
+        """
+        join = os.path.join
+        root = self._root
+        pending = [dirname]
+        while pending:
+            d = pending.pop()
+            try:
+                wd = _inotifyaddwatch(self._fd, join(root, d), _watchmask)
+                entries = os.listdir(join(root, d))
+            except OSError as inst:
+                if inst.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # removed in the meantime, which we will hear about
+                    continue
+                raise
+            self._dirs[wd] = d
+            for name in entries:
+                if name == '.hg':
+                    continue
+                path = d and d + '/' + name or name
+                if record:
+                    self._record(path)
+                try:
+                    st = os.lstat(join(root, path))
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    pending.append(path)
+
+    def readevents(self):
+        """Read the events queued by the kernel and record their paths"""
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as inst:
+                if inst.errno == errno.EAGAIN:
+                    return
+                if inst.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                return
+            if not self._processevents(data):
+                # the journal cannot be trusted any more
+                self._reset()
+                return
+
+    def _processevents(self, data):
+        dirs = self._dirs
+        pos = 0
+        hsize = _eventheader.size
+        while pos < len(data):
+            wd, mask, cookie, namelen = _eventheader.unpack_from(data, pos)
+            pos += hsize
+            name = data[pos:pos + namelen].rstrip('\0')
+            pos += namelen
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if mask & IN_IGNORED:
+                dirs.pop(wd, None)
+                continue
+            d = dirs.get(wd)
+            if d is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if not d:
+                    # the working copy itself is gone
+                    self.stopped = True
+                continue
+            if not name or name == '.hg':
+                continue
+            path = d and d + '/' + name or name
+            self._record(path)
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    # the paths below it are gone without any event
+                    return False
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._addwatches(path, True)
+        return True
+
+    def _fileinfo(self, path):
+        try:
+            st = os.lstat(os.path.join(self._root, path))
+        except OSError as inst:
+            if inst.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return {'name': path, 'exists': False, 'mode': 0, 'mtime': 0,
+                    'size': 0}
+        return {'name': path, 'exists': True, 'mode': st.st_mode,
+                'mtime': int(st.st_mtime), 'size': st.st_size}
+
+    def _walk(self):
+        """Every file below the root, outside of .hg directories"""
+        join = os.path.join
+        root = self._root
+        pending = ['']
+        while pending:
+            d = pending.pop()
+            try:
+                entries = os.listdir(join(root, d))
+            except OSError as inst:
+                if inst.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for name in entries:
+                if name == '.hg':
+                    continue
+                path = d and d + '/' + name or name
+                info = self._fileinfo(path)
+                if stat.S_ISDIR(info['mode']):
+                    pending.append(path)
+                elif info['exists']:
+                    yield info
+
+    def query(self, opts):
+        self.readevents()
+        clock = self.clock
+        since = opts.get('since', '')
+        prefix, sep, tick = since.rpartition(':')
+        if prefix == clock.rpartition(':')[0]:
+            tick = int(tick)
+            files = [self._fileinfo(f)
+                     for f, t in self._changed.iteritems() if t > tick]
+            fresh = False
+        elif opts.get('empty_on_fresh_instance'):
+            files = []
+            fresh = True
+        else:
+            files = list(self._walk())
+            fresh = True
+        return {'clock': clock, 'is_fresh_instance': fresh, 'files': files}
+
+    def command(self, args):
+        """Answer a command sent by a Watchman client"""
+        if not args:
+            return {'error': 'empty command'}
+        cmd = args[0]
+        if cmd == 'version':
+            return {'version': util.version()}
+        if len(args) < 2 or args[1] != self._root:
+            return {'error': 'unable to resolve root %s: not watched'
+                             % (len(args) > 1 and args[1] or '')}
+        if cmd in ('watch', 'watch-project'):
+            return {'watch': self._root}
+        if cmd == 'clock':
+            self.readevents()
+            return {'clock': self.clock}
+        if cmd == 'query':
+            return self.query(len(args) > 2 and args[2] or {})
+        if cmd in ('state-enter', 'state-leave'):
+            return {'root': self._root}
+        return {'error': 'unknown command %s' % cmd}
+
+class server(object):
+    """Serve the journal of a watcher on the socket of the repository"""
+
+    def __init__(self, ui, repo):
+        self.ui = ui
+        self.root = repo.root
+        self.sockpath = repo.vfs.join(_sockname)
+        self.watcher = None
+        self._sock = None
+        self._sockstat = None
+        # socket -> data received so far
+        self._clients = {}
+
+    def init(self):
+        sock = _connect(self.sockpath, 1.0, probe=True)
+        if sock:
+            sock.close()
+            raise error.Abort(_('a watcher is already running for %s')
+                              % self.root)
+        try:
+            self.watcher = watcher(self.ui, self.root)
+        except OSError as inst:
+            if inst.errno != errno.ENOSPC:
+                raise
+            raise error.Abort(_('too many directories to watch'),
+                              hint=_('see fs.inotify.max_user_watches in '
+                                     'sysctl(8)'))
+        util.tryunlink(self.sockpath)
+        self._sock = socket.socket(socket.AF_UNIX)
+        util.bindunixsocket(self._sock, self.sockpath)
+        self._sock.listen(socket.SOMAXCONN)
+        self._sockstat = util.filestat.frompath(self.sockpath)
+
+    def _socketchanged(self):
+        return util.filestat.frompath(self.sockpath) != self._sockstat
+
+    def run(self):
+        try:
+            self._mainloop()
+        finally:
+            for conn in self._clients:
+                conn.close()
+            self._clients.clear()
+            self.watcher.close()
+            if not self._socketchanged():
+                util.tryunlink(self.sockpath)
+            self._sock.close()
+
+    def _mainloop(self):
+        lastcheck = time.time()
+        while not self.watcher.stopped:
+            fds = [self._sock, self.watcher] + list(self._clients)
+            try:
+                ready = select.select(fds, [], [], _checkinterval)[0]
+            except select.error as inst:
+                if inst.args[0] == errno.EINTR:
+                    continue
+                raise
+            for obj in ready:
+                if obj is self.watcher:
+                    obj.readevents()
+                elif obj is self._sock:
+                    self._accept()
+                else:
+                    self._handle(obj)
+            now = time.time()
+            if now - lastcheck >= _checkinterval:
+                lastcheck = now
+                if self._socketchanged():
+                    # removed, or taken over by another watcher
+                    break
+
+    def _accept(self):
+        try:
+            conn, addr = self._sock.accept()
+        except socket.error as inst:
+            if inst.args[0] in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        self._clients[conn] = ''
+
+    def _handle(self, conn):
+        try:
+            data = conn.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            conn.close()
+            del self._clients[conn]
+            return
+        buf = self._clients[conn] + data
+        while len(buf) >= pywatchman.sniff_len:
+            try:
+                size = bser.pdu_info(buf)[2]
+            except ValueError:
+                conn.close()
+                del self._clients[conn]
+                return
+            if len(buf) < size:
+                break
+            args = bser.loads(buf[:size])
+            buf = buf[size:]
+            try:
+                conn.sendall(bser.dumps(self.watcher.command(args)))
+            except socket.error:
+                conn.close()
+                del self._clients[conn]
+                return
+        self._clients[conn] = buf
+
+def _connect(sockpath, timeout, probe=False):
+    """Connect to the watcher socket at sockpath
+
+    Like bindunixsocket(), this connects through a path relative to the
+    directory of the socket, to stay below the length limit on socket
+    paths. If probe is True, return None instead of raising if nothing
+    listens there.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    dirname, basename = os.path.split(sockpath)
+    bakwdfd = os.open('.', os.O_DIRECTORY)
+    try:
+        os.chdir(dirname)
+        try:
+            sock.connect(basename)
+        finally:
+            os.fchdir(bakwdfd)
+    except (socket.error, OSError) as inst:
+        sock.close()
+        if probe:
+            return None
+        raise pywatchman.SocketConnectError(sockpath, inst)
+    finally:
+        os.close(bakwdfd)
+    return sock
+
+class _transport(pywatchman.UnixSocketTransport):
+    def __init__(self, sockpath, timeout):
+        self.sockpath = sockpath
+        self.timeout = timeout
+        self.sock = _connect(sockpath, timeout)
+
+class client(watchmanclient.client):
+    """Watchman client talking to the watcher of the working copy
+
+    The watcher is started the first time it cannot be reached.
+    """
+
+    def __init__(self, repo, timeout=1.0):
+        if not supported():
+            raise watchmanclient.Unavailable(
+                'inotify is not supported on this system')
+        super(client, self).__init__(repo, timeout)
+        self._sockpath = repo.vfs.join(_sockname)
+
+    def _makeclient(self):
+        c = pywatchman.client(sockpath=self._sockpath, transport=_transport,
+                              timeout=self._timeout, useImmutableBser=True)
+        try:
+            c._connect()
+        except pywatchman.SocketConnectError:
+            self._startwatcher()
+            c._connect()
+        return c
+
+    def _startwatcher(self):
+        cmd = util.hgcmd() + ['debugfsmonitorwatcher', '--daemon']
+        ret = self._ui.system(' '.join(map(util.shellquote, cmd)),
+                              cwd=self._root, blockedtag='fsmonitor_watcher')
+        if ret:
+            raise pywatchman.WatchmanError(
+                'unable to start the inotify watcher')
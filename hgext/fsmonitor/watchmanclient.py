@@ -77,14 +77,15 @@ class client(object):
             # couldn't figure out our user
             return None
 
+    def _makeclient(self):
+        return pywatchman.client(timeout=self._timeout, useImmutableBser=True)
+
     def _command(self, *args):
         watchmanargs = (args[0], self._root) + args[1:]
         try:
             if self._watchmanclient is None:
                 self._firsttime = False
-                self._watchmanclient = pywatchman.client(
-                    timeout=self._timeout,
-                    useImmutableBser=True)
+                self._watchmanclient = self._makeclient()
             return self._watchmanclient.query(*watchmanargs)
         except pywatchman.CommandError as ex:
             if 'unable to resolve root' in ex.msg:
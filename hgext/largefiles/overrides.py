@@ -546,10 +546,10 @@ def mergerecordupdates(orig, repo, actions, branchmerge):
 # Override filemerge to prompt the user about how they wish to merge
 # largefiles. This will handle identical edits without prompting the user.
 def overridefilemerge(origfn, premerge, repo, wctx, mynode, orig, fcd, fco, fca,
-                      labels=None):
+                      labels=None, premerged=None):
     if not lfutil.isstandin(orig) or fcd.isabsent() or fco.isabsent():
         return origfn(premerge, repo, wctx, mynode, orig, fcd, fco, fca,
-                      labels=labels)
+                      labels=labels, premerged=premerged)
 
     ahash = lfutil.readasstandin(fca).lower()
     dhash = lfutil.readasstandin(fcd).lower()
@@ -29,6 +29,7 @@ from mercurial import (
     bookmarks,
     cmdutil,
     commands,
+    context,
     copies,
     destutil,
     dirstateguard,
@@ -136,7 +137,7 @@ def _ctxdesc(ctx):
 
 class rebaseruntime(object):
     """This class is a container for rebase runtime state"""
-    def __init__(self, repo, ui, opts=None):
+    def __init__(self, repo, ui, opts=None, inmemory=False):
         if opts is None:
             opts = {}
 
@@ -178,6 +179,9 @@ class rebaseruntime(object):
         # other extensions
         self.keepopen = opts.get('keepopen', False)
         self.obsoletenotrebased = {}
+        # whether the changesets are merged in memory rather than in the
+        # working directory
+        self.inmemory = inmemory
 
     @property
     def repo(self):
@@ -452,6 +456,10 @@ class rebaseruntime(object):
                                              self.obsoletenotrebased)
                 self.storestatus(tr=tr)
                 storecollapsemsg(repo, self.collapsemsg)
+                wctx = None
+                if self.inmemory:
+                    wctx = context.overlayworkingctx(repo)
+                    wctx.setbase(repo[p1])
                 if len(repo[None].parents()) == 2:
                     repo.ui.debug('resuming interrupted rebase\n')
                 else:
@@ -459,7 +467,7 @@ class rebaseruntime(object):
                         ui.setconfig('ui', 'forcemerge', opts.get('tool', ''),
                                      'rebase')
                         stats = rebasenode(repo, rev, p1, base, self.state,
-                                           self.collapsef, dest)
+                                           self.collapsef, dest, wctx=wctx)
                         if stats and stats[3] > 0:
                             raise error.InterventionRequired(
                                 _('unresolved conflicts (see hg '
@@ -470,15 +478,23 @@ class rebaseruntime(object):
                     merging = p2 != nullrev
                     editform = cmdutil.mergeeditform(merging, 'rebase')
                     editor = cmdutil.getcommiteditor(editform=editform, **opts)
-                    newnode = concludenode(repo, rev, p1, p2,
+                    if self.inmemory:
+                        newnode = concludememorynode(repo, rev, p1, p2, wctx,
                                            extrafn=_makeextrafn(self.extrafns),
                                            editor=editor,
                                            keepbranches=self.keepbranchesf,
                                            date=self.date)
-                    if newnode is None:
-                        # If it ended up being a no-op commit, then the normal
-                        # merge state clean-up path doesn't happen, so do it
-                        # here. Fix issue5494
+                    else:
+                        newnode = concludenode(repo, rev, p1, p2,
+                                           extrafn=_makeextrafn(self.extrafns),
+                                           editor=editor,
+                                           keepbranches=self.keepbranchesf,
+                                           date=self.date)
+                    if newnode is None or self.inmemory:
+                        # If it ended up being a no-op commit, or a commit of
+                        # changes kept in memory, then the normal merge state
+                        # clean-up path doesn't happen, so do it here. Fix
+                        # issue5494
                         mergemod.mergestate.clean(repo)
                 else:
                     # Skip commit if we are collapsing
@@ -690,13 +706,40 @@ def rebase(ui, repo, **opts):
       [rebase]
       singletransaction = True
 
+    By default, rebase updates the working directory to each changeset it
+    rebases. You can configure rebase to merge the changesets in memory
+    instead, only falling back to the working directory if the merges hit
+    conflicts (EXPERIMENTAL)::
+
+      [rebase]
+      experimental.inmemory = True
+
     Return Values:
 
     Returns 0 on success, 1 if nothing to rebase or there are
     unresolved conflicts.
 
     """
-    rbsrt = rebaseruntime(repo, ui, opts)
+    inmemory = ui.configbool('rebase', 'experimental.inmemory')
+    if (opts.get('continue') or opts.get('abort') or opts.get('collapse') or
+        repo.currenttransaction() is not None):
+        # resumed and collapsed rebases need the working directory, and an
+        # outer transaction would keep the fallback below from aborting
+        inmemory = False
+
+    if inmemory:
+        try:
+            # in-memory merges do not resolve conflicts, abort and run the
+            # rebase again in the working directory if they hit any
+            return _origrebase(ui, repo, inmemory=True, **opts)
+        except error.InMemoryMergeConflictsError:
+            ui.warn(_('hit merge conflicts; re-running rebase without '
+                      'in-memory merge\n'))
+            _origrebase(ui, repo, abort=True)
+    return _origrebase(ui, repo, **opts)
+
+def _origrebase(ui, repo, inmemory=False, **opts):
+    rbsrt = rebaseruntime(repo, ui, opts, inmemory=inmemory)
 
     with repo.wlock(), repo.lock():
         # Validate input and define rebasing points
@@ -949,25 +992,66 @@ def concludenode(repo, rev, p1, p2, commitmsg=None, editor=None, extrafn=None,
         repo.dirstate.setbranch(repo[newnode].branch())
         return newnode
 
-def rebasenode(repo, rev, p1, base, state, collapse, dest):
-    'Rebase a single revision rev on top of p1 using base as merge ancestor'
+def concludememorynode(repo, rev, p1, p2, wctx, commitmsg=None, editor=None,
+                       extrafn=None, keepbranches=False, date=None):
+    '''Commit the changes merged in memory in wctx with parents p1 and p2.
+    Reuse commit info from rev but also store useful information in extra.
+    Return node of committed revision.'''
+    ctx = repo[rev]
+    if commitmsg is None:
+        commitmsg = ctx.description()
+    keepbranch = keepbranches and repo[p1].branch() != ctx.branch()
+    extra = {'rebase_source': ctx.hex()}
+    if extrafn:
+        extrafn(ctx, extra)
+
+    destphase = max(ctx.phase(), phases.draft)
+    overrides = {('phases', 'new-commit'): destphase}
+    with repo.ui.configoverride(overrides, 'rebase'):
+        if keepbranch:
+            repo.ui.setconfig('ui', 'allowemptycommit', True)
+        # skip empty commits like repo.commit() does
+        if (not wctx.files() and
+            not repo.ui.configbool('ui', 'allowemptycommit')):
+            return None
+        if date is None:
+            date = ctx.date()
+        # a branch set in extra, e.g. by --keepbranches, takes precedence
+        branch = None
+        if 'branch' not in extra:
+            branch = repo[p1].branch()
+        memctx = wctx.tomemctx(commitmsg, parents=(repo[p1].node(),
+                                                   repo[p2].node()),
+                               branch=branch, extra=extra, date=date,
+                               user=ctx.user(), editor=editor)
+        return repo.commitctx(memctx)
+
+def rebasenode(repo, rev, p1, base, state, collapse, dest, wctx=None):
+    '''Rebase a single revision rev on top of p1 using base as merge ancestor
+
+    The merge happens in the working directory, or in wctx, an
+    overlayworkingctx on top of p1, to keep it in memory.'''
     # Merge phase
     # Update to destination and merge it with local
-    if repo['.'].rev() != p1:
-        repo.ui.debug(" update to %d:%s\n" % (p1, repo[p1]))
-        mergemod.update(repo, p1, False, True)
+    if wctx is not None:
+        repo.ui.debug(" merge in memory on top of %d:%s\n" % (p1, repo[p1]))
     else:
-        repo.ui.debug(" already in destination\n")
-    repo.dirstate.write(repo.currenttransaction())
+        if repo['.'].rev() != p1:
+            repo.ui.debug(" update to %d:%s\n" % (p1, repo[p1]))
+            mergemod.update(repo, p1, False, True)
+        else:
+            repo.ui.debug(" already in destination\n")
+        repo.dirstate.write(repo.currenttransaction())
+        wctx = repo[None]
     repo.ui.debug(" merge against %d:%s\n" % (rev, repo[rev]))
     if base is not None:
         repo.ui.debug("   detach base %d:%s\n" % (base, repo[base]))
     # When collapsing in-place, the parent is the common ancestor, we
     # have to allow merging with it.
     stats = mergemod.update(repo, rev, True, True, base, collapse,
-                            labels=['dest', 'source'])
+                            labels=['dest', 'source'], wc=wctx)
     if collapse:
-        copies.duplicatecopies(repo, rev, dest)
+        copies.duplicatecopies(repo, rev, dest, wctx=wctx)
     else:
         # If we're not using --collapse, we need to
         # duplicate copies between the revision we're
@@ -975,7 +1059,7 @@ def rebasenode(repo, rev, p1, base, state, collapse, dest):
         # duplicate any copies that have already been
         # performed in the destination.
         p1rev = repo[rev].p1().rev()
-        copies.duplicatecopies(repo, rev, p1rev, skiprev=dest)
+        copies.duplicatecopies(repo, rev, p1rev, skiprev=dest, wctx=wctx)
     return stats
 
 def adjustdest(repo, rev, destmap, state, skipped):
@@ -62,7 +62,10 @@ class bundlerevlog(revlog.revlog):
             size = len(delta)
             start = bundle.tell() - size
 
-            link = linkmapper(cs)
+            if linkmapper is None: # the changelog links to itself
+                link = n
+            else:
+                link = linkmapper(cs)
             if node in self.nodemap:
                 # this can happen if two branches make the same change
                 self.bundlerevs.add(self.nodemap[node])
@@ -146,6 +149,10 @@ class bundlerevlog(revlog.revlog):
         self._cache = (node, rev, rawtext)
         return text
 
+    def revisions(self, revs, raw=False):
+        for rev in revs:
+            yield self.revision(rev, raw=raw)
+
     def baserevision(self, nodeorrev):
         # Revlog subclasses may override 'revision' method to modify format of
         # content retrieved from revlog. To use bundlerevlog with such class one
@@ -164,7 +171,7 @@ class bundlerevlog(revlog.revlog):
 class bundlechangelog(bundlerevlog, changelog.changelog):
     def __init__(self, opener, bundle):
         changelog.changelog.__init__(self, opener)
-        linkmapper = lambda x: x
+        linkmapper = None
         bundlerevlog.__init__(self, opener, self.indexfile, bundle,
                               linkmapper)
 
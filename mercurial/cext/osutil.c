@@ -331,15 +331,21 @@ static PyObject *_listdir_stat(char *path, int pathlen, int keepstat,
 	strncpy(fullpath, path, PATH_MAX);
 	fullpath[pathlen] = '/';
 
+	/* the GIL is released around system calls, which lets other threads
+	   list directories at the same time */
 #ifdef AT_SYMLINK_NOFOLLOW
+	Py_BEGIN_ALLOW_THREADS
 	dfd = open(path, O_RDONLY);
+	Py_END_ALLOW_THREADS
 	if (dfd == -1) {
 		PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
 		goto error_value;
 	}
 	dir = fdopendir(dfd);
 #else
+	Py_BEGIN_ALLOW_THREADS
 	dir = opendir(path);
+	Py_END_ALLOW_THREADS
 #endif
 	if (!dir) {
 		PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
@@ -350,20 +356,29 @@ static PyObject *_listdir_stat(char *path, int pathlen, int keepstat,
 	if (!list)
 		goto error_list;
 
-	while ((ent = readdir(dir))) {
+	for (;;) {
+		Py_BEGIN_ALLOW_THREADS
+		ent = readdir(dir);
+		Py_END_ALLOW_THREADS
+		if (!ent)
+			break;
 		if (!strcmp(ent->d_name, ".") || !strcmp(ent->d_name, ".."))
 			continue;
 
 		kind = entkind(ent);
 		if (kind == -1 || keepstat) {
 #ifdef AT_SYMLINK_NOFOLLOW
+			Py_BEGIN_ALLOW_THREADS
 			err = fstatat(dfd, ent->d_name, &st,
 				      AT_SYMLINK_NOFOLLOW);
+			Py_END_ALLOW_THREADS
 #else
 			strncpy(fullpath + pathlen + 1, ent->d_name,
 				PATH_MAX - pathlen);
 			fullpath[PATH_MAX] = '\0';
+			Py_BEGIN_ALLOW_THREADS
 			err = lstat(fullpath, &st);
+			Py_END_ALLOW_THREADS
 #endif
 			if (err == -1) {
 				/* race with file deletion? */
@@ -235,7 +235,8 @@ class cg1unpacker(object):
                     pos = next
             yield closechunk()
 
-    def _unpackmanifests(self, repo, revmap, trp, prog, numchanges):
+    def _unpackmanifests(self, repo, revmap, trp, prog, numchanges,
+                         compressionpool=None):
         # We know that we'll never have more manifests than we had
         # changesets.
         self.callback = prog(_('manifests'), numchanges)
@@ -245,7 +246,8 @@ class cg1unpacker(object):
         # be empty during the pull
         self.manifestheader()
         deltas = self.deltaiter()
-        repo.manifestlog._revlog.addgroup(deltas, revmap, trp)
+        repo.manifestlog._revlog.addgroup(deltas, revmap, trp,
+                                          compressionpool=compressionpool)
         repo.ui.progress(_('manifests'), None)
         self.callback = None
 
@@ -270,6 +272,7 @@ class cg1unpacker(object):
             return cl.rev(x)
 
         changesets = files = revisions = 0
+        compressionpool = None
 
         try:
             # The transaction may already carry source information. In this
@@ -286,6 +289,8 @@ class cg1unpacker(object):
             cl = repo.changelog
             cl.delayupdate(tr)
             oldheads = set(cl.heads())
+            # the deltas of every revlog are compressed by the same threads
+            compressionpool = cl.compressionpool()
 
             trp = weakref.proxy(tr)
             # pull off the changeset group
@@ -308,7 +313,8 @@ class cg1unpacker(object):
 
             self.changelogheader()
             deltas = self.deltaiter()
-            cgnodes = cl.addgroup(deltas, csmap, trp, addrevisioncb=onchangelog)
+            cgnodes = cl.addgroup(deltas, csmap, trp, addrevisioncb=onchangelog,
+                                  compressionpool=compressionpool)
             efiles = len(efiles)
 
             if not cgnodes:
@@ -321,7 +327,8 @@ class cg1unpacker(object):
 
             # pull off the manifest group
             repo.ui.status(_("adding manifests\n"))
-            self._unpackmanifests(repo, revmap, trp, prog, changesets)
+            self._unpackmanifests(repo, revmap, trp, prog, changesets,
+                                  compressionpool=compressionpool)
 
             needfiles = {}
             if repo.ui.configbool('server', 'validate'):
@@ -338,7 +345,8 @@ class cg1unpacker(object):
             # process the files
             repo.ui.status(_("adding file changes\n"))
             newrevs, newfiles = _addchangegroupfiles(
-                repo, self, revmap, trp, efiles, needfiles)
+                repo, self, revmap, trp, efiles, needfiles,
+                compressionpool=compressionpool)
             revisions += newrevs
             files += newfiles
 
@@ -421,6 +429,8 @@ class cg1unpacker(object):
                 tr.addpostclose('changegroup-runhooks-%020i' % clstart,
                                 lambda tr: repo._afterlock(runhooks))
         finally:
+            if compressionpool is not None:
+                compressionpool.close()
             repo.ui.flush()
         # never return 0 here:
         if deltaheads < 0:
@@ -473,16 +483,19 @@ class cg3unpacker(cg2unpacker):
         node, p1, p2, deltabase, cs, flags = headertuple
         return node, p1, p2, deltabase, cs, flags
 
-    def _unpackmanifests(self, repo, revmap, trp, prog, numchanges):
-        super(cg3unpacker, self)._unpackmanifests(repo, revmap, trp, prog,
-                                                  numchanges)
+    def _unpackmanifests(self, repo, revmap, trp, prog, numchanges,
+                         compressionpool=None):
+        super(cg3unpacker, self)._unpackmanifests(
+            repo, revmap, trp, prog, numchanges,
+            compressionpool=compressionpool)
         for chunkdata in iter(self.filelogheader, {}):
             # If we get here, there are directory manifests in the changegroup
             d = chunkdata["filename"]
             repo.ui.debug("adding %s revisions\n" % d)
             dirlog = repo.manifestlog._revlog.dirlog(d)
             deltas = self.deltaiter()
-            if not dirlog.addgroup(deltas, revmap, trp):
+            if not dirlog.addgroup(deltas, revmap, trp,
+                                   compressionpool=compressionpool):
                 raise error.Abort(_("received dir revlog group is empty"))
 
 class headerlessfixup(object):
@@ -568,6 +581,21 @@ class cg1packer(object):
         p = revlog.parentrevs(revs[0])[0]
         revs.insert(0, p)
 
+        # the texts needed to compute the deltas which can not be reused
+        # from storage are built together, in the order revchunk() uses them
+        textrevs = []
+        for r in xrange(len(revs) - 1):
+            textrevs.extend(self._deltatexts(revlog, revs[r + 1], revs[r]))
+        texts = revlog.revisions(textrevs, raw=True)
+        expected = iter(textrevs)
+        def rawtext(rev):
+            planned = next(expected)
+            if rev != planned:
+                raise error.ProgrammingError('text of revision %d read out '
+                                             'of order, expected %d'
+                                             % (rev, planned))
+            return next(texts)
+
         # build deltas
         total = len(revs) - 1
         msgbundling = _('bundling')
@@ -576,7 +604,8 @@ class cg1packer(object):
                 self._progress(msgbundling, r + 1, unit=units, total=total)
             prev, curr = revs[r], revs[r + 1]
             linknode = lookup(revlog.node(curr))
-            for c in self.revchunk(revlog, curr, prev, linknode):
+            for c in self.revchunk(revlog, curr, prev, linknode,
+                                   rawtext=rawtext):
                 yield c
 
         if units is not None:
@@ -781,10 +810,31 @@ class cg1packer(object):
     def deltaparent(self, revlog, rev, p1, p2, prev):
         return prev
 
-    def revchunk(self, revlog, rev, prev, linknode):
+    def _deltatexts(self, revlog, rev, prev):
+        """return the revisions whose raw text revchunk() reads for rev"""
+        p1, p2 = revlog.parentrevs(rev)
+        base = self.deltaparent(revlog, rev, p1, p2, prev)
+        if revlog.iscensored(base) or revlog.iscensored(rev):
+            # read with revision(), which reports the censorship
+            return []
+        elif base == nullrev:
+            return [rev]
+        elif revlog.deltaparent(rev) == base:
+            # the stored delta is reused
+            return []
+        return [base, rev]
+
+    def revchunk(self, revlog, rev, prev, linknode, rawtext=None):
+        """yield the chunks of the delta of rev
+
+        ``rawtext`` is a function returning the raw text of a revision. It
+        is called in the order given by ``_deltatexts()``.
+        """
         node = revlog.node(rev)
         p1, p2 = revlog.parentrevs(rev)
         base = self.deltaparent(revlog, rev, p1, p2, prev)
+        if rawtext is None:
+            rawtext = lambda r: revlog.revision(r, raw=True)
 
         prefix = ''
         if revlog.iscensored(base) or revlog.iscensored(rev):
@@ -798,10 +848,12 @@ class cg1packer(object):
                 baselen = revlog.rawsize(base)
                 prefix = mdiff.replacediffheader(baselen, len(delta))
         elif base == nullrev:
-            delta = revlog.revision(node, raw=True)
+            delta = rawtext(rev)
             prefix = mdiff.trivialdiffheader(len(delta))
-        else:
+        elif revlog.deltaparent(rev) == base:
             delta = revlog.revdiff(base, rev)
+        else:
+            delta = mdiff.textdiff(rawtext(base), rawtext(rev))
         p1n, p2n = revlog.parents(node)
         basenode = revlog.node(base)
         flags = revlog.flags(rev)
@@ -961,7 +1013,8 @@ def makestream(repo, outgoing, version, source, fastpath=False,
     _changegroupinfo(repo, csets, source)
     return bundler.generate(commonrevs, csets, fastpathlinkrev, source)
 
-def _addchangegroupfiles(repo, source, revmap, trp, expectedfiles, needfiles):
+def _addchangegroupfiles(repo, source, revmap, trp, expectedfiles, needfiles,
+                         compressionpool=None):
     revisions = 0
     files = 0
     for chunkdata in iter(source.filelogheader, {}):
@@ -974,7 +1027,8 @@ def _addchangegroupfiles(repo, source, revmap, trp, expectedfiles, needfiles):
         o = len(fl)
         try:
             deltas = source.deltaiter()
-            if not fl.addgroup(deltas, revmap, trp):
+            if not fl.addgroup(deltas, revmap, trp,
+                               compressionpool=compressionpool):
                 raise error.Abort(_("received file revlog group is empty"))
         except error.CensoredBaseError as e:
             raise error.Abort(_("received delta base is censored: %s") % e)
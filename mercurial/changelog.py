@@ -128,17 +128,17 @@ class appender(object):
 
 def _divertopener(opener, target):
     """build an opener that writes in 'target.a' instead of 'target'"""
-    def _divert(name, mode='r', checkambig=False):
+    def _divert(name, mode='r', checkambig=False, **kwargs):
         if name != target:
-            return opener(name, mode)
+            return opener(name, mode, **kwargs)
         return opener(name + ".a", mode)
     return _divert
 
 def _delayopener(opener, target, buf):
     """build an opener that stores chunks in 'buf' instead of 'target'"""
-    def _delay(name, mode='r', checkambig=False):
+    def _delay(name, mode='r', checkambig=False, **kwargs):
         if name != target:
-            return opener(name, mode)
+            return opener(name, mode, **kwargs)
         return appender(opener, name, mode, buf)
     return _delay
 
@@ -277,7 +277,8 @@ class changelog(revlog.revlog):
 
         datafile = '00changelog.d'
         revlog.revlog.__init__(self, opener, indexfile, datafile=datafile,
-                               checkambig=True, mmaplargeindex=True)
+                               checkambig=True, mmaplargeindex=True,
+                               persistentnodemap=True)
 
         if self._initempty:
             # changelogs don't benefit from generaldelta
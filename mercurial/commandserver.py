@@ -434,6 +434,10 @@ class unixforkingservice(object):
     Listens on unix domain socket and forks server per connection
     """
 
+    # how often the main process checks for exited workers, to read the
+    # dirstate they may have changed [sec]
+    dirstatepollinterval = 0.1
+
     def __init__(self, ui, repo, opts, handler=None):
         self.ui = ui
         self.repo = repo
@@ -447,6 +451,7 @@ class unixforkingservice(object):
         self._oldsigchldhandler = None
         self._workerpids = set()  # updated by signal handler; do not iterate
         self._socketunlinked = None
+        self._dirstatestale = False  # set by signal handler
 
     def init(self):
         self._sock = socket.socket(socket.AF_UNIX)
@@ -454,6 +459,7 @@ class unixforkingservice(object):
         o = signal.signal(signal.SIGCHLD, self._sigchldhandler)
         self._oldsigchldhandler = o
         self._socketunlinked = False
+        self._preloaddirstate()
 
     def _unlinksocket(self):
         if not self._socketunlinked:
@@ -487,11 +493,20 @@ class unixforkingservice(object):
                 # waiting for recv() will receive ECONNRESET.
                 self._unlinksocket()
                 exiting = True
-            ready = selector.select(timeout=h.pollinterval)
+            timeout = h.pollinterval
+            if (self.repo is not None and
+                (self._workerpids or self._dirstatestale)):
+                # wake up to refresh the dirstate once workers exited
+                timeout = min(timeout or self.dirstatepollinterval,
+                              self.dirstatepollinterval)
+            ready = selector.select(timeout=timeout)
             if not ready:
                 # only exit if we completed all queued requests
                 if exiting:
                     break
+                if self._dirstatestale:
+                    self._dirstatestale = False
+                    self._preloaddirstate()
                 continue
             try:
                 conn, _addr = self._sock.accept()
@@ -520,6 +535,44 @@ class unixforkingservice(object):
                         os._exit(255)
         selector.close()
 
+    def _preloaddirstate(self):
+        """Read the dirstate of the repository again if its files changed
+
+        Workers inherit the dirstate parsed by the main process, along with
+        its ignore matcher and fold maps, and only read it again if their
+        repository finds its files changed since. The main process does
+        this at startup, then whenever it is idle after workers exited,
+        since they may have written the dirstate. A client connecting in
+        the meantime is served without waiting, by a worker reading the
+        dirstate itself.
+        """
+        repo = self.repo
+        if repo is None:
+            return
+        # have the filecache check the dirstate files
+        repo.invalidatedirstate()
+        ui = repo.ui
+        ui.pushbuffer(error=True)
+        try:
+            try:
+                dirstate = repo.dirstate
+                dirstate._map
+                dirstate._ignore
+                if dirstate._checkcase:
+                    dirstate._filefoldmap
+                    dirstate._dirfoldmap
+            finally:
+                warnings = ui.popbuffer()
+        except (error.Abort, IOError, OSError) as inst:
+            self.ui.debug("couldn't preload dirstate: %s\n" % inst)
+            repo.invalidatedirstate()
+            return
+        if warnings:
+            # leave it to the workers to build the ignore matcher, so that
+            # its warnings reach the clients
+            dirstate._filecache.pop('_ignore', None)
+            dirstate.__dict__.pop('_ignore', None)
+
     def _sigchldhandler(self, signal, frame):
         self._reapworkers(os.WNOHANG)
 
@@ -539,6 +592,9 @@ class unixforkingservice(object):
                 # no waitable child processes
                 return
             self.ui.debug('worker process exited (pid=%d)\n' % pid)
+            # flagged first, so the main loop keeps waking up until it
+            # refreshes the dirstate
+            self._dirstatestale = True
             self._workerpids.discard(pid)
 
     def _runworker(self, conn):
@@ -149,6 +149,12 @@ coreconfigitem('email', 'charsets',
 coreconfigitem('email', 'method',
     default='smtp',
 )
+coreconfigitem('experimental', 'addgroup-compression-threads',
+    default=0,
+)
+coreconfigitem('experimental', 'bucketed-ignore',
+    default=False,
+)
 coreconfigitem('experimental', 'bundle-phases',
     default=False,
 )
@@ -209,6 +215,18 @@ coreconfigitem('experimental', 'extendedheader.similarity',
 coreconfigitem('experimental', 'format.compression',
     default='zlib',
 )
+coreconfigitem('experimental', 'format.dirstatelog',
+    default=False,
+)
+coreconfigitem('experimental', 'format.treedirstate',
+    default=False,
+)
+coreconfigitem('experimental', 'format.zstd-dictionary',
+    default=False,
+)
+coreconfigitem('experimental', 'format.zstd-dictionary.size',
+    default='100K',
+)
 coreconfigitem('experimental', 'graphshorten',
     default=False,
 )
@@ -218,6 +236,9 @@ coreconfigitem('experimental', 'hook-track-tags',
 coreconfigitem('experimental', 'httppostargs',
     default=False,
 )
+coreconfigitem('experimental', 'intermediate-snapshots',
+    default=False,
+)
 coreconfigitem('experimental', 'manifestv2',
     default=False,
 )
@@ -227,15 +248,30 @@ coreconfigitem('experimental', 'mergedriver',
 coreconfigitem('experimental', 'obsmarkers-exchange-debug',
     default=False,
 )
+coreconfigitem('experimental', 'persistent-nodemap',
+    default=False,
+)
 coreconfigitem('experimental', 'rebase.multidest',
     default=False,
 )
 coreconfigitem('experimental', 'revertalternateinteractivemode',
     default=True,
 )
+coreconfigitem('experimental', 'revisioncachesize',
+    default='0',
+)
 coreconfigitem('experimental', 'revlogv2',
     default=None,
 )
+coreconfigitem('experimental', 'sparse-read',
+    default=False,
+)
+coreconfigitem('experimental', 'sparse-read.density-threshold',
+    default=0.25,
+)
+coreconfigitem('experimental', 'sparse-read.min-gap-size',
+    default='256K',
+)
 coreconfigitem('experimental', 'spacemovesdown',
     default=False,
 )
@@ -245,6 +281,9 @@ coreconfigitem('experimental', 'treemanifest',
 coreconfigitem('experimental', 'updatecheck',
     default=None,
 )
+coreconfigitem('experimental', 'walk-threads',
+    default=0,
+)
 coreconfigitem('format', 'aggressivemergedeltas',
     default=False,
 )
@@ -299,6 +338,9 @@ coreconfigitem('http_proxy', 'user',
 coreconfigitem('merge', 'followcopies',
     default=True,
 )
+coreconfigitem('merge', 'parallel',
+    default=False,
+)
 coreconfigitem('pager', 'ignore',
     default=list,
 )
@@ -649,6 +691,9 @@ coreconfigitem('web', 'style',
 coreconfigitem('web', 'templates',
     default=None,
 )
+coreconfigitem('worker', 'backend',
+    default='auto',
+)
 coreconfigitem('worker', 'backgroundclose',
     default=dynamicdefault,
 )
@@ -42,6 +42,7 @@ from . import (
     sparse,
     subrepo,
     util,
+    worker,
 )
 
 propertycache = util.propertycache
@@ -111,25 +112,34 @@ class basectx(object):
     def _buildstatus(self, other, s, match, listignored, listclean,
                      listunknown):
         """build a status with respect to another context"""
-        # Load earliest manifest first for caching reasons. More specifically,
-        # if you have revisions 1000 and 1001, 1001 is probably stored as a
-        # delta against 1000. Thus, if you read 1000 first, we'll reconstruct
-        # 1000 and cache it so that when you read 1001, we just need to apply a
-        # delta to what's in the cache. So that's one full reconstruction + one
-        # delta application.
-        mf2 = None
-        if self.rev() is not None and self.rev() < other.rev():
-            mf2 = self._buildstatusmanifest(s)
-        mf1 = other._buildstatusmanifest(s)
-        if mf2 is None:
-            mf2 = self._buildstatusmanifest(s)
+        mf1 = mf2 = None
+        if (self.rev() is not None and other.rev() is not None and
+            'treemanifest' not in self._repo.requirements):
+            # Neither is the working directory: let the manifests compare
+            # themselves. They can do it from the delta stored between them,
+            # without reading both. Tree manifests are still read, as later
+            # file lookups would otherwise load every directory of the tree.
+            d = other.manifestctx().diff(self.manifestctx(), match=match,
+                                         clean=listclean)
+        else:
+            # Load earliest manifest first for caching reasons. More
+            # specifically, if you have revisions 1000 and 1001, 1001 is
+            # probably stored as a delta against 1000. Thus, if you read 1000
+            # first, we'll reconstruct 1000 and cache it so that when you read
+            # 1001, we just need to apply a delta to what's in the cache. So
+            # that's one full reconstruction + one delta application.
+            if self.rev() is not None and self.rev() < other.rev():
+                mf2 = self._buildstatusmanifest(s)
+            mf1 = other._buildstatusmanifest(s)
+            if mf2 is None:
+                mf2 = self._buildstatusmanifest(s)
+            d = mf1.diff(mf2, match=match, clean=listclean)
 
         modified, added = [], []
         removed = []
         clean = []
         deleted, unknown, ignored = s.deleted, s.unknown, s.ignored
         deletedset = set(deleted)
-        d = mf1.diff(mf2, match=match, clean=listclean)
         for fn, value in d.iteritems():
             if fn in deletedset:
                 continue
@@ -190,6 +200,10 @@ class basectx(object):
     def mutable(self):
         return self.phase() > phases.public
 
+    def isinmemory(self):
+        """whether changes made to this context stay in memory"""
+        return False
+
     def getfileset(self, expr):
         return fileset.getfileset(self, expr)
 
@@ -1319,6 +1333,39 @@ class filectx(basefilectx):
         return [filectx(self._repo, self._path, fileid=x,
                         filelog=self._filelog) for x in c]
 
+# kinds of the results of _checklookupworker
+_lookupmodified = 0
+_lookupdeleted = 1
+_lookupclean = 2
+
+def _checklookupworker(wctx, pctx, files):
+    """compare files of the working directory to their parent revision
+
+    This yields a ``(kind, item)`` pair per file, where item is the file name
+    for modified and deleted files. For clean files, it is a ``(name, mode,
+    size, mtime)`` tuple: the stat is done before reading the content, so that
+    changes made in between are noticed by the next status.
+    """
+    wvfs = wctx._repo.wvfs
+    for f in files:
+        try:
+            st = wvfs.lstat(f)
+            # This will return True for a file that got replaced by a
+            # directory in the interim, but fixing that is pretty hard.
+            if (f not in pctx or wctx.flags(f) != pctx.flags(f)
+                or pctx[f].cmp(wctx[f])):
+                yield _lookupmodified, f
+            else:
+                yield _lookupclean, (f, st.st_mode, st.st_size, st.st_mtime)
+        except (IOError, OSError):
+            # A file become inaccessible in between? Mark it as deleted,
+            # matching dirstate behavior (issue5584).
+            # The dirstate has more complex behavior around whether a
+            # missing file matches a directory, etc, but we don't need to
+            # bother with that: if f has made it to this point, we're sure
+            # it's in the dirstate.
+            yield _lookupdeleted, f
+
 class committablectx(basectx):
     """A committablectx object provides common functionality for a context that
     wants the ability to commit, e.g. workingctx or memctx."""
@@ -1693,31 +1740,31 @@ class workingctx(committablectx):
         deleted = []
         fixup = []
         pctx = self._parents[0]
+        # read the manifest before the comparisons are spread over worker
+        # processes
+        pctx.manifest()
         # do a full compare of any files that might have changed
-        for f in sorted(files):
-            try:
-                # This will return True for a file that got replaced by a
-                # directory in the interim, but fixing that is pretty hard.
-                if (f not in pctx or self.flags(f) != pctx.flags(f)
-                    or pctx[f].cmp(self[f])):
-                    modified.append(f)
-                else:
-                    fixup.append(f)
-            except (IOError, OSError):
-                # A file become inaccessible in between? Mark it as deleted,
-                # matching dirstate behavior (issue5584).
-                # The dirstate has more complex behavior around whether a
-                # missing file matches a directory, etc, but we don't need to
-                # bother with that: if f has made it to this point, we're sure
-                # it's in the dirstate.
-                deleted.append(f)
+        prog = worker.worker(self._repo.ui, 0.001, _checklookupworker,
+                             (self, pctx), sorted(files))
+        for kind, item in prog:
+            if kind == _lookupmodified:
+                modified.append(item)
+            elif kind == _lookupdeleted:
+                deleted.append(item)
+            else:
+                f, mode, size, mtime = item
+                fixup.append((f, (mode, size, mtime)))
+        # workers report in no particular order
+        modified.sort()
+        deleted.sort()
+        fixup.sort()
 
         return modified, deleted, fixup
 
     def _poststatusfixup(self, status, fixup):
         """update dirstate for files that are actually clean"""
         poststatus = self._repo.postdsstatus()
-        if fixup or poststatus:
+        if fixup or poststatus or self._repo.dirstate.cachechanged():
             try:
                 oldid = self._repo.dirstate.identity()
 
@@ -1729,8 +1776,9 @@ class workingctx(committablectx):
                     if self._repo.dirstate.identity() == oldid:
                         if fixup:
                             normal = self._repo.dirstate.normal
-                            for f in fixup:
-                                normal(f)
+                            for f, parentfiledata in fixup:
+                                normal(f, parentfiledata=parentfiledata)
+                        if fixup or self._repo.dirstate.cachechanged():
                             # write changes out explicitly, because nesting
                             # wlock at runtime may prevent 'wlock.release()'
                             # after this block from doing so for subsequent
@@ -1770,7 +1818,7 @@ class workingctx(committablectx):
             s.deleted.extend(deleted2)
 
             if fixup and clean:
-                s.clean.extend(fixup)
+                s.clean.extend(f for f, parentfiledata in fixup)
 
         self._poststatusfixup(s, fixup)
 
@@ -1977,37 +2025,95 @@ class workingfilectx(committablefilectx):
     def setflags(self, l, x):
         self._repo.wvfs.setflags(self._path, l, x)
 
+    def markcopied(self, src):
+        """marks this file a copy of `src`"""
+        self._repo.dirstate.copy(src, self._path)
+
 class overlayworkingctx(workingctx):
     """Wraps another mutable context with a write-back cache that can be flushed
     at a later time.
 
+    The wrapped context can also be a changeset, in which case the changes are
+    kept in memory on top of it until ``tomemctx()`` turns them into a commit.
+    This is how merges run without touching the working directory.
+
     self._cache[path] maps to a dict with keys: {
         'exists': bool?
         'date': date?
         'data': str?
         'flags': str?
+        'copied': str?
     }
     If `exists` is True, `flags` must be non-None and 'date' is non-None. If it
     is `False`, the file was deleted.
     """
 
-    def __init__(self, repo, wrappedctx):
+    def __init__(self, repo):
         super(overlayworkingctx, self).__init__(repo)
         self._repo = repo
+        self._clean()
+
+    def setbase(self, wrappedctx):
+        """sets the context the changes are made on top of, and drops the
+        changes made so far"""
         self._wrappedctx = wrappedctx
+        # whether the changes are flushed to the working directory
+        self._ondisk = wrappedctx.rev() is None
+        if self._ondisk:
+            self._parents = wrappedctx.parents()
+        else:
+            self._parents = [wrappedctx]
         self._clean()
 
+    def __iter__(self):
+        return iter(self._manifest)
+
+    def __contains__(self, path):
+        if self.isdirty(path):
+            return self._cache[path]['exists']
+        return path in self._wrappedctx
+
+    @property
+    def _status(self):
+        """the changes in the cache, relative to the first parent"""
+        p1 = self.p1()
+        modified, added, removed = [], [], []
+        for path in sorted(self._cache):
+            entry = self._cache[path]
+            if path not in p1:
+                if entry['exists']:
+                    added.append(path)
+            elif not entry['exists']:
+                removed.append(path)
+            elif entry['flags'] != p1.flags(path) or p1[path].cmp(self[path]):
+                modified.append(path)
+        return scmutil.status(modified, added, removed, [], [], [], [])
+
+    @property
+    def _manifest(self):
+        return self._buildstatusmanifest(self._status)
+
+    @property
+    def _flagfunc(self):
+        return self.flags
+
+    def branch(self):
+        return self._wrappedctx.branch()
+
+    def isinmemory(self):
+        return not self._ondisk
+
     def data(self, path):
         if self.isdirty(path):
             if self._cache[path]['exists']:
-                if self._cache[path]['data']:
+                if self._cache[path]['data'] is not None:
                     return self._cache[path]['data']
                 else:
                     # Must fallback here, too, because we only set flags.
                     return self._wrappedctx[path].data()
             else:
                 raise error.ProgrammingError("No such file or directory: %s" %
-                                             self._path)
+                                             path)
         else:
             return self._wrappedctx[path].data()
 
@@ -2023,10 +2129,18 @@ class overlayworkingctx(workingctx):
                 return self._cache[path]['flags']
             else:
                 raise error.ProgrammingError("No such file or directory: %s" %
-                                             self._path)
+                                             path)
         else:
             return self._wrappedctx[path].flags()
 
+    def copydata(self, path):
+        """returns the source `path` was copied from, if any"""
+        if self.isdirty(path):
+            return self._cache[path]['copied']
+        if self._ondisk:
+            return self._repo.dirstate.copied(path)
+        return None
+
     def write(self, path, data, flags=''):
         if data is None:
             raise error.ProgrammingError("data must be non-None")
@@ -2034,12 +2148,21 @@ class overlayworkingctx(workingctx):
                         flags=flags)
 
     def setflags(self, path, l, x):
-        self._markdirty(path, exists=True, date=util.makedate(),
+        data = None
+        if self.isdirty(path) and self._cache[path]['exists']:
+            # keep the data already written
+            data = self._cache[path]['data']
+        self._markdirty(path, exists=True, data=data, date=util.makedate(),
                         flags=(l and 'l' or '') + (x and 'x' or ''))
 
     def remove(self, path):
         self._markdirty(path, exists=False)
 
+    def markcopied(self, path, origin):
+        # a clean file has no change for the copy to be recorded with
+        if self.isdirty(path) and self._cache[path]['exists']:
+            self._cache[path]['copied'] = origin
+
     def exists(self, path):
         """exists behaves like `lexists`, but needs to follow symlinks and
         return False if they are broken.
@@ -2049,27 +2172,61 @@ class overlayworkingctx(workingctx):
             # exists on the destination path.
             if (self._cache[path]['exists'] and
                         'l' in self._cache[path]['flags']):
-                return self.exists(self._cache[path]['data'].strip())
+                return self.exists(self.data(path).strip())
             else:
                 return self._cache[path]['exists']
+        if not self._ondisk:
+            return path in self._wrappedctx
         return self._wrappedctx[path].exists()
 
     def lexists(self, path):
         """lexists returns True if the path exists"""
         if self.isdirty(path):
             return self._cache[path]['exists']
+        if not self._ondisk:
+            return path in self._wrappedctx
         return self._wrappedctx[path].lexists()
 
     def size(self, path):
         if self.isdirty(path):
             if self._cache[path]['exists']:
-                return len(self._cache[path]['data'])
+                return len(self.data(path))
             else:
                 raise error.ProgrammingError("No such file or directory: %s" %
-                                             self._path)
+                                             path)
         return self._wrappedctx[path].size()
 
+    def tomemctx(self, text, branch=None, extra=None, date=None,
+                 parents=None, user=None, editor=None):
+        """Converts the changes into a ``memctx`` ready to be committed.
+
+        ``parents`` are the nodes of the parents of the commit, they default
+        to the ones of this context.
+        """
+        if parents is None:
+            parents = [p.node() for p in self.parents()]
+            if len(parents) == 1:
+                parents.append(None)
+
+        cache = self._cache
+        def getfile(repo, memctx, path):
+            if not cache[path]['exists']:
+                # the file was removed
+                return None
+            flags = self.flags(path)
+            return memfilectx(repo, path, self.data(path),
+                              islink='l' in flags, isexec='x' in flags,
+                              copied=cache[path]['copied'], memctx=memctx)
+
+        return memctx(self._repo, parents, text, self.files(), getfile,
+                      user=user, date=date, extra=extra, branch=branch,
+                      editor=editor)
+
     def flushall(self):
+        if not self._ondisk:
+            # there is no working directory to flush to, the changes stay in
+            # memory until they are committed
+            return
         for path in self._writeorder:
             entry = self._cache[path]
             if entry['exists']:
@@ -2084,6 +2241,8 @@ class overlayworkingctx(workingctx):
                     self._wrappedctx[path].setflags(
                         'l' in entry['flags'],
                         'x' in entry['flags'])
+                if entry['copied']:
+                    self._wrappedctx[path].markcopied(entry['copied'])
             else:
                 self._wrappedctx[path].remove(path)
         self._clean()
@@ -2099,11 +2258,16 @@ class overlayworkingctx(workingctx):
         if path not in self._cache:
             self._writeorder.append(path)
 
+        copied = None
+        if exists:
+            # rewriting a copied file keeps its copy source
+            copied = self._cache.get(path, {}).get('copied')
         self._cache[path] = {
             'exists': exists,
             'data': data,
             'date': date,
             'flags': flags,
+            'copied': copied,
         }
 
     def filectx(self, path, filelog=None):
@@ -2137,9 +2301,7 @@ class overlayworkingfilectx(workingfilectx):
         return self._parent.exists(self._path)
 
     def renamed(self):
-        # Copies are currently tracked in the dirstate as before. Straight copy
-        # from workingfilectx.
-        rp = self._repo.dirstate.copied(self._path)
+        rp = self._parent.copydata(self._path)
         if not rp:
             return None
         return rp, self._changectx._parents[0]._manifest.get(rp, nullid)
@@ -2156,12 +2318,18 @@ class overlayworkingfilectx(workingfilectx):
     def setflags(self, islink, isexec):
         return self._parent.setflags(self._path, islink, isexec)
 
+    def markcopied(self, src):
+        return self._parent.markcopied(self._path, src)
+
     def write(self, data, flags, backgroundclose=False):
         return self._parent.write(self._path, data, flags)
 
     def remove(self, ignoremissing=False):
         return self._parent.remove(self._path)
 
+    def clearunknown(self):
+        pass
+
 class workingcommitctx(workingctx):
     """A workingcommitctx object makes access to data related to
     the revision being committed convenient.
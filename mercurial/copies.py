@@ -842,14 +842,19 @@ def _checkcopies(srcctx, dstctx, f, base, tca, remotebase, limit, data):
                         data['incompletediverge'][sf] = [of, f]
                     return
 
-def duplicatecopies(repo, rev, fromrev, skiprev=None):
+def duplicatecopies(repo, rev, fromrev, skiprev=None, wctx=None):
     '''reproduce copies from fromrev to rev in the dirstate
 
     If skiprev is specified, it's a revision that should be used to
     filter copy records. Any copies that occur between fromrev and
     skiprev will not be duplicated, even if they appear in the set of
     copies between fromrev and rev.
+
+    If wctx is specified, the copies are recorded in it rather than in the
+    working directory.
     '''
+    if wctx is None:
+        wctx = repo[None]
     exclude = {}
     if (skiprev is not None and
         repo.ui.config('experimental', 'copytrace') != 'off'):
@@ -863,5 +868,5 @@ def duplicatecopies(repo, rev, fromrev, skiprev=None):
         # actually be in the dirstate
         if dst in exclude:
             continue
-        if repo.dirstate[dst] in "nma":
-            repo.dirstate.copy(src, dst)
+        if dst in wctx:
+            wctx[dst].markcopied(src)
@@ -49,6 +49,7 @@ from . import (
     localrepo,
     lock as lockmod,
     merge as mergemod,
+    nodemap,
     obsolete,
     obsutil,
     phases,
@@ -555,7 +556,11 @@ def debugdeltachain(ui, repo, file_=None, **opts):
     :``chainid``:   delta chain identifier (numbered by unique base)
     :``chainlen``:  delta chain length to this revision
     :``prevrev``:   previous revision in delta chain
-    :``deltatype``: role of delta / how it was computed
+    :``deltatype``: role of delta / how it was computed; ``snap`` denotes an
+                    intermediate snapshot (a delta against another snapshot
+                    of the chain rather than against a parent)
+    :``snapdepth``: number of snapshots the revision is based on, if the
+                    revision is a snapshot itself, -1 otherwise
     :``compsize``:  compressed size of revision
     :``uncompsize``: uncompressed size of revision
     :``chainsize``: total size of compressed revisions in chain
@@ -569,11 +574,21 @@ def debugdeltachain(ui, repo, file_=None, **opts):
                     the delta chain for this revision
     :``extraratio``: extradist divided by chainsize; another representation of
                     how much unrelated data is needed to load this delta chain
+
+    If the repository is configured to use the sparse read, additional keywords
+    are available:
+
+    :``readsize``:     total size of data read from the disk for a revision
+                       (sum of the sizes of all the blocks)
+    :``largestblock``: size of the largest block of data read from the disk
+    :``readdensity``:  density of useful bytes in the data read from the disk
+    :``srchunks``:     in how many data hunks the whole revision would be read
     """
     opts = pycompat.byteskwargs(opts)
     r = cmdutil.openrevlog(repo, 'debugdeltachain', file_, opts)
     index = r.index
     generaldelta = r.version & revlog.FLAG_GENERALDELTA
+    withsparseread = getattr(r, '_withsparseread', False)
 
     def revinfo(rev):
         e = index[rev]
@@ -590,6 +605,8 @@ def debugdeltachain(ui, repo, file_=None, **opts):
                 deltatype = 'prev'
             elif e[3] == rev:
                 deltatype = 'base'
+            elif r.issnapshot(rev):
+                deltatype = 'snap'
             else:
                 deltatype = 'other'
         else:
@@ -609,7 +626,10 @@ def debugdeltachain(ui, repo, file_=None, **opts):
 
     fm.plain('    rev  chain# chainlen     prev   delta       '
              'size    rawsize  chainsize     ratio   lindist extradist '
-             'extraratio\n')
+             'extraratio')
+    if withsparseread:
+        fm.plain('   readsize largestblk rddensity srchunks')
+    fm.plain('\n')
 
     chainbases = {}
     for rev in r:
@@ -632,7 +652,7 @@ def debugdeltachain(ui, repo, file_=None, **opts):
         fm.write('rev chainid chainlen prevrev deltatype compsize '
                  'uncompsize chainsize chainratio lindist extradist '
                  'extraratio',
-                 '%7d %7d %8d %8d %7s %10d %10d %10d %9.5f %9d %9d %10.5f\n',
+                 '%7d %7d %8d %8d %7s %10d %10d %10d %9.5f %9d %9d %10.5f',
                  rev, chainid, len(chain), prevrev, deltatype, comp,
                  uncomp, chainsize, chainratio, lineardist, extradist,
                  extraratio,
@@ -641,6 +661,36 @@ def debugdeltachain(ui, repo, file_=None, **opts):
                  uncompsize=uncomp, chainsize=chainsize,
                  chainratio=chainratio, lindist=lineardist,
                  extradist=extradist, extraratio=extraratio)
+        if r.issnapshot(rev):
+            fm.data(snapdepth=r.snapshotdepth(rev))
+        else:
+            fm.data(snapdepth=-1)
+        if withsparseread:
+            readsize = 0
+            largestblock = 0
+            srchunks = 0
+
+            for revschunk in revlog._slicechunk(r, chain):
+                srchunks += 1
+                blkend = r.start(revschunk[-1]) + r.length(revschunk[-1])
+                blksize = blkend - r.start(revschunk[0])
+
+                readsize += blksize
+                if largestblock < blksize:
+                    largestblock = blksize
+
+            if readsize:
+                readdensity = float(chainsize) / float(readsize)
+            else:
+                readdensity = 1.0
+
+            fm.write('readsize largestblock readdensity srchunks',
+                     ' %10d %10d %9.5f %8d',
+                     readsize, largestblock, readdensity, srchunks,
+                     readsize=readsize, largestblock=largestblock,
+                     readdensity=readdensity, srchunks=srchunks)
+
+        fm.plain('\n')
 
     fm.end()
 
@@ -1343,6 +1393,35 @@ def debugnamecomplete(ui, repo, *args):
     ui.write('\n'.join(sorted(completions)))
     ui.write('\n')
 
+@command('debugnodemap',
+    [('', 'update', False, _('bring the persistent nodemaps up to date'))],
+    '')
+def debugnodemap(ui, repo, **opts):
+    """show the state of the persistent nodemaps of the repository
+
+    The persistent nodemaps of the changelog and of the manifest speed up
+    the lookup of revisions by node. They are maintained by transactions
+    when ``experimental.persistent-nodemap`` is enabled. ``--update``
+    writes them for a repository that does not have them yet.
+    """
+    unfi = repo.unfiltered()
+    revlogs = [unfi.changelog, unfi.manifestlog._revlog]
+    if opts.get(r'update'):
+        if not ui.configbool('experimental', 'persistent-nodemap'):
+            raise error.Abort(_('persistent nodemaps are not enabled'),
+                              hint=_('set experimental.persistent-nodemap'))
+        with repo.lock():
+            with repo.transaction('nodemap') as tr:
+                for rl in revlogs:
+                    nodemap.setupupdate(tr, rl)
+    for rl in revlogs:
+        d, nm = nodemap.readnodemap(rl)
+        if nm is None:
+            ui.write(('%s: no valid nodemap\n') % rl.indexfile)
+            continue
+        ui.write(('%s: %d entries (%d sorted), tip %d\n')
+                 % (rl.indexfile, d.entrycount, d.sortedcount, d.tiprev))
+
 @command('debugobsolete',
         [('', 'flags', 0, _('markers flag')),
          ('', 'record-parents', False,
@@ -2255,6 +2334,12 @@ def debugupgraderepo(ui, repo, run=False, optimize=None):
     can be influenced via additional arguments. More details will be provided
     by the command output when run without ``--run``.
 
+    Revlogs are rewritten with the delta chain limits configured by
+    ``format.maxchainlen`` and ``experimental.maxdeltachainspan``: existing
+    deltas making a chain exceed them are recalculated. An upgrade therefore
+    brings existing revlogs within limits configured after they were
+    written, without any optimization requested.
+
     During the upgrade, the repository will be locked and no writes will be
     allowed.
 
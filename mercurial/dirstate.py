@@ -10,11 +10,17 @@ from __future__ import absolute_import
 import collections
 import contextlib
 import errno
+import hashlib
 import os
 import stat
+import struct
+import threading
 
 from .i18n import _
-from .node import nullid
+from .node import (
+    hex,
+    nullid,
+)
 from . import (
     encoding,
     error,
@@ -54,16 +60,132 @@ def _getfsnow(vfs):
         os.close(tmpfd)
         vfs.unlink(tmpname)
 
+_ignorecachefile = 'ignore'
+_ignorecacheversion = '1'
+_ignorebucketnames = ('name', 'suffix', 'prefix', 're', 'subinclude')
+
+def _encodeignorecache(warnings, buckets):
+    '''Serialize the warnings and buckets of an ignorematcher, one item
+    per line'''
+    lines = ['warning %s' % util.escapestr(msg) for msg in warnings]
+    for name, bucket in zip(_ignorebucketnames, buckets):
+        if name == 'subinclude':
+            bucket = ['\0'.join(s) for s in bucket]
+        lines.extend('%s %s' % (name, v) for v in bucket)
+    return ''.join(l + '\n' for l in lines)
+
+def _decodeignorecache(lines):
+    '''Parse the lines written by _encodeignorecache()
+
+    Raise ValueError if they are corrupted.'''
+    warnings = []
+    buckets = tuple([] for name in _ignorebucketnames)
+    for l in lines:
+        if not l:
+            continue
+        name, v = l.split(' ', 1)
+        if name == 'warning':
+            warnings.append(util.unescapestr(v))
+        elif name == 'subinclude':
+            prefix, root, include = v.split('\0')
+            buckets[-1].append((prefix, root, include))
+        else:
+            buckets[_ignorebucketnames.index(name)].append(v)
+    return warnings, buckets
+
+class _listdirjob(object):
+    """the listing of a directory by a ``_listdirpool``"""
+
+    def __init__(self, path):
+        self._path = path
+        self._done = threading.Event()
+        self._result = None
+        self._exc = None
+
+    def run(self):
+        try:
+            self._result = util.listdir(self._path, stat=True, skip='.hg')
+        except Exception as inst:
+            # re-raised in the thread waiting for the result
+            self._exc = inst
+        self._done.set()
+
+    def result(self):
+        """wait for the listing and return it like ``util.listdir``"""
+        self._done.wait()
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+class _listdirpool(object):
+    """list directories in background threads
+
+    Listing a directory mostly waits for the filesystem, and the listdir
+    implementations release the GIL while doing so. Listing the
+    subdirectories found by ``dirstate.walk`` ahead of their traversal
+    keeps several requests in flight, which helps on network filesystems
+    and with cold caches.
+    """
+
+    def __init__(self, threadcount):
+        self._queue = util.queue()
+        self._jobs = {}
+        self._threads = []
+        for i in range(threadcount):
+            t = threading.Thread(target=self._worker, name='dirstatewalk')
+            t.daemon = True
+            self._threads.append(t)
+            t.start()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def listahead(self, nd, path):
+        """start listing the subdirectory nd at path"""
+        job = _listdirjob(path)
+        self._jobs[nd] = job
+        self._queue.put(job)
+
+    def pop(self, nd):
+        """return the job listing nd, or None if it was not listed ahead"""
+        return self._jobs.pop(nd, None)
+
+    def close(self):
+        # drop the listings nobody is going to wait for
+        try:
+            while True:
+                self._queue.get_nowait()
+        except util.empty:
+            pass
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
 class dirstate(object):
 
-    def __init__(self, opener, ui, root, validate, sparsematchfn):
+    def __init__(self, opener, ui, root, validate, sparsematchfn,
+                 treedirstate=False, dirstatelog=False, cachevfs=None):
         '''Create a new dirstate object.
 
         opener is an open()-like callable that can be used to open the
         dirstate file; root is the root of the directory tracked by
-        the dirstate.
+        the dirstate. treedirstate selects the tree format of the dirstate
+        file (see treedirstatemap). dirstatelog enables appending small
+        changes to the dirstate log instead of rewriting the dirstate file
+        (see dirstatemap.writelog). cachevfs, if given, is where the
+        compiled ignore patterns are cached (see _bucketedignore).
         '''
         self._opener = opener
+        self._cachevfs = cachevfs
+        if treedirstate:
+            self._mapcls = treedirstatemap
+        else:
+            self._mapcls = dirstatemap
         self._validate = validate
         self._root = root
         self._sparsematchfn = sparsematchfn
@@ -77,9 +199,14 @@ class dirstate(object):
         self._parentwriters = 0
         self._filename = 'dirstate'
         self._pendingfilename = '%s.pending' % self._filename
+        self._logfilename = '%s.log' % self._filename
+        self._uselog = dirstatelog
         self._plchangecallbacks = {}
         self._origpl = None
         self._updatedfiles = set()
+        self._dirtycache = False
+        # whether _updatedfiles misses changes to write out
+        self._fullwrite = False
 
     @contextlib.contextmanager
     def parentchange(self):
@@ -155,11 +282,7 @@ class dirstate(object):
 
     @propertycache
     def _dirfoldmap(self):
-        f = {}
-        normcase = util.normcase
-        for name in self._dirs:
-            f[normcase(name)] = name
-        return f
+        return self._map.dirfoldmap()
 
     @property
     def _sparsematcher(self):
@@ -201,8 +324,49 @@ class dirstate(object):
             return matchmod.never(self._root, '')
 
         pats = ['include:%s' % f for f in files]
+        if self._ui.configbool('experimental', 'bucketed-ignore'):
+            return self._bucketedignore(pats)
         return matchmod.match(self._root, '', [], pats, warn=self._ui.warn)
 
+    def _bucketedignore(self, pats):
+        '''Return an ignorematcher for the ignore patterns, or a plain
+        include matcher if they cannot be bucketed.
+
+        The buckets are cached in .hg/cache/ignore, along with the warnings
+        issued while reading the ignore files, and are reused as long as the
+        hash of the ignore files is the same.'''
+        cachevfs = self._cachevfs
+        if cachevfs is not None:
+            key = '%s %s' % (_ignorecacheversion, hex(self._ignorehash()))
+            try:
+                lines = cachevfs.read(_ignorecachefile).split('\n')
+                if lines[0] == key:
+                    warnings, buckets = _decodeignorecache(lines[1:])
+                    for msg in warnings:
+                        self._ui.warn(msg)
+                    return matchmod.ignorematcher(self._root, '', buckets)
+            except (IOError, ValueError):
+                pass
+
+        warnings = []
+        def warn(msg):
+            warnings.append(msg)
+            self._ui.warn(msg)
+        kindpats = matchmod._donormalize(pats, 'glob', self._root, '', None,
+                                         warn)
+        buckets = matchmod.ignorebuckets(self._root, kindpats)
+        if buckets is None:
+            return matchmod.includematcher(self._root, '', kindpats)
+        if cachevfs is not None:
+            try:
+                f = cachevfs(_ignorecachefile, 'w', atomictemp=True)
+                f.write(key + '\n')
+                f.write(_encodeignorecache(warnings, buckets))
+                f.close()
+            except (IOError, OSError, error.Abort) as inst:
+                self._ui.debug("couldn't write ignore cache: %s\n" % inst)
+        return matchmod.ignorematcher(self._root, '', buckets)
+
     @propertycache
     def _slash(self):
         return self._ui.configbool('ui', 'slash') and pycompat.ossep != '/'
@@ -386,53 +550,17 @@ class dirstate(object):
             raise
 
     def _read(self):
-        self._map = dirstatemap(self._ui, self._opener, self._root)
+        self._map = self._mapcls(self._ui, self._opener, self._root,
+                                 self._uselog)
 
         # ignore HG_PENDING because identity is used only for writing
         self._identity = util.filestat.frompath(
             self._opener.join(self._filename))
-        try:
-            fp = self._map._opendirstatefile()
-            try:
-                st = fp.read()
-            finally:
-                fp.close()
-        except IOError as err:
-            if err.errno != errno.ENOENT:
-                raise
-            return
-        if not st:
-            return
-
-        if util.safehasattr(parsers, 'dict_new_presized'):
-            # Make an estimate of the number of files in the dirstate based on
-            # its size. From a linear regression on a set of real-world repos,
-            # all over 10,000 files, the size of a dirstate entry is 85
-            # bytes. The cost of resizing is significantly higher than the cost
-            # of filling in a larger presized dict, so subtract 20% from the
-            # size.
-            #
-            # This heuristic is imperfect in many ways, so in a future dirstate
-            # format update it makes sense to just record the number of entries
-            # on write.
-            self._map._map = parsers.dict_new_presized(len(st) / 71)
-
-        # Python's garbage collector triggers a GC each time a certain number
-        # of container objects (the number being defined by
-        # gc.get_threshold()) are allocated. parse_dirstate creates a tuple
-        # for each file in the dirstate. The C version then immediately marks
-        # them as not to be tracked by the collector. However, this has no
-        # effect on when GCs are triggered, only on what objects the GC looks
-        # into. This means that O(number of files) GCs are unavoidable.
-        # Depending on when in the process's lifetime the dirstate is parsed,
-        # this can get very expensive. As a workaround, disable GC while
-        # parsing the dirstate.
-        #
-        # (we cannot decorate the function directly since it is in a C module)
-        parse_dirstate = util.nogc(parsers.parse_dirstate)
-        p = parse_dirstate(self._map._map, self._map.copymap, st)
-        if not self._map._dirtyparents:
-            self._map.setparents(*p)
+        if self._uselog:
+            logid = util.filestat.frompath(
+                self._opener.join(self._logfilename))
+            self._identity = (self._identity, logid)
+        self._map.read()
 
     def invalidate(self):
         '''Causes the next access to reread the dirstate.
@@ -448,7 +576,7 @@ class dirstate(object):
             if a in self.__dict__:
                 delattr(self, a)
         self._lastnormaltime = 0
-        self._dirty = False
+        self._dirty = self._dirtycache = self._fullwrite = False
         self._updatedfiles.clear()
         self._parentwriters = 0
         self._origpl = None
@@ -472,13 +600,21 @@ class dirstate(object):
         return self._map.copymap
 
     def _droppath(self, f):
-        if self[f] not in "?r" and "_dirs" in self.__dict__:
+        tracked = self[f] not in "?r"
+        # the directory fold map is pruned of the directories left empty,
+        # which needs the directories
+        if tracked and ("_dirs" in self.__dict__ or
+                        "_dirfoldmap" in self.__dict__):
             self._dirs.delpath(f)
 
         if "_filefoldmap" in self.__dict__:
-            normed = util.normcase(f)
-            if normed in self._filefoldmap:
-                del self._filefoldmap[normed]
+            self._filefoldmap.pop(util.normcase(f), None)
+        if tracked and "_dirfoldmap" in self.__dict__:
+            dirfoldmap = self._dirfoldmap
+            for d in util.finddirs(f):
+                if d in self._dirs:
+                    break
+                dirfoldmap.pop(util.normcase(d), None)
 
         self._updatedfiles.add(f)
 
@@ -501,17 +637,31 @@ class dirstate(object):
         self._dirty = True
         self._updatedfiles.add(f)
         self._map[f] = dirstatetuple(state, mode, size, mtime)
+        if "_filefoldmap" in self.__dict__:
+            self._filefoldmap[util.normcase(f)] = f
+        if oldstate in "?r" and "_dirfoldmap" in self.__dict__:
+            dirfoldmap = self._dirfoldmap
+            for d in util.finddirs(f):
+                normed = util.normcase(d)
+                if normed in dirfoldmap:
+                    break
+                dirfoldmap[normed] = d
         if state != 'n' or mtime == -1:
             self._nonnormalset.add(f)
         if size == -2:
             self._otherparentset.add(f)
 
-    def normal(self, f):
-        '''Mark a file normal and clean.'''
-        s = os.lstat(self._join(f))
-        mtime = s.st_mtime
-        self._addpath(f, 'n', s.st_mode,
-                      s.st_size & _rangemask, mtime & _rangemask)
+    def normal(self, f, parentfiledata=None):
+        '''Mark a file normal and clean.
+
+        parentfiledata is the (mode, size, mtime) of the file when it was
+        found clean, when already known. Otherwise the file is stat'ed.'''
+        if parentfiledata:
+            mode, size, mtime = parentfiledata
+        else:
+            s = os.lstat(self._join(f))
+            mode, size, mtime = s.st_mode, s.st_size, s.st_mtime
+        self._addpath(f, 'n', mode, size & _rangemask, mtime & _rangemask)
         self._map.copymap.pop(f, None)
         if f in self._nonnormalset:
             self._nonnormalset.remove(f)
@@ -625,6 +775,11 @@ class dirstate(object):
         return folded
 
     def _normalizefile(self, path, isknown, ignoremissing=False, exists=None):
+        # paths given in the case recorded in the dirstate do not need the
+        # fold maps
+        entry = self._map.get(path)
+        if entry is not None and entry[0] != 'r':
+            return path
         normed = util.normcase(path)
         folded = self._filefoldmap.get(normed, None)
         if folded is None:
@@ -636,6 +791,9 @@ class dirstate(object):
         return folded
 
     def _normalize(self, path, isknown, ignoremissing=False, exists=None):
+        entry = self._map.get(path)
+        if entry is not None and entry[0] != 'r':
+            return path
         normed = util.normcase(path)
         folded = self._filefoldmap.get(normed, None)
         if folded is None:
@@ -673,15 +831,17 @@ class dirstate(object):
         return path
 
     def clear(self):
-        self._map = dirstatemap(self._ui, self._opener, self._root)
+        self._map = self._mapcls(self._ui, self._opener, self._root,
+                                 self._uselog)
         self._nonnormalset = set()
         self._otherparentset = set()
-        if "_dirs" in self.__dict__:
-            delattr(self, "_dirs")
+        for a in ("_dirs", "_filefoldmap", "_dirfoldmap"):
+            if a in self.__dict__:
+                delattr(self, a)
         self._map.setparents(nullid, nullid)
         self._lastnormaltime = 0
         self._updatedfiles.clear()
-        self._dirty = True
+        self._dirty = self._fullwrite = True
 
     def rebuild(self, parent, allfiles, changedfiles=None):
         if changedfiles is None:
@@ -729,19 +889,54 @@ class dirstate(object):
                 e = dmap.get(f)
                 if e is not None and e[0] == 'n' and e[3] == now:
                     dmap[f] = dirstatetuple(e[0], e[1], e[2], -1)
-                    self._nonnormalset.add(f)
+                    if '_nonnormalset' in self.__dict__:
+                        self._nonnormalset.add(f)
 
             # emulate that all 'dirstate.normal' results are written out
             self._lastnormaltime = 0
             self._updatedfiles.clear()
+            self._fullwrite = True
 
             # delay writing in-memory changes out
             tr.addfilegenerator('dirstate', (self._filename,),
                                 self._writedirstate, location='plain')
+            if self._uselog:
+                tr.addpostclose('dirstate-log', self._removelog)
             return
 
+        if self._writelog():
+            return
         st = self._opener(filename, "w", atomictemp=True, checkambig=True)
         self._writedirstate(st)
+        if self._uselog:
+            self._removelog()
+
+    def _writelog(self):
+        '''Append the changes to the dirstate log instead of rewriting the
+        dirstate file, if possible. Return True if they were written.'''
+        if (not self._uselog or self._fullwrite or self._dirtycache or
+            not self._updatedfiles):
+            return False
+        now = _getfsnow(self._opener) & _rangemask
+        dmap = self._map
+        files = self._updatedfiles
+        now = self._delaywrite(now, (dmap.get(f) for f in files))
+        if not dmap.writelog(files, now):
+            return False
+        self._notifyparentchange()
+        # writing may have dropped ambiguous timestamps
+        for a in ('_nonnormalset', '_otherparentset'):
+            if a in self.__dict__:
+                delattr(self, a)
+        self._lastnormaltime = 0
+        self._updatedfiles.clear()
+        self._dirty = False
+        return True
+
+    def _removelog(self, tr=None):
+        '''Remove the dirstate log, once the dirstate file holds its
+        changes'''
+        self._opener.tryunlink(self._logfilename)
 
     def addparentchangecallback(self, category, callback):
         """add a callback to be called when the wd parents are changed
@@ -754,23 +949,21 @@ class dirstate(object):
         """
         self._plchangecallbacks[category] = callback
 
-    def _writedirstate(self, st):
+    def _notifyparentchange(self):
         # notify callbacks about parents change
         if self._origpl is not None and self._origpl != self._pl:
             for c, callback in sorted(self._plchangecallbacks.iteritems()):
                 callback(self, self._origpl, self._pl)
             self._origpl = None
-        # use the modification time of the newly created temporary file as the
-        # filesystem's notion of 'now'
-        now = util.fstat(st).st_mtime & _rangemask
 
+    def _delaywrite(self, now, entries):
         # enough 'delaywrite' prevents 'pack_dirstate' from dropping
         # timestamp of each entries in dirstate, because of 'now > mtime'
         delaywrite = self._ui.configint('debug', 'dirstate.delaywrite', 0)
         if delaywrite > 0:
             # do we have any files to delay for?
-            for f, e in self._map.iteritems():
-                if e[0] == 'n' and e[3] == now:
+            for e in entries:
+                if e is not None and e[0] == 'n' and e[3] == now:
                     import time # to avoid useless import
                     # rather than sleep n seconds, sleep until the next
                     # multiple of n seconds
@@ -780,17 +973,34 @@ class dirstate(object):
                     time.sleep(end - clock)
                     now = end # trust our estimate that the end is near now
                     break
+        return now
 
-        st.write(parsers.pack_dirstate(self._map._map, self._map.copymap,
-                                       self._pl, now))
-        self._nonnormalset, self._otherparentset = self._map.nonnormalentries()
-        st.close()
+    def _writedirstate(self, st):
+        self._notifyparentchange()
+        # use the modification time of the newly created temporary file as the
+        # filesystem's notion of 'now'
+        now = util.fstat(st).st_mtime & _rangemask
+        now = self._delaywrite(now, (e for f, e in self._map.iteritems()))
+
+        self._map.write(st, now)
+        # writing may have dropped ambiguous timestamps
+        for a in ('_nonnormalset', '_otherparentset'):
+            if a in self.__dict__:
+                delattr(self, a)
         self._lastnormaltime = 0
-        self._dirty = self._map._dirtyparents = False
+        self._updatedfiles.clear()
+        self._dirty = self._dirtycache = self._fullwrite = False
+
+    def cachechanged(self):
+        '''Returns true if data cached in the dirstate to speed up status,
+        like the mtimes of walked directories, should be written out.'''
+        return self._dirtycache
 
     def _dirignore(self, f):
         if f == '.':
             return False
+        if isinstance(self._ignore, matchmod.ignorematcher):
+            return self._ignore.visitdir(f) == 'all'
         if self._ignore(f):
             return True
         for p in util.finddirs(f):
@@ -991,6 +1201,7 @@ class dirstate(object):
         dmap = self._map
         listdir = util.listdir
         lstat = os.lstat
+        getkind = stat.S_IFMT
         dirkind = stat.S_IFDIR
         regkind = stat.S_IFREG
         lnkkind = stat.S_IFLNK
@@ -1017,6 +1228,41 @@ class dirstate(object):
         skipstep3 = skipstep3 and not (work or dirsnotfound)
         work = [d for d in work if not dirignore(d[0])]
 
+        # directories listed by the dirstate when unchanged, see
+        # _walkcachednow
+        cachednow = None
+        if unknown and not ignored:
+            cachednow = self._walkcachednow()
+        # directories known from the dirstate, which may only hold removed
+        # files
+        cacheddirs = set()
+
+        # subdirectories are listed ahead of their traversal by a thread pool
+        pool = None
+        threadcount = self._ui.configint('experimental', 'walk-threads')
+        if threadcount > 0 and work:
+            pool = _listdirpool(threadcount)
+
+        def visitcached(nd, wadd):
+            files, dirs = dmap.dirlisting(nd)
+            for f in files:
+                nf = nd and (nd + "/" + f) or f
+                if nf not in results and (matchalways or matchfn(nf)):
+                    try:
+                        st = lstat(join(nf))
+                        kind = getkind(st.st_mode)
+                        if kind != regkind and kind != lnkkind:
+                            st = None
+                    except OSError:
+                        st = None
+                    results[nf] = st
+            for f in dirs:
+                nf = nd and (nd + "/" + f) or f
+                if nf not in results and not ignore(nf):
+                    # reported to matchtdir once known to exist
+                    cacheddirs.add(nf)
+                    wadd(nf)
+
         # step 2: visit subdirectories
         def traverse(work, alreadynormed):
             wadd = work.append
@@ -1029,8 +1275,29 @@ class dirstate(object):
                     nd = ''
                 else:
                     skip = '.hg'
+                cacheable = False
+                if cachednow is not None:
+                    try:
+                        mtime = int(lstat(join(nd)).st_mtime)
+                    except OSError:
+                        if nd in cacheddirs:
+                            continue
+                        mtime = None
+                    if nd in cacheddirs and matchtdir:
+                        matchtdir(nd)
+                    if mtime is not None:
+                        if dmap.dirmtime(nd) == mtime & _rangemask:
+                            visitcached(nd, wadd)
+                            continue
+                        # the listing may change within the same timeslot
+                        # without changing the mtime
+                        cacheable = mtime < cachednow
+                job = pool and pool.pop(nd)
                 try:
-                    entries = listdir(join(nd), stat=True, skip=skip)
+                    if job is not None:
+                        entries = job.result()
+                    else:
+                        entries = listdir(join(nd), stat=True, skip=skip)
                 except OSError as inst:
                     if inst.errno in (errno.EACCES, errno.ENOENT):
                         match.bad(self.pathto(nd),
@@ -1052,8 +1319,16 @@ class dirstate(object):
                                 if matchtdir:
                                     matchtdir(nf)
                                 wadd(nf)
-                            if nf in dmap and (matchalways or matchfn(nf)):
-                                results[nf] = None
+                                if (pool and match.visitdir(nf) and
+                                    (cachednow is None or
+                                     dmap.dirmtime(nf) == -1)):
+                                    pool.listahead(nf, join(nf))
+                                if cacheable and not dmap.hasdir(nf):
+                                    cacheable = False
+                            if nf in dmap:
+                                cacheable = False
+                                if matchalways or matchfn(nf):
+                                    results[nf] = None
                         elif kind == regkind or kind == lnkkind:
                             if nf in dmap:
                                 if matchalways or matchfn(nf):
@@ -1064,14 +1339,33 @@ class dirstate(object):
                                 if not alreadynormed:
                                     nf = normalize(nf, False, True)
                                 results[nf] = st
-                        elif nf in dmap and (matchalways or matchfn(nf)):
-                            results[nf] = None
+                                cacheable = False
+                            elif cacheable and not ignore(nf):
+                                cacheable = False
+                        elif nf in dmap:
+                            cacheable = False
+                            if matchalways or matchfn(nf):
+                                results[nf] = None
+                    elif nf != '.hg':
+                        # explicitly listed files and subrepos are not
+                        # checked here
+                        cacheable = False
+                if cacheable:
+                    dmap.setdirmtime(nd, mtime & _rangemask)
+                    self._dirty = self._dirtycache = True
+                elif cachednow is not None and dmap.dirmtime(nd) != -1:
+                    dmap.setdirmtime(nd, -1)
+                    self._dirty = self._dirtycache = True
 
-        for nd, d in work:
-            # alreadynormed means that processwork doesn't have to do any
-            # expensive directory normalization
-            alreadynormed = not normalize or nd == d
-            traverse([d], alreadynormed)
+        try:
+            for nd, d in work:
+                # alreadynormed means that processwork doesn't have to do any
+                # expensive directory normalization
+                alreadynormed = not normalize or nd == d
+                traverse([d], alreadynormed)
+        finally:
+            if pool:
+                pool.close()
 
         for s in subrepos:
             del results[s]
@@ -1124,6 +1418,54 @@ class dirstate(object):
                     results[next(iv)] = st
         return results
 
+    def _ignorehash(self):
+        '''Return a hash of the ignore files, including the included and
+        subincluded ones'''
+        s = hashlib.sha1()
+        files = collections.deque(self._ignorefiles())
+        visited = set()
+        while files:
+            i = files.popleft()
+            if i in visited:
+                continue
+            visited.add(i)
+            s.update(i + '\0')
+            try:
+                s.update(hashlib.sha1(util.readfile(i)).digest())
+                # the ignore matcher already warned about invalid lines
+                patterns = matchmod.readpatternfile(i, None)
+            except IOError:
+                continue
+            for pattern in patterns:
+                kind, p = matchmod._patsplit(pattern, 'glob')
+                if kind == "include":
+                    files.append(os.path.join(self._root, util.localpath(p)))
+                elif kind == "subinclude":
+                    files.append(os.path.join(os.path.dirname(i), p))
+        return s.digest()
+
+    def _walkcachednow(self):
+        '''Return the current time of the filesystem if walk can skip
+        listing the directories unchanged since the dirstate recorded them,
+        None otherwise.
+
+        Unknown files are only found by listing directories, so a directory
+        mtime is only recorded when all its entries are tracked files,
+        ignored or directories of the dirstate. Recorded mtimes depend on the
+        ignore files and are forgotten when they change.
+        '''
+        dmap = self._map
+        if not util.safehasattr(dmap, 'dirmtime'):
+            return None
+        ignorehash = self._ignorehash()
+        if dmap.ignorehash != ignorehash:
+            dmap.cleardirmtimes(ignorehash)
+        try:
+            return int(_getfsnow(self._opener))
+        except (IOError, OSError):
+            # recorded mtimes can still be used
+            return -1
+
     def status(self, match, subrepos, ignored, clean, unknown):
         '''Determine the status of the working copy relative to the
         dirstate and return a pair of (unsure, status), where status is of type
@@ -1248,9 +1590,14 @@ class dirstate(object):
         # use '_writedirstate' instead of 'write' to write changes certainly,
         # because the latter omits writing out if transaction is running.
         # output file will be used to create backup of dirstate at this point.
-        if self._dirty or not self._opener.exists(filename):
+        # the backup must not depend on the dirstate log either.
+        haslog = (self._uselog and not tr and
+                  self._opener.exists(self._logfilename))
+        if self._dirty or haslog or not self._opener.exists(filename):
             self._writedirstate(self._opener(filename, "w", atomictemp=True,
                                              checkambig=True))
+            if haslog:
+                self._removelog()
 
         if tr:
             # ensure that subsequent tr.writepending returns True for
@@ -1258,6 +1605,8 @@ class dirstate(object):
             # changed after this
             tr.addfilegenerator('dirstate', (self._filename,),
                                 self._writedirstate, location='plain')
+            if self._uselog:
+                tr.addpostclose('dirstate-log', self._removelog)
 
             # ensure that pending file written above is unlinked at
             # failure, even if tr.writepending isn't invoked until the
@@ -1276,24 +1625,47 @@ class dirstate(object):
         # changes of dirstate out after restoring from backup file
         self.invalidate()
         filename = self._actualfilename(tr)
+        if self._uselog and not tr:
+            # the backup may be a hardlink of the dirstate file the log
+            # applies to
+            self._removelog()
         self._opener.rename(backupname, filename, checkambig=True)
 
     def clearbackup(self, tr, backupname):
         '''Clear backup file'''
         self._opener.unlink(backupname)
 
+# The dirstate log holds the changes made to the dirstate since the dirstate
+# file was last written. Its header identifies the dirstate file the changes
+# apply to by its size and mtime. It is followed by batches of changes, each
+# starting with the size and the sha1 of its data. The data of a batch is in
+# the flat dirstate format: the parents, then the changed entries, with a '?'
+# state for the dropped ones.
+_logheader = struct.Struct('>Qq')
+_logbatchheader = struct.Struct('>I20s')
+# the dirstate file is rewritten once the log would get larger than this
+# fraction of its size
+_logmaxratio = 4
+
 class dirstatemap(object):
-    def __init__(self, ui, opener, root):
+    def __init__(self, ui, opener, root, uselog=False):
         self._ui = ui
         self._opener = opener
         self._root = root
         self._filename = 'dirstate'
+        self._logfilename = '%s.log' % self._filename
 
         self._map = {}
         self.copymap = {}
         self._parents = None
         self._dirtyparents = False
 
+        # header of the dirstate log matching the dirstate file read, and
+        # end of the valid batches of the log
+        self._uselog = uselog
+        self._logkey = None
+        self._logend = 0
+
         # for consistent view between _pl() and _read() invocations
         self._pendingmode = None
 
@@ -1355,6 +1727,16 @@ class dirstatemap(object):
         f['.'] = '.' # prevents useless util.fspath() invocation
         return f
 
+    def dirfoldmap(self):
+        """Returns a dictionary mapping normalized case directories to their
+        non-normalized versions.
+        """
+        f = {}
+        normcase = util.normcase
+        for name in self.dirs():
+            f[normcase(name)] = name
+        return f
+
     def dirs(self):
         """Returns a set-like object containing all the directories in the
         current dirstate.
@@ -1370,10 +1752,166 @@ class dirstatemap(object):
         self._pendingmode = mode
         return fp
 
+    def _readdirstatefile(self):
+        try:
+            fp = self._opendirstatefile()
+            try:
+                if self._uselog and not self._pendingmode:
+                    self._logkey = self._filelogkey(fp)
+                return fp.read()
+            finally:
+                fp.close()
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return ''
+
+    def _filelogkey(self, fp):
+        st = util.fstat(fp)
+        return _logheader.pack(st.st_size, st.st_mtime)
+
+    def _readlog(self, logkey):
+        '''Return the batches of the dirstate log applying to the dirstate
+        file of the given log header, and the end of the last one'''
+        try:
+            data = self._opener.read(self._logfilename)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return [], 0
+        if not data.startswith(logkey):
+            # left over from an older dirstate file
+            return [], 0
+        batches = []
+        pos = len(logkey)
+        while pos + _logbatchheader.size <= len(data):
+            size, digest = _logbatchheader.unpack_from(data, pos)
+            start = pos + _logbatchheader.size
+            batch = data[start:start + size]
+            if len(batch) != size or hashlib.sha1(batch).digest() != digest:
+                # interrupted append
+                break
+            batches.append(batch)
+            pos = start + size
+        return batches, pos
+
+    def _applylog(self, p):
+        '''Apply the changes of the dirstate log to the entries read from
+        the dirstate file with parents p, and return the resulting parents'''
+        if self._logkey is None:
+            return p
+        batches, self._logend = self._readlog(self._logkey)
+        for batch in batches:
+            entries = {}
+            copies = {}
+            p = parsers.parse_dirstate(entries, copies, batch)
+            for f, e in entries.iteritems():
+                if e[0] == '?':
+                    if f in self:
+                        del self[f]
+                else:
+                    self[f] = e
+                self.copymap.pop(f, None)
+            self.copymap.update(copies)
+        return p
+
+    def writelog(self, files, now):
+        '''Append the entries of files and the parents to the dirstate log
+
+        Return False without writing anything if the dirstate file has to be
+        rewritten instead, because the dirstate was not read from it or
+        because the log would get too large compared to it.
+        '''
+        if self._logkey is None:
+            return False
+        entries = {}
+        copies = {}
+        for f in files:
+            e = self.get(f)
+            if e is None:
+                e = dirstatetuple('?', 0, 0, 0)
+            elif f in self.copymap:
+                copies[f] = self.copymap[f]
+            entries[f] = e
+        batch = parsers.pack_dirstate(entries, copies, self.parents(), now)
+        end = max(self._logend, _logheader.size)
+        size = end + _logbatchheader.size + len(batch)
+        if size * _logmaxratio > _logheader.unpack(self._logkey)[0]:
+            return False
+        # packing dropped the ambiguous timestamps
+        for f, e in entries.iteritems():
+            if e[0] == 'n' and e[3] == -1:
+                self[f] = e
+
+        data = (_logbatchheader.pack(len(batch), hashlib.sha1(batch).digest())
+                + batch)
+        if not self._logend:
+            fp = self._opener(self._logfilename, 'w', atomictemp=True)
+            fp.write(self._logkey + data)
+            fp.close()
+        else:
+            # overwrite the remains of an interrupted append
+            fp = self._opener(self._logfilename, 'r+b')
+            try:
+                fp.seek(end)
+                fp.write(data)
+                fp.truncate()
+            finally:
+                fp.close()
+        self._logend = size
+        return True
+
+    def read(self):
+        st = self._readdirstatefile()
+        if not st:
+            return
+
+        if util.safehasattr(parsers, 'dict_new_presized'):
+            # Make an estimate of the number of files in the dirstate based on
+            # its size. From a linear regression on a set of real-world repos,
+            # all over 10,000 files, the size of a dirstate entry is 85
+            # bytes. The cost of resizing is significantly higher than the cost
+            # of filling in a larger presized dict, so subtract 20% from the
+            # size.
+            #
+            # This heuristic is imperfect in many ways, so in a future dirstate
+            # format update it makes sense to just record the number of entries
+            # on write.
+            self._map = parsers.dict_new_presized(len(st) / 71)
+
+        # Python's garbage collector triggers a GC each time a certain number
+        # of container objects (the number being defined by
+        # gc.get_threshold()) are allocated. parse_dirstate creates a tuple
+        # for each file in the dirstate. The C version then immediately marks
+        # them as not to be tracked by the collector. However, this has no
+        # effect on when GCs are triggered, only on what objects the GC looks
+        # into. This means that O(number of files) GCs are unavoidable.
+        # Depending on when in the process's lifetime the dirstate is parsed,
+        # this can get very expensive. As a workaround, disable GC while
+        # parsing the dirstate.
+        #
+        # (we cannot decorate the function directly since it is in a C module)
+        parse_dirstate = util.nogc(parsers.parse_dirstate)
+        p = parse_dirstate(self._map, self.copymap, st)
+        p = self._applylog(p)
+        if not self._dirtyparents:
+            self.setparents(*p)
+
+    def write(self, st, now):
+        st.write(parsers.pack_dirstate(self._map, self.copymap,
+                                       self.parents(), now))
+        st.close()
+        self._dirtyparents = False
+        # the log does not apply to the new dirstate file
+        self._logkey = None
+
     def parents(self):
         if not self._parents:
+            logkey = None
             try:
                 fp = self._opendirstatefile()
+                if self._uselog and not self._pendingmode:
+                    logkey = self._filelogkey(fp)
                 st = fp.read(40)
                 fp.close()
             except IOError as err:
@@ -1383,6 +1921,11 @@ class dirstatemap(object):
                 st = ''
 
             l = len(st)
+            if logkey is not None and l == 40:
+                # the last batch of the log holds the current parents
+                batches = self._readlog(logkey)[0]
+                if batches:
+                    st = batches[-1][:40]
             if l == 40:
                 self._parents = st[:20], st[20:40]
             elif l == 0:
@@ -1396,3 +1939,418 @@ class dirstatemap(object):
     def setparents(self, p1, p2):
         self._parents = (p1, p2)
         self._dirtyparents = True
+
+# Tree dirstate format. After the parents, the header holds the hash of the
+# ignore files the directory mtimes were recorded with, the size of the copy
+# records which follow it, the sizes of the lists of non-normal and other
+# parent files which end the file, and the offset of the record of the root
+# directory.
+_treeheader = struct.Struct('>20sIIII')
+# A directory record starts with the mtime of the directory when it was last
+# walked (-1 if unknown), the size of the record, the size of the records of
+# its descendants, which precede it, and its numbers of files and of
+# subdirectories.
+_treedirheader = struct.Struct('>iIIII')
+# A file entry is followed by the file name.
+_treefileentry = struct.Struct('>cllll')
+# A subdirectory reference holds the distance between the start of the
+# subdirectory record and the start of the record of its parent, and is
+# followed by the subdirectory name.
+_treedirref = struct.Struct('>II')
+
+class _treenode(object):
+    """directory of a tree dirstate
+
+    ``start`` is the offset of the record of the directory in the dirstate
+    data, or None if the directory changed since it was read. Nodes are
+    loaded from their record when first visited.
+    """
+    __slots__ = ('files', 'dirs', 'mtime', 'start', 'loaded')
+
+    def __init__(self, start=None):
+        self.files = set()
+        self.dirs = {}
+        self.mtime = -1
+        self.start = start
+        self.loaded = start is None
+
+class _treefoldmap(object):
+    """case-folding map of a tree dirstate, resolved lazily
+
+    Rather than folding every path of the dirstate up front, looking up a
+    path only folds the names in the directories along it, loading their
+    records as needed. With dirs, the map folds the directories instead of
+    the files. Paths set explicitly take precedence.
+    """
+    def __init__(self, dmap, dirs=False):
+        self._dmap = dmap
+        self._dirs = dirs
+        self._stored = {}
+        # paths dropped since the records were read
+        self._dropped = set()
+        # normalized directory -> (folded files, folded subdirectories)
+        self._folds = {}
+
+    def _fold(self, node, normdir, prefix):
+        fold = self._folds.get(normdir)
+        if fold is None:
+            normcase = util.normcase
+            entries = self._dmap._entries
+            files = dict((normcase(name), name) for name in node.files
+                         if entries[prefix + name][0] != 'r')
+            dirs = dict((normcase(name), name) for name in node.dirs)
+            fold = self._folds[normdir] = (files, dirs)
+        return fold
+
+    def get(self, normed, default=None):
+        folded = self._stored.get(normed)
+        if folded is not None:
+            return folded
+        if normed == '.' and not self._dirs:
+            return '.'
+        if normed in self._dropped:
+            return default
+        dmap = self._dmap
+        node = dmap._getnode('')
+        normdir, sep, normname = normed.rpartition('/')
+        prefix = ''
+        if normdir:
+            parts = normdir.split('/')
+            for i, part in enumerate(parts):
+                fold = self._fold(node, '/'.join(parts[:i]), prefix)
+                name = fold[1].get(part)
+                if name is None:
+                    return default
+                node = node.dirs[name]
+                prefix += name + '/'
+                if not node.loaded:
+                    dmap._loadnode(node, prefix)
+        files, dirs = self._fold(node, normdir, prefix)
+        if self._dirs:
+            name = dirs.get(normname)
+        else:
+            name = files.get(normname)
+        if name is None:
+            return default
+        return prefix + name
+
+    def __contains__(self, normed):
+        return self.get(normed) is not None
+
+    def __setitem__(self, normed, folded):
+        self._stored[normed] = folded
+        self._dropped.discard(normed)
+        self._folds.pop(normed.rpartition('/')[0], None)
+
+    def pop(self, normed, default=None):
+        self._dropped.add(normed)
+        self._folds.pop(normed.rpartition('/')[0], None)
+        return self._stored.pop(normed, default)
+
+class treedirstatemap(dirstatemap):
+    """dirstate map stored as a tree of directories
+
+    Each directory record holds the entries of the files of a directory and
+    references to the records of its subdirectories. Records are only parsed
+    when a path below them is looked up, and the records of directories
+    which did not change are copied as is when writing, so commands touching
+    a few files do not pay for the whole dirstate.
+
+    Directories also record their mtime when walked, which lets walk skip
+    listing them while they are unchanged (see dirstate.walk). Case-folding
+    lookups also only load the records along the paths (see _treefoldmap).
+
+    The lists of non-normal and other parent files are kept up to date as
+    entries change and are written at the end of the file, so
+    nonnormalentries() does not need to load the whole tree.
+    """
+    def __init__(self, ui, opener, root, uselog=False):
+        super(treedirstatemap, self).__init__(ui, opener, root, uselog)
+        self._data = ''
+        self._rootnode = _treenode()
+        self._loadeddirs = {''}
+        self._allloaded = True
+        self._nonnormal = set()
+        self._otherparent = set()
+        self.ignorehash = nullid
+
+    @property
+    def _map(self):
+        if not self._allloaded:
+            self._loadall()
+        return self._entries
+
+    @_map.setter
+    def _map(self, value):
+        self._entries = value
+
+    def read(self):
+        data = self._readdirstatefile()
+        if not data:
+            return
+        if len(data) < 40 + _treeheader.size:
+            raise error.Abort(_('working directory state appears damaged!'))
+        (self.ignorehash, copieslen, nonnormallen, otherparentlen,
+         rootstart) = _treeheader.unpack_from(data, 40)
+        pos = 40 + _treeheader.size
+        for copy in data[pos:pos + copieslen].splitlines():
+            dest, source = copy.split('\0')
+            self.copymap[dest] = source
+        pos = len(data) - nonnormallen - otherparentlen
+        self._nonnormal = set(data[pos:pos + nonnormallen].splitlines())
+        pos += nonnormallen
+        self._otherparent = set(data[pos:].splitlines())
+        self._data = data
+        self._rootnode = _treenode(rootstart)
+        self._loadeddirs = set()
+        self._allloaded = False
+        p = self._applylog((data[:20], data[20:40]))
+        if not self._dirtyparents:
+            self.setparents(*p)
+
+    def _loadnode(self, node, prefix):
+        data = self._data
+        entries = self._entries
+        start = node.start
+        mtime, reclen, subtree, nfiles, ndirs = _treedirheader.unpack_from(
+            data, start)
+        pos = start + _treedirheader.size
+        entrysize = _treefileentry.size
+        for i in xrange(nfiles):
+            e = _treefileentry.unpack_from(data, pos)
+            pos += entrysize
+            name = data[pos:pos + e[4]]
+            pos += e[4]
+            node.files.add(name)
+            entries[prefix + name] = dirstatetuple(e[0], e[1], e[2], e[3])
+        refsize = _treedirref.size
+        for i in xrange(ndirs):
+            distance, l = _treedirref.unpack_from(data, pos)
+            pos += refsize
+            node.dirs[data[pos:pos + l]] = _treenode(start - distance)
+            pos += l
+        node.mtime = mtime
+        node.loaded = True
+        self._loadeddirs.add(prefix[:-1])
+
+    def _loadall(self):
+        visit = [(self._rootnode, '')]
+        while visit:
+            node, prefix = visit.pop()
+            if not node.loaded:
+                self._loadnode(node, prefix)
+            for name, child in node.dirs.iteritems():
+                visit.append((child, prefix + name + '/'))
+        self._allloaded = True
+
+    def _getnode(self, path, create=False, change=False):
+        """return the node of a directory, loading the nodes on its path
+
+        With create, missing nodes are created. With change, the nodes on the
+        path are marked as changed.
+        """
+        node = self._rootnode
+        prefix = ''
+        if not node.loaded:
+            self._loadnode(node, prefix)
+        if change:
+            node.start = None
+        if not path:
+            return node
+        for name in path.split('/'):
+            child = node.dirs.get(name)
+            prefix += name + '/'
+            if child is None:
+                if not create:
+                    return None
+                child = node.dirs[name] = _treenode()
+                self._loadeddirs.add(prefix[:-1])
+            elif not child.loaded:
+                self._loadnode(child, prefix)
+            if change:
+                child.start = None
+            node = child
+        return node
+
+    def _loadpath(self, f):
+        if not self._allloaded:
+            d = f.rpartition('/')[0]
+            if d not in self._loadeddirs:
+                self._getnode(d)
+
+    def get(self, key, default=None):
+        self._loadpath(key)
+        return self._entries.get(key, default)
+
+    def __contains__(self, key):
+        self._loadpath(key)
+        return key in self._entries
+
+    def __getitem__(self, key):
+        self._loadpath(key)
+        return self._entries[key]
+
+    def __setitem__(self, key, value):
+        d, sep, name = key.rpartition('/')
+        self._getnode(d, create=True, change=True).files.add(name)
+        self._entries[key] = value
+        if value[0] != 'n' or value[3] == -1:
+            self._nonnormal.add(key)
+        else:
+            self._nonnormal.discard(key)
+        if value[0] == 'n' and value[2] == -2:
+            self._otherparent.add(key)
+        else:
+            self._otherparent.discard(key)
+
+    def __delitem__(self, key):
+        d, sep, name = key.rpartition('/')
+        node = self._getnode(d)
+        if node is None or name not in node.files:
+            raise KeyError(key)
+        node = self._getnode(d, change=True)
+        node.files.discard(name)
+        # the file may still be on disk, as an unknown file
+        node.mtime = -1
+        del self._entries[key]
+        self._nonnormal.discard(key)
+        self._otherparent.discard(key)
+
+    def dirmtime(self, d):
+        """mtime of directory d when walk last listed it, or -1"""
+        node = self._getnode(d)
+        if node is None:
+            return -1
+        return node.mtime
+
+    def setdirmtime(self, d, mtime):
+        self._getnode(d, create=True, change=True).mtime = mtime
+
+    def dirlisting(self, d):
+        """names of the files and subdirectories of directory d in the
+        dirstate"""
+        node = self._getnode(d)
+        if node is None:
+            return [], []
+        return list(node.files), list(node.dirs)
+
+    def hasdir(self, d):
+        return self._getnode(d) is not None
+
+    def nonnormalentries(self):
+        return set(self._nonnormal), set(self._otherparent)
+
+    def filefoldmap(self):
+        return _treefoldmap(self)
+
+    def dirfoldmap(self):
+        return _treefoldmap(self, dirs=True)
+
+    def cleardirmtimes(self, ignorehash):
+        """forget the directory mtimes recorded with other ignore files"""
+        self._loadall()
+        visit = [self._rootnode]
+        while visit:
+            node = visit.pop()
+            if node.mtime != -1:
+                node.mtime = -1
+                node.start = None
+            visit.extend(node.dirs.itervalues())
+        # the parents of the changed nodes are changed too
+        self._markchanged(self._rootnode)
+        self.ignorehash = ignorehash
+
+    def _markchanged(self, node):
+        changed = False
+        for child in node.dirs.itervalues():
+            if self._markchanged(child):
+                changed = True
+        if changed:
+            node.start = None
+        return node.start is None
+
+    def write(self, st, now):
+        copies = ''.join('%s\0%s\n' % (dest, source)
+                         for dest, source in sorted(self.copymap.iteritems()))
+        base = 40 + _treeheader.size + len(copies)
+        chunks = []
+        rootstart, end = self._writenode(self._rootnode, '', now, chunks,
+                                         base)
+        # writing the records may have dropped ambiguous mtimes
+        nonnormal = ''.join(f + '\n' for f in sorted(self._nonnormal))
+        otherparent = ''.join(f + '\n' for f in sorted(self._otherparent))
+        p1, p2 = self.parents()
+        data = ''.join([p1, p2,
+                        _treeheader.pack(self.ignorehash, len(copies),
+                                         len(nonnormal), len(otherparent),
+                                         rootstart),
+                        copies] + chunks + [nonnormal, otherparent])
+        st.write(data)
+        st.close()
+        self._data = data
+        self._dirtyparents = False
+        # the log does not apply to the new dirstate file
+        self._logkey = None
+
+    def _writenode(self, node, prefix, now, chunks, pos):
+        """write the records of the subtree of node at offset pos
+
+        Return the offset of the record of node, or None if the subtree is
+        empty, and the offset after the subtree.
+        """
+        if node.start is not None:
+            # unchanged: copy the records of the subtree as is
+            data = self._data
+            reclen, subtree = _treedirheader.unpack_from(data, node.start)[1:3]
+            chunks.append(data[node.start - subtree:node.start + reclen])
+            self._relocate(node, pos + subtree - node.start)
+            return node.start, pos + subtree + reclen
+
+        begin = pos
+        refs = []
+        for name in sorted(node.dirs):
+            child = node.dirs[name]
+            childstart, pos = self._writenode(child, prefix + name + '/', now,
+                                              chunks, pos)
+            if childstart is None:
+                del node.dirs[name]
+                self._loadeddirs.discard(prefix + name)
+                # walk would not find the directory from the dirstate anymore
+                node.mtime = -1
+            else:
+                refs.append((name, childstart))
+
+        files = sorted(node.files)
+        if prefix and not files and not refs and node.mtime == -1:
+            return None, pos
+
+        entries = self._entries
+        record = []
+        for name in files:
+            f = prefix + name
+            e = entries[f]
+            if e[0] == 'n' and e[3] == now:
+                # see pack_dirstate for why ambiguous timestamps are dropped
+                e = dirstatetuple(e[0], e[1], e[2], -1)
+                entries[f] = e
+                self._nonnormal.add(f)
+            record.append(_treefileentry.pack(e[0], e[1], e[2], e[3],
+                                              len(name)))
+            record.append(name)
+        for name, childstart in refs:
+            record.append(_treedirref.pack(pos - childstart, len(name)))
+            record.append(name)
+        record = ''.join(record)
+        chunks.append(_treedirheader.pack(node.mtime,
+                                          _treedirheader.size + len(record),
+                                          pos - begin, len(files), len(refs)))
+        chunks.append(record)
+        node.start = pos
+        return pos, pos + _treedirheader.size + len(record)
+
+    def _relocate(self, node, offset):
+        visit = [node]
+        while visit:
+            node = visit.pop()
+            node.start += offset
+            visit.extend(node.dirs.itervalues())
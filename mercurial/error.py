@@ -72,6 +72,11 @@ class InterventionRequired(Hint, Exception):
     """Exception raised when a command requires human intervention."""
     __bytes__ = _tobytes
 
+class InMemoryMergeConflictsError(Exception):
+    """Exception raised when a merge kept in memory needs the working
+    directory, e.g. to resolve conflicts."""
+    __bytes__ = _tobytes
+
 class Abort(Hint, Exception):
     """Raised if a command needs to print an error and exit."""
     __bytes__ = _tobytes
@@ -314,19 +314,13 @@ def _underlyingfctxifabsent(filectx):
     else:
         return filectx
 
-def _premerge(repo, fcd, fco, fca, toolconf, files, labels=None):
-    tool, toolpath, binary, symlink = toolconf
-    if symlink or fcd.isabsent() or fco.isabsent():
-        return 1
-    unused, unused, unused, back = files
-
-    ui = repo.ui
-
+def _premergesetting(ui, tool, binary):
+    """return the premerge setting of a merge tool: a boolean, 'keep' or
+    'keep-merge3'"""
     validkeep = ['keep', 'keep-merge3']
 
-    # do we attempt to simplemerge first?
     try:
-        premerge = _toolbool(ui, tool, "premerge", not binary)
+        return _toolbool(ui, tool, "premerge", not binary)
     except error.ConfigError:
         premerge = _toolstr(ui, tool, "premerge").lower()
         if premerge not in validkeep:
@@ -334,18 +328,39 @@ def _premerge(repo, fcd, fco, fca, toolconf, files, labels=None):
             raise error.ConfigError(_("%s.premerge not valid "
                                       "('%s' is neither boolean nor %s)") %
                                     (tool, premerge, _valid))
+        return premerge
+
+def _premergelabels(premerge, labels):
+    """return the labels of the conflict markers of a premerge"""
+    if premerge == 'keep-merge3':
+        if not labels:
+            labels = _defaultconflictlabels
+        if len(labels) < 3:
+            labels = labels + ['base']
+    return labels
+
+def _premerge(repo, fcd, fco, fca, toolconf, files, labels=None,
+              premerged=None):
+    tool, toolpath, binary, symlink = toolconf
+    if symlink or fcd.isabsent() or fco.isabsent():
+        return 1
+    unused, unused, unused, back = files
+
+    ui = repo.ui
+
+    validkeep = ['keep', 'keep-merge3']
+
+    # do we attempt to simplemerge first?
+    premerge = _premergesetting(ui, tool, binary)
 
     if premerge:
-        if premerge == 'keep-merge3':
-            if not labels:
-                labels = _defaultconflictlabels
-            if len(labels) < 3:
-                labels.append('base')
-        r = simplemerge.simplemerge(ui, fcd, fca, fco, quiet=True, label=labels)
+        labels = _premergelabels(premerge, labels)
+        r = simplemerge.simplemerge(ui, fcd, fca, fco, quiet=True, label=labels,
+                                    premerged=premerged)
         if not r:
             ui.debug(" premerge successful\n")
             return 0
-        if premerge not in validkeep:
+        if premerge not in validkeep and back is not None:
             # restore from backup and try again
             _restorebackup(fcd, back)
     return 1 # continue merging
@@ -569,6 +584,51 @@ def _formatlabels(repo, fcd, fco, fca, labels):
         newlabels.append(_formatconflictmarker(repo, ca, tmpl, labels[2], pad))
     return newlabels
 
+def _mergelabels(repo, fcd, fco, fca, labels):
+    """Returns the labels of the conflict markers of a merge."""
+    if not labels:
+        labels = _defaultconflictlabels
+    if repo.ui.config('ui', 'mergemarkers') != 'basic':
+        labels = _formatlabels(repo, fcd, fco, fca, labels)
+    return labels
+
+def _internalpremerge(repo, path):
+    """Returns the premerge setting of the internal merge tool picked for the
+    text file at path, or None if the tool is not an internal one running a
+    premerge."""
+    ui = repo.ui
+    # the messages of the tool lookup are given when merging
+    ui.pushbuffer(error=True)
+    try:
+        tool, toolpath = _picktool(repo, ui, path, False, False, False)
+    finally:
+        ui.popbuffer()
+    if tool in internals and tool.startswith('internal:'):
+        tool = tool[len('internal'):]
+    if tool not in internals or internals[tool].mergetype != fullmerge:
+        return None
+    return _premergesetting(ui, tool, False) or None
+
+def premergeargs(repo, fcd, fco, fca, localtext, labels=None):
+    """Returns the arguments of the simplemerge.mergetext() run by the premerge
+    of a file, or None if the files are not merged as texts by the premerge of
+    an internal merge tool.
+
+    localtext is the content fcd will have when premerging.
+    """
+    premerge = _internalpremerge(repo, fcd.path())
+    if premerge is None:
+        return None
+    localtext = repo.wwritedata(fcd.path(), localtext)
+    basetext = fca.decodeddata()
+    othertext = fco.decodeddata()
+    if any(util.binary(t) for t in (localtext, basetext, othertext)):
+        return None
+    labels = _mergelabels(repo, fcd, fco, fca, labels)
+    labels = _premergelabels(premerge, labels)
+    return simplemerge.mergeargs(localtext, basetext, othertext, fcd.path(),
+                                 fco.path(), label=labels)
+
 def partextras(labels):
     """Return a dictionary of extra labels for use in prompts to the user
 
@@ -590,15 +650,18 @@ def _restorebackup(fcd, back):
     # util.copy here instead.
     fcd.write(util.readfile(back), fcd.flags())
 
-def _makebackup(repo, ui, fcd, premerge):
+def _makebackup(repo, ui, wctx, fcd, premerge):
     """Makes a backup of the local `fcd` file prior to merging.
 
     In addition to preserving the user's pre-existing modifications to `fcd`
     (if any), the backup is used to undo certain premerges, confirm whether a
     merge changed anything, and determine what line endings the new file should
     have.
+
+    Merges kept in memory have no backup: they are given up on as soon as they
+    do not complete cleanly.
     """
-    if fcd.isabsent():
+    if fcd.isabsent() or wctx.isinmemory():
         return None
 
     a = _workingpath(repo, fcd)
@@ -626,10 +689,13 @@ def _maketempfiles(repo, fco, fca):
 
     return b, c
 
-def _filemerge(premerge, repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
+def _filemerge(premerge, repo, wctx, mynode, orig, fcd, fco, fca, labels=None,
+               premerged=None):
     """perform a 3-way merge in the working directory
 
     premerge = whether this is a premerge
+    premerged = text merge of the premerge computed ahead of time, see
+    simplemerge.simplemerge()
     mynode = parent node before merge
     orig = original local filename before merge
     fco = other file context
@@ -674,7 +740,13 @@ def _filemerge(premerge, repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
     toolconf = tool, toolpath, binary, symlink
 
     if mergetype == nomerge:
+        if tool == ':prompt':
+            # abort before asking, the merge is run again in the working
+            # directory where the question is asked anew
+            _checkinmemory(wctx)
         r, deleted = func(repo, mynode, orig, fcd, fco, fca, toolconf, labels)
+        if r:
+            _checkinmemory(wctx)
         return True, r, deleted
 
     if premerge:
@@ -687,22 +759,22 @@ def _filemerge(premerge, repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
 
     if precheck and not precheck(repo, mynode, orig, fcd, fco, fca,
                                  toolconf):
+        _checkinmemory(wctx)
         if onfailure:
             ui.warn(onfailure % fd)
         return True, 1, False
 
-    back = _makebackup(repo, ui, fcd, premerge)
+    back = _makebackup(repo, ui, wctx, fcd, premerge)
     files = (None, None, None, back)
     r = 1
     try:
-        markerstyle = ui.config('ui', 'mergemarkers')
-        if not labels:
-            labels = _defaultconflictlabels
-        if markerstyle != 'basic':
-            labels = _formatlabels(repo, fcd, fco, fca, labels)
+        labels = _mergelabels(repo, fcd, fco, fca, labels)
 
         if premerge and mergetype == fullmerge:
-            r = _premerge(repo, fcd, fco, fca, toolconf, files, labels=labels)
+            r = _premerge(repo, fcd, fco, fca, toolconf, files, labels=labels,
+                          premerged=premerged)
+            if r:
+                _checkinmemory(wctx)
             # complete if premerge successful (r is 0)
             return not r, r, False
 
@@ -713,6 +785,7 @@ def _filemerge(premerge, repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
             r = _check(repo, r, ui, tool, fcd, files)
 
         if r:
+            _checkinmemory(wctx)
             if onfailure:
                 ui.warn(onfailure % fd)
 
@@ -721,6 +794,13 @@ def _filemerge(premerge, repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
         if not r and back is not None:
             util.unlink(back)
 
+def _checkinmemory(wctx):
+    """abort a merge kept in memory that did not complete cleanly, it has to
+    be run again in the working directory"""
+    if wctx.isinmemory():
+        raise error.InMemoryMergeConflictsError(
+            _('in-memory merge does not support merge conflicts'))
+
 def _check(repo, r, ui, tool, fcd, files):
     fd = fcd.path()
     unused, unused, unused, back = files
@@ -755,9 +835,10 @@ def _check(repo, r, ui, tool, fcd, files):
 def _workingpath(repo, ctx):
     return repo.wjoin(ctx.path())
 
-def premerge(repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
+def premerge(repo, wctx, mynode, orig, fcd, fco, fca, labels=None,
+             premerged=None):
     return _filemerge(True, repo, wctx, mynode, orig, fcd, fco, fca,
-                      labels=labels)
+                      labels=labels, premerged=premerged)
 
 def filemerge(repo, wctx, mynode, orig, fcd, fco, fca, labels=None):
     return _filemerge(False, repo, wctx, mynode, orig, fcd, fco, fca,
@@ -302,6 +302,16 @@ class locallegacypeer(repository.legacypeer, localpeer):
 # clients.
 REVLOGV2_REQUIREMENT = 'exp-revlogv2.0'
 
+# Revlogs are compressed with the zstd dictionary stored in the store.
+ZSTDDICTIONARY_REQUIREMENT = 'exp-zstd-dictionary'
+
+# The dirstate is stored as a tree of directories (see dirstate.py).
+TREEDIRSTATE_REQUIREMENT = 'exp-treedirstate'
+
+# Small changes to the dirstate are appended to .hg/dirstate.log instead of
+# rewriting .hg/dirstate.
+DIRSTATELOG_REQUIREMENT = 'exp-dirstatelog'
+
 class localrepository(object):
 
     supportedformats = {
@@ -311,6 +321,9 @@ class localrepository(object):
         'manifestv2',
         REVLOGV2_REQUIREMENT,
     }
+    if util.compengines['zstd'].available():
+        # the dictionary is streamed with the revlogs
+        supportedformats.add(ZSTDDICTIONARY_REQUIREMENT)
     _basesupported = supportedformats | {
         'store',
         'fncache',
@@ -318,6 +331,8 @@ class localrepository(object):
         'relshared',
         'dotencode',
         'exp-sparse',
+        TREEDIRSTATE_REQUIREMENT,
+        DIRSTATELOG_REQUIREMENT,
     }
     openerreqs = {
         'revlogv1',
@@ -608,11 +623,41 @@ class localrepository(object):
                                                  'mmapindexthreshold', None)
         if mmapindexthreshold is not None:
             self.svfs.options['mmapindexthreshold'] = mmapindexthreshold
+        mmapdatathreshold = self.ui.configbytes('experimental',
+                                                'mmapdatathreshold', None)
+        if mmapdatathreshold is not None:
+            self.svfs.options['mmapdatathreshold'] = mmapdatathreshold
+        withsparseread = self.ui.configbool('experimental', 'sparse-read')
+        srdensitythres = float(self.ui.config('experimental',
+                                              'sparse-read.density-threshold'))
+        srmingapsize = self.ui.configbytes('experimental',
+                                           'sparse-read.min-gap-size')
+        self.svfs.options['with-sparse-read'] = withsparseread
+        self.svfs.options['intermediatesnapshots'] = self.ui.configbool(
+            'experimental', 'intermediate-snapshots')
+        self.svfs.options['sparse-read-density-threshold'] = srdensitythres
+        self.svfs.options['sparse-read-min-gap-size'] = srmingapsize
+        if self.ui.configbool('experimental', 'persistent-nodemap'):
+            self.svfs.options['persistentnodemap'] = True
+        revisioncachesize = self.ui.configbytes('experimental',
+                                                'revisioncachesize')
+        if revisioncachesize > 0:
+            self.svfs.options['revisioncachesize'] = revisioncachesize
+        addgroupthreads = self.ui.configint('experimental',
+                                            'addgroup-compression-threads')
+        if addgroupthreads > 0:
+            self.svfs.options['addgroupthreads'] = addgroupthreads
 
         for r in self.requirements:
             if r.startswith('exp-compression-'):
                 self.svfs.options['compengine'] = r[len('exp-compression-'):]
 
+        if ZSTDDICTIONARY_REQUIREMENT in self.requirements:
+            # the dictionary is trained by "hg debugupgraderepo"
+            zstddict = self.svfs.tryread('zstd-dictionary')
+            if zstddict:
+                self.svfs.options['zstd.dictionary'] = zstddict
+
         # TODO move "revlogv2" to openerreqs once finalized.
         if REVLOGV2_REQUIREMENT in self.requirements:
             self.svfs.options['revlogv2'] = True
@@ -719,12 +764,17 @@ class localrepository(object):
     def manifestlog(self):
         return manifest.manifestlog(self.svfs, self)
 
-    @repofilecache('dirstate')
+    @repofilecache('dirstate', 'dirstate.log')
     def dirstate(self):
         sparsematchfn = lambda: sparse.matcher(self)
 
+        treedirstate = TREEDIRSTATE_REQUIREMENT in self.requirements
+        dirstatelog = DIRSTATELOG_REQUIREMENT in self.requirements
         return dirstate.dirstate(self.vfs, self.ui, self.root,
-                                 self._dirstatevalidate, sparsematchfn)
+                                 self._dirstatevalidate, sparsematchfn,
+                                 treedirstate=treedirstate,
+                                 dirstatelog=dirstatelog,
+                                 cachevfs=self.cachevfs)
 
     def _dirstatevalidate(self, node):
         try:
@@ -2285,6 +2335,9 @@ def newreporequirements(repo):
     # zlib is the historical default and doesn't need an explicit requirement.
     if compengine != 'zlib':
         requirements.add('exp-compression-%s' % compengine)
+    if (compengine == 'zstd' and
+        ui.configbool('experimental', 'format.zstd-dictionary')):
+        requirements.add(ZSTDDICTIONARY_REQUIREMENT)
 
     if scmutil.gdinitconfig(ui):
         requirements.add('generaldelta')
@@ -2292,6 +2345,10 @@ def newreporequirements(repo):
         requirements.add('treemanifest')
     if ui.configbool('experimental', 'manifestv2'):
         requirements.add('manifestv2')
+    if ui.configbool('experimental', 'format.treedirstate'):
+        requirements.add(TREEDIRSTATE_REQUIREMENT)
+    if ui.configbool('experimental', 'format.dirstatelog'):
+        requirements.add(DIRSTATELOG_REQUIREMENT)
 
     revlogv2 = ui.config('experimental', 'revlogv2')
     if revlogv2 == 'enable-unstable-format-and-corrupt-my-data':
@@ -366,9 +366,91 @@ class _lazymanifest(object):
         self._compact()
         return self.data
 
+    def _isplain(self):
+        """Whether this manifest is exactly its data, one entry per line
+
+        That is, no entry was added, changed or removed since the data was
+        parsed, and all nodes are 20 bytes long.
+        """
+        return (not self.extradata and
+                self.extrainfo.count(0) == len(self.extrainfo) and
+                self.data.count('\n') == len(self.positions))
+
+    def _entry(self, pos):
+        data = self.data
+        zeropos = data.find('\x00', pos)
+        end = data.find('\n', zeropos)
+        return data[pos:zeropos], (bin(data[zeropos + 1:zeropos + 41]),
+                                   data[zeropos + 41:end])
+
+    def _plaindiff(self, m2):
+        """diff() of two plain manifests, see _isplain()
+
+        Runs of lines that are identical in both are skipped by comparing
+        growing byte ranges of the data, so that the cost depends on the
+        number of changes rather than on the size of the manifests.
+        """
+        diff = {}
+        data1, positions1 = self.data, self.positions
+        data2, positions2 = m2.data, m2.positions
+        len1, len2 = len(positions1), len(positions2)
+        positions1 = positions1 + [len(data1)]
+        positions2 = positions2 + [len(data2)]
+        buffer = util.buffer
+
+        def same(i, j, count):
+            start1, start2 = positions1[i], positions2[j]
+            size = positions1[i + count] - start1
+            if positions2[j + count] - start2 != size:
+                return False
+            return buffer(data1, start1, size) == buffer(data2, start2, size)
+
+        i = j = 0
+        while i < len1 and j < len2:
+            # skip the lines identical in both, doubling the size of the
+            # range compared and then halving it to find where they differ
+            count = 1
+            while i + count <= len1 and j + count <= len2 and same(i, j,
+                                                                   count):
+                i += count
+                j += count
+                count *= 2
+            count //= 2
+            while count:
+                if i + count <= len1 and j + count <= len2 and same(i, j,
+                                                                   count):
+                    i += count
+                    j += count
+                count //= 2
+            if i == len1 or j == len2:
+                break
+            fn1, e1 = self._entry(positions1[i])
+            fn2, e2 = m2._entry(positions2[j])
+            if fn1 == fn2:
+                diff[fn1] = e1, e2
+                i += 1
+                j += 1
+            elif fn1 < fn2:
+                diff[fn1] = e1, (None, '')
+                i += 1
+            else:
+                diff[fn2] = (None, ''), e2
+                j += 1
+        while i < len1:
+            fn1, e1 = self._entry(positions1[i])
+            diff[fn1] = e1, (None, '')
+            i += 1
+        while j < len2:
+            fn2, e2 = m2._entry(positions2[j])
+            diff[fn2] = (None, ''), e2
+            j += 1
+        return diff
+
     def diff(self, m2, clean=False):
         '''Finds changes between the current manifest and m2.'''
-        # XXX think whether efficiency matters here
+        if not clean and self._isplain() and m2._isplain():
+            return self._plaindiff(m2)
+
         diff = {}
 
         for fn, e1, flags in self.iterentries():
@@ -1234,7 +1316,8 @@ class manifestrevlog(revlog.revlog):
         super(manifestrevlog, self).__init__(opener, indexfile,
                                              # only root indexfile is cached
                                              checkambig=not bool(dir),
-                                             mmaplargeindex=True)
+                                             mmaplargeindex=True,
+                                             persistentnodemap=not dir)
 
     @property
     def fulltextcache(self):
@@ -1504,6 +1587,82 @@ class manifestctx(object):
         d = mdiff.patchtext(revlog.revdiff(revlog.deltaparent(r), r))
         return manifestdict(d)
 
+    def diff(self, m2, match=None, clean=False):
+        '''Finds changes between this manifest and the manifest of m2.
+
+        This is the same as read().diff(m2.read(), match, clean), but if the
+        revlog stores one of the two manifests as a delta against the other,
+        only the lines replaced by that delta are compared.
+        '''
+        if isinstance(m2, manifestctx):
+            if not clean:
+                diff = self._deltadiff(m2)
+                if diff is not None:
+                    if match:
+                        diff = dict((f, v) for f, v in diff.iteritems()
+                                    if match(f))
+                    return diff
+            # read the earliest manifest first, the other one is likely to
+            # be stored as a delta against it
+            rl = self._revlog()
+            if rl.rev(m2.node()) < rl.rev(self._node):
+                m2.read()
+        return self.read().diff(m2.read(), match=match, clean=clean)
+
+    def _deltadiff(self, m2):
+        """diff() computed from the stored delta between the two manifests
+
+        Returns None if neither manifest is stored as a delta against the
+        other.
+        """
+        rl = self._revlog()
+        if (rl._usemanifestv2 or m2._revlog() is not rl or
+            revlog.nullid in (self._node, m2.node())):
+            return None
+        r1, r2 = rl.rev(self._node), rl.rev(m2.node())
+        if rl.deltaparent(r2) == r1:
+            base, target = r1, r2
+        elif rl.deltaparent(r1) == r2:
+            base, target = r2, r1
+        else:
+            return None
+        text = rl.revision(base)
+        delta = rl.revdiff(base, target)
+
+        # the entries on the lines replaced by the delta, and on the lines
+        # replacing them
+        old, new = {}, {}
+        pos = 0
+        try:
+            while pos < len(delta):
+                start, end, l = struct.unpack(">lll", delta[pos:pos + 12])
+                pos += 12
+                data = delta[pos:pos + l]
+                pos += l
+                if ((start and text[start - 1] != '\n') or
+                    (end and text[end - 1] != '\n')):
+                    # not a delta between lines, compare the manifests
+                    return None
+                for f, n, fl in _parsev1(text[start:end]):
+                    old[f] = n, fl
+                for f, n, fl in _parsev1(data):
+                    new[f] = n, fl
+        except (ValueError, TypeError, struct.error):
+            return None
+
+        diff = {}
+        missing = (None, '')
+        for f, e in old.iteritems():
+            e2 = new.get(f, missing)
+            if e != e2:
+                diff[f] = e, e2
+        for f, e in new.iteritems():
+            if f not in old:
+                diff[f] = missing, e
+        if base != r1:
+            diff = dict((f, (e2, e1)) for f, (e1, e2) in diff.iteritems())
+        return diff
+
     def find(self, key):
         return self.read().find(key)
 
@@ -1639,5 +1798,18 @@ class treemanifestctx(object):
         else:
             return self.read()
 
+    def diff(self, m2, match=None, clean=False):
+        '''Finds changes between this manifest and the manifest of m2.
+
+        This is the same as read().diff(m2.read(), match, clean).
+        '''
+        if isinstance(m2, treemanifestctx):
+            # read the earliest manifest first, the other one is likely to
+            # be stored as a delta against it
+            rl = self._revlog()
+            if rl.rev(m2.node()) < rl.rev(self._node):
+                m2.read()
+        return self.read().diff(m2.read(), match=match, clean=clean)
+
     def find(self, key):
         return self.read().find(key)
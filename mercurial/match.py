@@ -431,6 +431,127 @@ class includematcher(basematcher):
     def __repr__(self):
         return ('<includematcher includes=%r>' % self._pats)
 
+def _isliteralglob(pat):
+    return not any(c in '*?[]{},\\' for c in pat)
+
+def _literalprefix(regex):
+    """Return the string matched by a regexp of the '^literal' form, where
+    punctuation may be escaped, or None."""
+    if not regex.startswith('^'):
+        return None
+    prefix = []
+    i, n = 1, len(regex)
+    while i < n:
+        c = regex[i]
+        if c == '\\' and i + 1 < n and not regex[i + 1].isalnum():
+            c = regex[i + 1]
+            i += 1
+        elif c in '.^$*+?{}[]|()\\':
+            return None
+        prefix.append(c)
+        i += 1
+    return ''.join(prefix) or None
+
+def ignorebuckets(root, kindpats):
+    """Sort normalized ignore patterns in the buckets of an ignorematcher.
+
+    Return a (names, suffixes, prefixes, regexes, subincludes) tuple of
+    sorted lists, or None if some patterns cannot be bucketed.
+    """
+    names = set()
+    suffixes = set()
+    prefixes = set()
+    subincludes, kindpats = _expandsubinclude(kindpats, root)
+    others = []
+    for kind, pat, source in kindpats:
+        if kind == 'set':
+            return None
+        if kind == 'relglob' and pat and '/' not in pat:
+            if _isliteralglob(pat):
+                names.add(pat)
+                continue
+            if pat[0] == '*' and pat[1:] and _isliteralglob(pat[1:]):
+                suffixes.add(pat[1:])
+                continue
+        elif kind in ('re', 'relre'):
+            prefix = _literalprefix(pat)
+            if prefix is not None:
+                prefixes.add(prefix)
+                continue
+        others.append((kind, pat, source))
+    regexes = []
+    if others:
+        # report invalid patterns with the file they come from
+        _buildregexmatch(others, '(?:/|$)')
+        regexes = [_regex(k, p, '(?:/|$)') for k, p, s in others]
+    subincludes = [(prefix, matcherargs[0], matcherargs[3][0])
+                   for prefix, matcherargs in subincludes]
+    return (sorted(names), sorted(suffixes), sorted(prefixes), regexes,
+            sorted(subincludes))
+
+class ignorematcher(basematcher):
+    '''Matches the files ignored by ignore patterns sorted by ignorebuckets()
+
+    Unrooted globs of a literal name or suffix, like 'build' or '*.pyc', are
+    looked up in sets against each component of the paths, and regexps of a
+    literal prefix, like '^build/', are tested with str.startswith(). Only
+    the other patterns are combined in a regular expression.
+
+    visitdir() returns 'all' for the directories which are ignored, directly
+    or through one of their parents.
+    '''
+
+    def __init__(self, root, cwd, buckets, badfn=None):
+        super(ignorematcher, self).__init__(root, cwd, badfn)
+        self._buckets = buckets
+        names, suffixes, prefixes, regexes, subincludes = buckets
+        self._names = frozenset(names)
+        self._suffixes = tuple(suffixes)
+        self._prefixes = tuple(prefixes)
+        self._regexmatch = None
+        if regexes:
+            self._regexmatch = _buildregexmatch([('re', r, '')
+                                                 for r in regexes], '')[1]
+        self._subincludes = subincludes
+        self._submatchers = {}
+        self._visited = {}
+
+    def matchfn(self, f):
+        names, suffixes = self._names, self._suffixes
+        if names or suffixes:
+            for c in f.split('/'):
+                if c in names or c.endswith(suffixes):
+                    return True
+        if self._prefixes and f.startswith(self._prefixes):
+            return True
+        if self._regexmatch and self._regexmatch(f):
+            return True
+        for prefix, root, include in self._subincludes:
+            if f.startswith(prefix):
+                mf = self._submatchers.get(include)
+                if mf is None:
+                    mf = match(root, '', [], [include])
+                    self._submatchers[include] = mf
+                if mf(f[len(prefix):]):
+                    return True
+        return False
+
+    def visitdir(self, dir):
+        if dir == '.':
+            return True
+        ignored = self._visited.get(dir)
+        if ignored is None:
+            parent = dir.rpartition('/')[0] or '.'
+            ignored = self.visitdir(parent) == 'all' or self.matchfn(dir)
+            self._visited[dir] = ignored
+        if ignored:
+            return 'all'
+        return True
+
+    def __repr__(self):
+        return ('<ignorematcher names=%r suffixes=%r prefixes=%r regexes=%r '
+                'subincludes=%r>' % self._buckets)
+
 class exactmatcher(basematcher):
     '''Matches the input files exactly. They are interpreted as paths, not
     patterns (so no kind-prefixes).
@@ -11,6 +11,8 @@ import errno
 import hashlib
 import shutil
 import struct
+import sys
+import threading
 
 from .i18n import _
 from .node import (
@@ -26,10 +28,12 @@ from . import (
     copies,
     error,
     filemerge,
+    manifest,
     match as matchmod,
     obsutil,
     pycompat,
     scmutil,
+    simplemerge,
     subrepo,
     util,
     worker,
@@ -105,6 +109,7 @@ class mergestate(object):
         self._repo = repo
         self._dirty = False
         self._labels = None
+        self._premerged = {}
 
     def reset(self, node=None, other=None, labels=None):
         self._state = {}
@@ -464,17 +469,7 @@ class mergestate(object):
             return True, 0
         stateentry = self._state[dfile]
         state, hash, lfile, afile, anode, ofile, onode, flags = stateentry
-        octx = self._repo[self._other]
-        extras = self.extras(dfile)
-        anccommitnode = extras.get('ancestorlinknode')
-        if anccommitnode:
-            actx = self._repo[anccommitnode]
-        else:
-            actx = None
-        fcd = self._filectxorabsent(hash, wctx, dfile)
-        fco = self._filectxorabsent(onode, octx, ofile)
-        # TODO: move this to filectxorabsent
-        fca = self._repo.filectx(afile, fileid=anode, changeid=actx)
+        fcd, fco, fca = self._filectxs(dfile, wctx)
         # "premerge" x flags
         flo = fco.flags()
         fla = fca.flags()
@@ -495,10 +490,9 @@ class mergestate(object):
                 f.close()
             else:
                 wctx[dfile].remove(ignoremissing=True)
-            complete, r, deleted = filemerge.premerge(self._repo, wctx,
-                                                      self._local, lfile, fcd,
-                                                      fco, fca,
-                                                      labels=self._labels)
+            complete, r, deleted = filemerge.premerge(
+                self._repo, wctx, self._local, lfile, fcd, fco, fca,
+                labels=self._labels, premerged=self._premerged.pop(dfile, None))
         else:
             complete, r, deleted = filemerge.filemerge(self._repo, wctx,
                                                        self._local, lfile, fcd,
@@ -535,6 +529,48 @@ class mergestate(object):
 
         return complete, r
 
+    def _filectxs(self, dfile, wctx):
+        """return the local, other and ancestor file contexts of the merge of
+        `dfile`"""
+        state, hash, lfile, afile, anode, ofile, onode, flags = \
+            self._state[dfile]
+        octx = self._repo[self._other]
+        extras = self.extras(dfile)
+        anccommitnode = extras.get('ancestorlinknode')
+        if anccommitnode:
+            actx = self._repo[anccommitnode]
+        else:
+            actx = None
+        fcd = self._filectxorabsent(hash, wctx, dfile)
+        fco = self._filectxorabsent(onode, octx, ofile)
+        # TODO: move this to filectxorabsent
+        fca = self._repo.filectx(afile, fileid=anode, changeid=actx)
+        return fcd, fco, fca
+
+    def addpremerged(self, results):
+        """record the results of the text merges of files run ahead of their
+        premerge, as (merge key, merged text, conflicts) tuples by file
+
+        The premerge of each file reuses its result once, if the texts it
+        merges still have that merge key."""
+        self._premerged.update(results)
+
+    def premergeargs(self, dfile, wctx):
+        """return the arguments of the text merge the premerge of `dfile`
+        runs, or None if it does not run one"""
+        if self[dfile] in 'rd':
+            return None
+        state, hash, lfile, afile, anode, ofile, onode, flags = \
+            self._state[dfile]
+        if hash == nullhex or onode == nullhex:
+            return None
+        fcd, fco, fca = self._filectxs(dfile, wctx)
+        if 'l' in flags + fco.flags():
+            return None
+        localtext = self._repo.vfs.read('merge/' + hash)
+        return filemerge.premergeargs(self._repo, fcd, fco, fca, localtext,
+                                      labels=self._labels)
+
     def _filectxorabsent(self, hexnode, ctx, f):
         if hexnode == nullhex:
             return filemerge.absentfilectx(ctx, f)
@@ -613,6 +649,10 @@ def _getcheckunknownconfig(repo, section, name):
     return config
 
 def _checkunknownfile(repo, wctx, mctx, f, f2=None):
+    if wctx.isinmemory():
+        # the untracked files of the working directory do not matter to a
+        # merge kept in memory
+        return False
     if f2 is None:
         f2 = f
     return (repo.wvfs.audit.check(f)
@@ -785,6 +825,23 @@ def driverconclude(repo, ms, wctx, labels=None):
     This is currently not implemented -- it's an extension point."""
     return True
 
+def _changedmanifests(pa, p2):
+    """return manifests of the entries of pa and p2 that differ
+
+    The changes are read from the delta stored between the two manifests
+    when there is one.
+    """
+    ma, m2 = manifest.manifestdict(), manifest.manifestdict()
+    diff = pa.manifestctx().diff(p2.manifestctx())
+    for f, ((na, fla), (n2, fl2)) in diff.iteritems():
+        if na is not None:
+            ma[f] = na
+            ma.setflag(f, fla)
+        if n2 is not None:
+            m2[f] = n2
+            m2.setflag(f, fl2)
+    return ma, m2
+
 def manifestmerge(repo, wctx, p2, pa, branchmerge, force, matcher,
                   acceptremote, followcopies, forcefulldiff=False):
     """
@@ -799,9 +856,18 @@ def manifestmerge(repo, wctx, p2, pa, branchmerge, force, matcher,
 
     copy, movewithdir, diverge, renamedelete, dirmove = {}, {}, {}, {}, {}
 
-    # manifests fetched in order are going to be faster, so prime the caches
-    [x.manifest() for x in
-     sorted(wctx.parents() + [p2, pa], key=scmutil.intrev)]
+    # Don't use m2-vs-ma optimization if:
+    # - ma is the same as m1 or m2, which we're just going to diff again later
+    # - The caller specifically asks for a full diff, which is useful during bid
+    #   merge.
+    relevantonly = (pa not in ([wctx, p2] + wctx.parents()) and
+                    not forcefulldiff)
+
+    if followcopies or not relevantonly:
+        # manifests fetched in order are going to be faster, so prime the
+        # caches
+        [x.manifest() for x in
+         sorted(wctx.parents() + [p2, pa], key=scmutil.intrev)]
 
     if followcopies:
         ret = copies.mergecopies(repo, wctx, p2, pa)
@@ -815,7 +881,17 @@ def manifestmerge(repo, wctx, p2, pa, branchmerge, force, matcher,
                   % (boolbm, boolf, boolm))
     repo.ui.debug(" ancestor: %s, local: %s, remote: %s\n" % (pa, wctx, p2))
 
-    m1, m2, ma = wctx.manifest(), p2.manifest(), pa.manifest()
+    m1 = wctx.manifest()
+    if (relevantonly and not (copy or movewithdir or dirmove) and
+        'treemanifest' not in repo.requirements):
+        # Only the files changed between ma and m2 are looked up in them, so
+        # they are built from these changes alone. Consecutive revisions, like
+        # the ones of a rebased stack, are usually stored as deltas against
+        # each other, and the changes are then read from that delta instead
+        # of comparing the full manifests.
+        ma, m2 = _changedmanifests(pa, p2)
+    else:
+        m2, ma = p2.manifest(), pa.manifest()
     copied = set(copy.values())
     copied.update(movewithdir.values())
 
@@ -824,11 +900,7 @@ def manifestmerge(repo, wctx, p2, pa, branchmerge, force, matcher,
         if any(wctx.sub(s).dirty() for s in wctx.substate):
             m1['.hgsubstate'] = modifiednodeid
 
-    # Don't use m2-vs-ma optimization if:
-    # - ma is the same as m1 or m2, which we're just going to diff again later
-    # - The caller specifically asks for a full diff, which is useful during bid
-    #   merge.
-    if (pa not in ([wctx, p2] + wctx.parents()) and not forcefulldiff):
+    if relevantonly:
         # Identify which files are relevant to the merge, so we can limit the
         # total m1-vs-m2 diff to just those files. This has significant
         # performance benefits in large repositories.
@@ -1080,10 +1152,12 @@ def calculateupdates(repo, wctx, mctx, ancestors, branchmerge, force,
         fractions = _forgetremoved(wctx, mctx, branchmerge)
         actions.update(fractions)
 
-    prunedactions = sparse.filterupdatesactions(repo, wctx, mctx, branchmerge,
-                                                actions)
+    if not wctx.isinmemory():
+        # the sparse rules only restrict the files laid out on disk
+        actions = sparse.filterupdatesactions(repo, wctx, mctx, branchmerge,
+                                              actions)
 
-    return prunedactions, diverge, renamedelete
+    return actions, diverge, renamedelete
 
 def _getcwd():
     try:
@@ -1128,6 +1202,59 @@ def batchremove(repo, wctx, actions):
     # quit after this function.
     wctx.flushall()
 
+# number of file contents read ahead of their writing by batchget
+_prefetchsize = 32
+# below this number of files, reading them in a thread costs more than it saves
+_prefetchmin = 16
+
+def _prefetchdata(mctx, actions):
+    """read the contents of the files of get actions ahead of their use
+
+    The files are read and decompressed in a background thread, while
+    the files read before them are written to the working directory.
+
+    yields (f, args, msg, data) tuples in the order of actions
+    """
+    fctx = mctx.filectx
+    if len(actions) < _prefetchmin:
+        for f, args, msg in actions:
+            yield f, args, msg, fctx(f).data()
+        return
+
+    results = util.queue(_prefetchsize)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for f, args, msg in actions:
+                if stop.is_set():
+                    return
+                results.put(('data', (f, args, msg, fctx(f).data())))
+        except: # re-raises in the writing thread
+            results.put(('error', sys.exc_info()))
+            return
+        results.put(('done', None))
+
+    t = threading.Thread(target=read, name='prefetch')
+    t.setDaemon(True)
+    t.start()
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == 'done':
+                break
+            elif kind == 'error':
+                pycompat.raisewithtb(value[1], value[2])
+            yield value
+    finally:
+        stop.set()
+        # unblock the reading thread if it waits for room in the queue
+        while t.is_alive():
+            try:
+                results.get_nowait()
+            except util.empty:
+                t.join(0.01)
+
 def batchget(repo, mctx, wctx, actions):
     """apply gets to the working directory
 
@@ -1136,11 +1263,10 @@ def batchget(repo, mctx, wctx, actions):
     yields tuples for progress updates
     """
     verbose = repo.ui.verbose
-    fctx = mctx.filectx
     ui = repo.ui
     i = 0
     with repo.wvfs.backgroundclosing(ui, expectedcount=len(actions)):
-        for f, (flags, backup), msg in actions:
+        for f, (flags, backup), msg, data in _prefetchdata(mctx, actions):
             repo.ui.debug(" %s: %s -> g\n" % (f, msg))
             if verbose:
                 repo.ui.note(_("getting %s\n") % f)
@@ -1155,7 +1281,7 @@ def batchget(repo, mctx, wctx, actions):
                     if e.errno != errno.ENOENT:
                         raise
             wctx[f].clearunknown()
-            wctx[f].write(fctx(f).data(), flags, backgroundclose=True)
+            wctx[f].write(data, flags, backgroundclose=True)
             if i == 100:
                 yield i, f
                 i = 0
@@ -1167,6 +1293,46 @@ def batchget(repo, mctx, wctx, actions):
     # quit after this function.
     wctx.flushall()
 
+# estimated cost of merging the texts of a file, for worker.worthwhile()
+_premergecost = 0.01
+
+def batchmergetexts(repo, ms, wctx, files):
+    """merge the texts of files the way their premerge will
+
+    yields tuples for progress updates, with the file, merge key, merged text
+    and conflict flag as item, or None for files premerge will not merge as
+    texts
+    """
+    for f in files:
+        args = ms.premergeargs(f, wctx)
+        if args is None:
+            yield 1, None
+            continue
+        mergedtext, conflicts = simplemerge.mergetext(*args)
+        yield 1, (f, simplemerge.mergekey(*args), mergedtext, conflicts)
+
+def _premergetexts(repo, ms, wctx, files):
+    """merge the texts of files ahead of their premerge, in workers
+
+    The results are recorded in the merge state, for the premerge of the
+    files to reuse.
+    """
+    # merging in the main process ahead of time would not save anything
+    if not worker.worthwhile(repo.ui, _premergecost, len(files)):
+        return
+    results = {}
+    z = 0
+    _merging = _('merging')
+    prog = worker.worker(repo.ui, _premergecost, batchmergetexts,
+                         (repo, ms, wctx), files)
+    for i, item in prog:
+        if item is not None:
+            results[item[0]] = item[1:]
+        z += i
+        repo.ui.progress(_merging, z, total=len(files), unit=_('files'))
+    repo.ui.progress(_merging, None)
+    ms.addpremerged(results)
+
 def applyupdates(repo, actions, wctx, mctx, overwrite, labels=None):
     """apply the merge action list to the working directory
 
@@ -1226,10 +1392,14 @@ def applyupdates(repo, actions, wctx, mctx, overwrite, labels=None):
     if [a for a in actions['r'] if a[0] == '.hgsubstate']:
         subrepo.submerge(repo, wctx, mctx, wctx, overwrite, labels)
 
-    # remove in parallel (must come first)
+    # remove in parallel (must come first), unless the changes are kept in
+    # memory, where workers would not share them
     z = 0
-    prog = worker.worker(repo.ui, 0.001, batchremove, (repo, wctx),
-                         actions['r'])
+    if wctx.isinmemory():
+        prog = batchremove(repo, wctx, actions['r'])
+    else:
+        prog = worker.worker(repo.ui, 0.001, batchremove, (repo, wctx),
+                             actions['r'], iobound=True)
     for i, item in prog:
         z += i
         progress(_updating, z, item=item, total=numupdates, unit=_files)
@@ -1240,8 +1410,11 @@ def applyupdates(repo, actions, wctx, mctx, overwrite, labels=None):
     wctx.flushall()
 
     # get in parallel
-    prog = worker.worker(repo.ui, 0.001, batchget, (repo, mctx, wctx),
-                         actions['g'])
+    if wctx.isinmemory():
+        prog = batchget(repo, mctx, wctx, actions['g'])
+    else:
+        prog = worker.worker(repo.ui, 0.001, batchget, (repo, mctx, wctx),
+                             actions['g'], iobound=True)
     for i, item in prog:
         z += i
         progress(_updating, z, item=item, total=numupdates, unit=_files)
@@ -1310,6 +1483,10 @@ def applyupdates(repo, actions, wctx, mctx, overwrite, labels=None):
     # True
     usemergedriver = not overwrite and mergeactions and ms.mergedriver
 
+    if usemergedriver and wctx.isinmemory():
+        raise error.InMemoryMergeConflictsError(
+            _('in-memory merge does not support merge drivers'))
+
     if usemergedriver:
         ms.commit()
         proceed = driverpreprocess(repo, ms, wctx, labels=labels)
@@ -1325,6 +1502,13 @@ def applyupdates(repo, actions, wctx, mctx, overwrite, labels=None):
                 newactions.append((f, args, msg))
         mergeactions = newactions
 
+    # merge the texts in parallel, the files are still resolved in order
+    # below, reusing these merges
+    if repo.ui.configbool('merge', 'parallel'):
+        _premergetexts(repo, ms, wctx,
+                       [f for f, args, msg in mergeactions
+                        if f != '.hgsubstate'])
+
     # premerge
     tocomplete = []
     for f, args, msg in mergeactions:
@@ -1529,7 +1713,10 @@ def update(repo, node, branchmerge, force, ancestor=None,
     3 = abort: uncommitted changes (checked in commands.py)
 
     The merge is performed inside ``wc``, a workingctx-like objects. It defaults
-    to repo[None] if None is passed.
+    to repo[None] if None is passed. An overlayworkingctx on top of a changeset
+    keeps the merge in memory, leaving the working directory and the dirstate
+    alone: InMemoryMergeConflictsError is raised if the merge needs them, e.g.
+    to resolve conflicts.
 
     Return the same tuple as applyupdates().
     """
@@ -1565,6 +1752,9 @@ def update(repo, node, branchmerge, force, ancestor=None,
         overwrite = force and not branchmerge
 
         p2 = repo[node]
+        if wc.isinmemory() and ('.hgsubstate' in wc or '.hgsubstate' in p2):
+            raise error.InMemoryMergeConflictsError(
+                _('in-memory merge does not support subrepositories'))
         if pas[0] is None:
             if repo.ui.configlist('merge', 'preferancestor', ['*']) == ['*']:
                 cahs = repo.changelog.commonancestorsheads(p1.node(), p2.node())
@@ -1708,7 +1898,9 @@ def update(repo, node, branchmerge, force, ancestor=None,
         ### apply phase
         if not branchmerge: # just jump to the new rev
             fp1, fp2, xp1, xp2 = fp2, nullid, xp2, ''
-        if not partial:
+        # a merge kept in memory leaves the working directory alone
+        updatedirstate = not partial and not wc.isinmemory()
+        if updatedirstate:
             repo.hook('preupdate', throw=True, parent1=xp1, parent2=xp2)
             # note that we're in the middle of an update
             repo.vfs.write('updatestate', p2.hex())
@@ -1716,7 +1908,7 @@ def update(repo, node, branchmerge, force, ancestor=None,
         stats = applyupdates(repo, actions, wc, p2, overwrite, labels=labels)
         wc.flushall()
 
-        if not partial:
+        if updatedirstate:
             with repo.dirstate.parentchange():
                 repo.setparents(fp1, fp2)
                 recordupdates(repo, actions, branchmerge)
@@ -1731,7 +1923,7 @@ def update(repo, node, branchmerge, force, ancestor=None,
     if not branchmerge:
         sparse.prunetemporaryincludes(repo)
 
-    if not partial:
+    if updatedirstate:
         repo.hook('update', parent1=xp1, parent2=xp2, error=stats[3])
     return stats
 
@@ -0,0 +1,238 @@
+# nodemap.py - persistent node -> rev mapping for revlogs
+#
+# Copyright 2017 Matt Mackall <mpm@selenic.com> and others
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""persistent, mmap-able mapping from node to revision number
+
+Building the node -> rev mapping of a revlog requires a pass over its
+whole index. For large revlogs this dominates the run time of short
+commands looking up a single node. A persistent nodemap lets such lookups
+be answered with a binary search over a file that is only paged in where
+needed.
+
+The nodemap of a revlog is stored in two files next to it:
+
+``<name>.n`` (the "docket")
+    A small fixed-size file written atomically at transaction close. It
+    records how many entries of the data file are valid, how many of them
+    are sorted, and the tip revision (and its node) covered by the data.
+    The tip is used to validate the nodemap against the index: a nodemap
+    whose tip does not match the index (e.g. after a strip) is ignored.
+
+``<name>.nd`` (the data file)
+    A sequence of fixed-size (node, rev) entries. The first entries are
+    sorted by node and searched by bisection. Entries for revisions added
+    since the last full write are appended unsorted and loaded into a dict
+    when the nodemap is read. Once that unsorted tail grows beyond
+    ``_compactthreshold`` entries, the whole file is rewritten sorted.
+
+The nodemap is purely an accelerator: a lookup missing from it falls back
+to the regular index search.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import struct
+
+from .node import (
+    nullrev,
+)
+from . import (
+    util,
+)
+
+# docket: version, sorted entries, total entries, tip rev, tip node
+docketformat = struct.Struct(">BQQi20s")
+# data file entry: node, rev
+entryformat = struct.Struct(">20si")
+_entrysize = entryformat.size
+
+NODEMAPVERSION = 1
+
+# number of unsorted entries accumulated before the data file is rewritten
+_compactthreshold = 4096
+
+def docketfile(rl):
+    """return the name of the docket file for revlog ``rl``"""
+    # use the data file name: the changelog index file name changes when
+    # writes are being delayed.
+    return rl.datafile[:-2] + '.n'
+
+def datafile(rl):
+    """return the name of the data file for revlog ``rl``"""
+    return docketfile(rl) + 'd'
+
+class docket(object):
+    """the metadata describing the content of a nodemap data file"""
+
+    def __init__(self, sortedcount=0, entrycount=0, tiprev=nullrev,
+                 tipnode=None):
+        self.sortedcount = sortedcount
+        self.entrycount = entrycount
+        self.tiprev = tiprev
+        self.tipnode = tipnode
+
+    def serialize(self):
+        return docketformat.pack(NODEMAPVERSION, self.sortedcount,
+                                 self.entrycount, self.tiprev,
+                                 self.tipnode or '\0' * 20)
+
+def _readdocket(rl):
+    try:
+        data = rl.opener.read(docketfile(rl))
+    except IOError as inst:
+        if inst.errno != errno.ENOENT:
+            raise
+        return None
+    if len(data) != docketformat.size:
+        return None
+    version, sortedcount, entrycount, tiprev, tipnode = docketformat.unpack(
+        data)
+    if version != NODEMAPVERSION or sortedcount > entrycount:
+        return None
+    return docket(sortedcount, entrycount, tiprev, tipnode)
+
+class persistentnodemap(object):
+    """read-only view on a persistent nodemap
+
+    ``data`` is a str, buffer or mmap holding at least ``docket.entrycount``
+    entries. Entries pointing past ``docket.tiprev`` are ignored, which
+    protects readers racing with a writer rewriting the data file.
+    """
+
+    def __init__(self, data, docket):
+        self._data = data
+        self._sorted = docket.sortedcount
+        # last revision covered by the nodemap
+        self.tiprev = docket.tiprev
+        self._tail = {}
+        unpack = entryformat.unpack_from
+        for i in xrange(docket.sortedcount, docket.entrycount):
+            node, rev = unpack(data, i * _entrysize)
+            if rev <= self.tiprev:
+                self._tail[node] = rev
+
+    def __len__(self):
+        return self._sorted + len(self._tail)
+
+    def _bisect(self, key):
+        """return the index of the first sorted entry not lower than key"""
+        data = self._data
+        lo, hi = 0, self._sorted
+        keylen = len(key)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off = mid * _entrysize
+            if data[off:off + keylen] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, node, default=None):
+        """return the revision of ``node``, or ``default`` if unknown"""
+        rev = self._tail.get(node)
+        if rev is not None:
+            return rev
+        i = self._bisect(node)
+        if i < self._sorted:
+            node2, rev = entryformat.unpack_from(self._data, i * _entrysize)
+            if node2 == node and rev <= self.tiprev:
+                return rev
+        return default
+
+    def prefixmatches(self, prefix):
+        """return the list of known nodes starting with binary ``prefix``"""
+        data = self._data
+        unpack = entryformat.unpack_from
+        matches = []
+        for i in xrange(self._bisect(prefix), self._sorted):
+            node, rev = unpack(data, i * _entrysize)
+            if not node.startswith(prefix):
+                break
+            if rev <= self.tiprev:
+                matches.append(node)
+        matches.extend(n for n in self._tail if n.startswith(prefix))
+        return matches
+
+def readnodemap(rl):
+    """load the persistent nodemap of revlog ``rl``
+
+    Returns a ``(docket, persistentnodemap)`` tuple. The nodemap is None if
+    no valid nodemap exists for the current content of the index.
+    """
+    d = _readdocket(rl)
+    if d is None:
+        return None, None
+    index = rl.index
+    # the nodemap must describe a prefix of the index
+    if (d.tiprev >= len(index) - 1 or d.tiprev < nullrev or
+        (d.tiprev != nullrev and index[d.tiprev][7] != d.tipnode)):
+        return None, None
+    try:
+        fp = rl.opener(datafile(rl))
+    except IOError as inst:
+        if inst.errno != errno.ENOENT:
+            raise
+        return None, None
+    try:
+        size = rl.opener.fstat(fp).st_size
+        if size < d.entrycount * _entrysize:
+            return None, None
+        if size:
+            data = util.buffer(util.mmapread(fp))
+        else:
+            data = ''
+    finally:
+        fp.close()
+    return d, persistentnodemap(data, d)
+
+def _sortedentries(rl, stop):
+    index = rl.index
+    pack = entryformat.pack
+    return ''.join(pack(index[r][7], r) for r in
+                   sorted(xrange(stop), key=lambda r: index[r][7]))
+
+def _write(rl, tr, fp):
+    """file generator writing the nodemap of ``rl`` in transaction ``tr``
+
+    ``fp`` is the docket file. The data file is updated as a side effect,
+    either by appending entries for new revisions or by rewriting it.
+    """
+    d = rl._nodemapdocket
+    index = rl.index
+    tiprev = len(index) - 2
+    name = datafile(rl)
+    if (d is None or d.tiprev > tiprev or
+        (d.tiprev != nullrev and index[d.tiprev][7] != d.tipnode) or
+        d.entrycount - d.sortedcount + tiprev - d.tiprev > _compactthreshold):
+        # full rewrite of the sorted data
+        tr.addbackup(name)
+        with rl.opener(name, 'w', atomictemp=True) as dfp:
+            dfp.write(_sortedentries(rl, tiprev + 1))
+        d = docket(tiprev + 1, tiprev + 1)
+    elif d.tiprev < tiprev:
+        pack = entryformat.pack
+        offset = d.entrycount * _entrysize
+        tr.add(name, offset)
+        with rl.opener(name, 'r+') as dfp:
+            dfp.seek(offset)
+            dfp.truncate()
+            dfp.write(''.join(pack(index[r][7], r)
+                              for r in xrange(d.tiprev + 1, tiprev + 1)))
+        count = d.entrycount + tiprev - d.tiprev
+        d = docket(d.sortedcount, count)
+    d.tiprev = tiprev
+    if tiprev != nullrev:
+        d.tipnode = index[tiprev][7]
+    rl._nodemapdocket = d
+    fp.write(d.serialize())
+
+def setupupdate(tr, rl):
+    """schedule the update of the persistent nodemap of ``rl`` with ``tr``"""
+    tr.addfilegenerator('nodemap-%s' % docketfile(rl), (docketfile(rl),),
+                        lambda fp: _write(rl, tr, fp), location='')
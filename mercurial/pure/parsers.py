@@ -7,10 +7,11 @@
 
 from __future__ import absolute_import
 
+import array
 import struct
 import zlib
 
-from ..node import nullid
+from ..node import nullid, nullrev
 from .. import pycompat
 stringio = pycompat.stringio
 
@@ -31,6 +32,12 @@ indexfirst = struct.calcsize('Q')
 sizeint = struct.calcsize('i')
 indexsize = struct.calcsize(indexformatng)
 
+_indexstruct = struct.Struct(indexformatng)
+_sizestruct = struct.Struct('>i')
+# the parents of an entry follow the offset and four integer fields
+_parentsstruct = struct.Struct('>ii')
+_parentsoffset = indexfirst + 4 * sizeint
+
 def gettype(q):
     return int(q & 0xFFFF)
 
@@ -38,12 +45,19 @@ def offset_type(offset, type):
     return int(int(offset) << 16 | type)
 
 class BaseIndexObject(object):
+    """revlog index backed by packed entries
+
+    Entries read from disk stay in the index data and entries inserted
+    afterwards are packed in the ``_extra`` bytearray, so an index costs
+    about the size of its on-disk entries. Entry tuples are only unpacked
+    when accessed.
+    """
     def __len__(self):
-        return self._lgt + len(self._extra) + 1
+        return self._lgt + len(self._extra) // indexsize + 1
 
     def insert(self, i, tup):
         assert i == -1
-        self._extra.append(tup)
+        self._extra += _indexstruct.pack(*tup)
 
     def _fix_index(self, i):
         if not isinstance(i, int):
@@ -59,9 +73,9 @@ class BaseIndexObject(object):
         if i == len(self) - 1:
             return (0, 0, 0, -1, -1, -1, -1, nullid)
         if i >= self._lgt:
-            return self._extra[i - self._lgt]
-        index = self._calculate_index(i)
-        r = struct.unpack(indexformatng, self._data[index:index + indexsize])
+            return _indexstruct.unpack_from(self._extra,
+                                            (i - self._lgt) * indexsize)
+        r = _indexstruct.unpack_from(self._data, self._calculate_index(i))
         if i == 0:
             e = list(r)
             type = gettype(e[0])
@@ -69,12 +83,40 @@ class BaseIndexObject(object):
             return tuple(e)
         return r
 
+    def _parents(self, i):
+        if i >= self._lgt:
+            return _parentsstruct.unpack_from(
+                self._extra, (i - self._lgt) * indexsize + _parentsoffset)
+        return _parentsstruct.unpack_from(
+            self._data, self._calculate_index(i) + _parentsoffset)
+
+    def headrevs(self, filteredrevs=None):
+        """revisions without children, ignoring revisions in filteredrevs"""
+        count = len(self) - 1
+        if not count:
+            return [nullrev]
+        if filteredrevs is None:
+            filteredrevs = ()
+        # the extra last slot absorbs the nullrev parents
+        ishead = bytearray(b'\x01') * count + bytearray(1)
+        for r in xrange(count):
+            if r in filteredrevs:
+                ishead[r] = 0
+                continue
+            p1, p2 = self._parents(r)
+            ishead[p1] = ishead[p2] = 0
+        ishead[-1] = 0
+        return [r for r, val in enumerate(ishead) if val]
+
+    def headrevsfiltered(self, filteredrevs):
+        return self.headrevs(filteredrevs)
+
 class IndexObject(BaseIndexObject):
     def __init__(self, data):
         assert len(data) % indexsize == 0
         self._data = data
         self._lgt = len(data) // indexsize
-        self._extra = []
+        self._extra = bytearray()
 
     def _calculate_index(self, i):
         return i * indexsize
@@ -86,43 +128,40 @@ class IndexObject(BaseIndexObject):
         if i < self._lgt:
             self._data = self._data[:i * indexsize]
             self._lgt = i
-            self._extra = []
+            self._extra = bytearray()
         else:
-            self._extra = self._extra[:i - self._lgt]
+            del self._extra[(i - self._lgt) * indexsize:]
 
 class InlinedIndexObject(BaseIndexObject):
     def __init__(self, data, inline=0):
         self._data = data
-        self._lgt = self._inline_scan(None)
-        self._inline_scan(self._lgt)
-        self._extra = []
-
-    def _inline_scan(self, lgt):
+        self._offsets = self._inline_scan()
+        self._lgt = len(self._offsets)
+        self._extra = bytearray()
+
+    def _inline_scan(self):
+        # an array of machine integers rather than a list of int objects
+        offsets = array.array('l')
+        data = self._data
         off = 0
-        if lgt is not None:
-            self._offsets = [0] * lgt
-        count = 0
-        while off <= len(self._data) - indexsize:
-            s, = struct.unpack('>i',
-                self._data[off + indexfirst:off + sizeint + indexfirst])
-            if lgt is not None:
-                self._offsets[count] = off
-            count += 1
+        while off <= len(data) - indexsize:
+            offsets.append(off)
+            s, = _sizestruct.unpack_from(data, off + indexfirst)
             off += indexsize + s
-        if off != len(self._data):
+        if off != len(data):
             raise ValueError("corrupted data")
-        return count
+        return offsets
 
     def __delitem__(self, i):
         if not isinstance(i, slice) or not i.stop == -1 or i.step is not None:
             raise ValueError("deleting slices only supports a:-1 with step 1")
         i = self._fix_index(i.start)
         if i < self._lgt:
-            self._offsets = self._offsets[:i]
+            del self._offsets[i:]
             self._lgt = i
-            self._extra = []
+            self._extra = bytearray()
         else:
-            self._extra = self._extra[:i - self._lgt]
+            del self._extra[(i - self._lgt) * indexsize:]
 
     def _calculate_index(self, i):
         return self._offsets[i]
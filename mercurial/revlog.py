@@ -17,8 +17,10 @@ import binascii
 import collections
 import errno
 import hashlib
+import heapq
 import os
 import struct
+import threading
 import zlib
 
 # import stuff from node for others to import from revlog
@@ -36,6 +38,7 @@ from . import (
     ancestor,
     error,
     mdiff,
+    nodemap as nodemapmod,
     policy,
     pycompat,
     templatefilters,
@@ -77,6 +80,10 @@ REVIDX_KNOWN_FLAGS = util.bitsfrom(REVIDX_FLAGS_ORDER)
 # max size of revlog with inline data
 _maxinline = 131072
 _chunksize = 1048576
+# max number of chunks revlog.revisions() reads together
+_revisionsbatchsize = 1024
+# max size of the texts revlog.revisions() keeps to build other revisions
+_revisionstextsize = 32 * 1024 * 1024
 
 RevlogError = error.RevlogError
 LookupError = error.LookupError
@@ -173,6 +180,273 @@ indexformatv0 = struct.Struct(">4l20s20s20s")
 indexformatv0_pack = indexformatv0.pack
 indexformatv0_unpack = indexformatv0.unpack
 
+def _slicechunk(revlog, revs):
+    """slice revs to reduce the amount of unrelated data read from disk.
+
+    ``revs`` is sliced into groups that should be read in one time. The
+    largest gaps between consecutive revisions are skipped until the density
+    of useful data in the read spans reaches ``revlog._srdensitythreshold``.
+    Gaps smaller than ``revlog._srmingapsize`` are never skipped.
+
+    Assume that revs are sorted.
+    """
+    start = revlog.start
+    length = revlog.length
+
+    if len(revs) <= 1:
+        yield revs
+        return
+
+    startbyte = start(revs[0])
+    endbyte = start(revs[-1]) + length(revs[-1])
+    readdata = endbyte - startbyte
+    chainpayload = sum(length(r) for r in revs)
+
+    if readdata:
+        density = chainpayload / float(readdata)
+    else:
+        density = 1.0
+
+    # gaps large enough to be skipped, largest first
+    gapsheap = []
+    prevend = None
+    for i, rev in enumerate(revs):
+        revstart = start(rev)
+        if prevend is not None:
+            gapsize = revstart - prevend
+            if gapsize > revlog._srmingapsize:
+                heapq.heappush(gapsheap, (-gapsize, i))
+        prevend = revstart + length(rev)
+
+    # collect the indices to cut at until the density is acceptable
+    cuts = []
+    while gapsheap and density < revlog._srdensitythreshold:
+        negsize, idx = heapq.heappop(gapsheap)
+        cuts.append(idx)
+        readdata += negsize
+        if readdata > 0:
+            density = chainpayload / float(readdata)
+        else:
+            density = 1.0
+
+    previdx = 0
+    for idx in sorted(cuts):
+        yield revs[previdx:idx]
+        previdx = idx
+    yield revs[previdx:]
+
+def _compress(compressor, data):
+    """compress ``data`` with ``compressor`` for storage in a revlog
+
+    Returns a ``(header, data)`` tuple, see ``revlog.compress()``.
+    """
+    if not data:
+        return '', data
+
+    compressed = compressor.compress(data)
+
+    if compressed:
+        # The revlog compressor added the header in the returned data.
+        return '', compressed
+
+    if data[0:1] == '\0':
+        return '', data
+    return 'u', data
+
+class _compressionjob(object):
+    """the compression of a piece of data by a ``_compressionpool``"""
+
+    def __init__(self, data):
+        self._data = data
+        self._done = threading.Event()
+        self._result = None
+        self._exc = None
+
+    def run(self, compressor):
+        try:
+            self._result = _compress(compressor, self._data)
+        except Exception as inst:
+            # re-raised in the thread waiting for the result
+            self._exc = inst
+        self._data = None
+        self._done.set()
+
+    def result(self):
+        """wait for the compression and return its ``(header, data)``"""
+        self._done.wait()
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+class _compressionpool(object):
+    """compress the deltas of a changegroup in background threads
+
+    The zlib and zstd compressors release the GIL, so compressing incoming
+    deltas ahead of the thread writing them to the revlog lets ``addgroup()``
+    use several cores. Compressors are not thread safe: each thread gets its
+    own.
+
+    A pool is obtained with ``revlog.compressionpool()`` and can serve the
+    ``addgroup()`` calls of every revlog of a changegroup using the same
+    compression.
+    """
+
+    def __init__(self, compengine, compengineopts, threadcount):
+        self.compengine = compengine
+        self.compengineopts = compengineopts
+        self._queue = util.queue()
+        # number of deltas compressed ahead of the one being added
+        self._lookahead = threadcount * 4
+        self._threads = []
+        engine = util.compengines[compengine]
+        for i in range(threadcount):
+            t = threading.Thread(target=self._worker,
+                                 args=(engine.revlogcompressor(
+                                     compengineopts),),
+                                 name='revlogcompressor')
+            t.daemon = True
+            self._threads.append(t)
+            t.start()
+
+    def _worker(self, compressor):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job.run(compressor)
+
+    def compressahead(self, deltas):
+        """iterate over ``(deltadata, job)`` for the entries of ``deltas``
+
+        ``job.result()`` returns the compressed delta of ``deltadata``.
+        """
+        pending = collections.deque()
+        for data in deltas:
+            job = _compressionjob(data[5])
+            self._queue.put(job)
+            pending.append((data, job))
+            if len(pending) >= self._lookahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def close(self):
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+# maximum number of entries of the revision cache, its size is bounded by the
+# total size of the texts it holds.
+_revisioncachecount = 100000
+
+class revisioncache(object):
+    """cache of revision raw texts shared by the revlogs of a process
+
+    Entries are keyed by ``(revlogkey, node)`` and evicted in LRU order
+    once the total size of the cached texts exceeds ``maxcost`` bytes.
+    Texts larger than ``maxcost`` are not cached.
+
+    ``hits`` and ``misses`` count the lookups of requested revisions,
+    ``basehits`` counts the delta chains shortened by a cached text.
+
+    Revlogs may be read from several threads, so accesses are serialized.
+
+    Revlogs opt in with the ``experimental.revisioncachesize`` option.
+    """
+
+    def __init__(self, maxcost):
+        self._cache = util.lrucachedict(_revisioncachecount, maxcost=maxcost)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.basehits = 0
+        self.misses = 0
+
+    @property
+    def maxcost(self):
+        return self._cache.maxcost
+
+    def resize(self, maxcost):
+        """drop the cached texts and bound their total size to ``maxcost``"""
+        with self._lock:
+            self._cache.clear()
+            self._cache.maxcost = maxcost
+
+    @property
+    def totalcost(self):
+        return self._cache.totalcost
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, rlkey, node):
+        """return the cached raw text of ``node``, or None"""
+        with self._lock:
+            try:
+                text = self._cache[(rlkey, node)]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return text
+
+    def findbase(self, rlkey, chain, node):
+        """find the last revision of a delta chain with a cached raw text
+
+        ``node`` maps a revision of ``chain`` to its node. The last revision
+        of the chain, the one being requested, is not looked up.
+
+        Returns a ``(index, text)`` tuple, ``(None, None)`` if no revision
+        of the chain is cached.
+        """
+        with self._lock:
+            cache = self._cache
+            for i in xrange(len(chain) - 2, -1, -1):
+                key = (rlkey, node(chain[i]))
+                if key in cache:
+                    self.basehits += 1
+                    return i, cache[key]
+        return None, None
+
+    def insert(self, rlkey, node, text):
+        with self._lock:
+            if len(text) <= self._cache.maxcost:
+                self._cache.insert((rlkey, node), text, cost=len(text))
+
+    def clear(self, rlkey=None):
+        """drop the cached texts of the ``rlkey`` revlog
+
+        Without ``rlkey``, drop every cached text and reset the counters.
+        """
+        with self._lock:
+            cache = self._cache
+            if rlkey is None:
+                cache.clear()
+                self.hits = self.basehits = self.misses = 0
+                return
+            for key in [k for k in cache if k[0] == rlkey]:
+                del cache[key]
+
+# the revision cache of the process, see getrevisioncache()
+_sharedrevisioncache = None
+_sharedrevisioncachelock = threading.Lock()
+
+def getrevisioncache(maxcost=None):
+    """return the process wide revision cache
+
+    The cache is created the first time it is requested with a ``maxcost``,
+    it is cleared and resized if a different ``maxcost`` is requested later.
+    Returns None if no cache exists.
+    """
+    global _sharedrevisioncache
+    if maxcost:
+        with _sharedrevisioncachelock:
+            if _sharedrevisioncache is None:
+                _sharedrevisioncache = revisioncache(maxcost)
+            elif _sharedrevisioncache.maxcost != maxcost:
+                _sharedrevisioncache.resize(maxcost)
+    return _sharedrevisioncache
+
 class revlogoldio(object):
     def __init__(self):
         self.size = indexformatv0.size
@@ -272,9 +546,19 @@ class revlog(object):
     If mmaplargeindex is True, and an mmapindexthreshold is set, the
     index will be mmapped rather than read if it is larger than the
     configured threshold.
+
+    If an mmapdatathreshold is set, the data file is mmapped rather than
+    read through file handles if it is larger than the configured
+    threshold, and revision data is served from that mapping without
+    copies.
+
+    If persistentnodemap is True, and the persistentnodemap option is set,
+    node to revision lookups are answered from an on-disk nodemap when one
+    is available, and that nodemap is kept up to date when the revlog is
+    written to (see the ``nodemap`` module).
     """
     def __init__(self, opener, indexfile, datafile=None, checkambig=False,
-                 mmaplargeindex=False):
+                 mmaplargeindex=False, persistentnodemap=False):
         """
         create a revlog object
 
@@ -304,9 +588,25 @@ class revlog(object):
         self._nodecache = {nullid: nullrev}
         self._nodepos = None
         self._compengine = 'zlib'
+        # Options of the compression engines, see revlogcompressor().
+        self._compengineopts = {}
         self._maxdeltachainspan = -1
+        self._withsparseread = False
+        self._intermediatesnapshots = False
+        self._srdensitythreshold = 0.25
+        self._srmingapsize = 262144
+        # Number of threads compressing incoming deltas in addgroup().
+        self._addgroupthreads = 0
+        # Process wide cache of raw texts, if enabled.
+        self._revisioncache = None
+        # Minimum size of the data file for it to be mmapped.
+        self._mmapdatathreshold = None
+        # mmap of the data file, False if the file is too small to be mapped.
+        self._datamap = None
 
         mmapindexthreshold = None
+        # Whether the persistent nodemap is used and maintained.
+        self._usenodemap = False
         v = REVLOG_DEFAULT_VERSION
         opts = getattr(opener, 'options', None)
         if opts is not None:
@@ -327,10 +627,30 @@ class revlog(object):
             self._lazydeltabase = bool(opts.get('lazydeltabase', False))
             if 'compengine' in opts:
                 self._compengine = opts['compengine']
+            if 'zstd.dictionary' in opts:
+                self._compengineopts['dictdata'] = opts['zstd.dictionary']
             if 'maxdeltachainspan' in opts:
                 self._maxdeltachainspan = opts['maxdeltachainspan']
             if mmaplargeindex and 'mmapindexthreshold' in opts:
                 mmapindexthreshold = opts['mmapindexthreshold']
+            if 'mmapdatathreshold' in opts:
+                self._mmapdatathreshold = opts['mmapdatathreshold']
+            self._withsparseread = bool(opts.get('with-sparse-read', False))
+            self._intermediatesnapshots = bool(
+                opts.get('intermediatesnapshots', False))
+            if 'sparse-read-density-threshold' in opts:
+                self._srdensitythreshold = opts['sparse-read-density-threshold']
+            if 'sparse-read-min-gap-size' in opts:
+                self._srmingapsize = opts['sparse-read-min-gap-size']
+            if persistentnodemap and 'persistentnodemap' in opts:
+                self._usenodemap = True
+            if 'addgroupthreads' in opts:
+                self._addgroupthreads = opts['addgroupthreads']
+            if opts.get('revisioncachesize'):
+                self._revisioncache = getrevisioncache(
+                    opts['revisioncachesize'])
+                # identify the revlog in the cache by the path of its data
+                self._revisioncachekey = opener.join(self.datafile)
 
         if self._chunkcachesize <= 0:
             raise RevlogError(_('revlog chunk cache size %r is not greater '
@@ -394,6 +714,13 @@ class revlog(object):
             self.nodemap = self._nodecache = nodemap
         if not self._chunkcache:
             self._chunkclear()
+        # The docket of the on-disk nodemap and the read-only nodemap it
+        # describes, if any.
+        self._nodemapdocket = None
+        self._persistentnodemap = None
+        if self._usenodemap:
+            d, nm = nodemapmod.readnodemap(self)
+            self._nodemapdocket, self._persistentnodemap = d, nm
         # revnum -> (chain-length, sum-delta-length)
         self._chaininfocache = {}
         # revlog header -> revlog compressor
@@ -401,7 +728,8 @@ class revlog(object):
 
     @util.propertycache
     def _compressor(self):
-        return util.compengines[self._compengine].revlogcompressor()
+        engine = util.compengines[self._compengine]
+        return engine.revlogcompressor(self._compengineopts)
 
     def tip(self):
         return self.node(len(self.index) - 2)
@@ -424,7 +752,9 @@ class revlog(object):
 
     @util.propertycache
     def nodemap(self):
-        self.rev(self.node(0))
+        # the persistent nodemap must not short-circuit the population of
+        # the in-memory one
+        self._indexrev(self.node(0))
         return self._nodecache
 
     def hasnode(self, node):
@@ -436,8 +766,11 @@ class revlog(object):
 
     def clearcaches(self):
         self._cache = None
+        if self._revisioncache is not None:
+            self._revisioncache.clear(self._revisioncachekey)
         self._chainbasecache.clear()
         self._chunkcache = (0, '')
+        self._datamap = None
         self._pcache = {}
 
         try:
@@ -447,6 +780,15 @@ class revlog(object):
             self._nodepos = None
 
     def rev(self, node):
+        nm = self._persistentnodemap
+        if nm is not None:
+            r = nm.get(node)
+            if r is not None:
+                return r
+        return self._indexrev(node)
+
+    def _indexrev(self, node):
+        """look up the revision of a node without the persistent nodemap"""
         try:
             return self._nodecache[node]
         except TypeError:
@@ -1081,27 +1423,33 @@ class revlog(object):
 
     def _partialmatch(self, id):
         maybewdir = wdirhex.startswith(id)
-        try:
-            partial = self.index.partialmatch(id)
-            if partial and self.hasnode(partial):
+        nm = self._persistentnodemap
+        # building the radix tree of parsers.c requires a full index scan,
+        # the persistent nodemap can answer without it
+        if nm is None:
+            try:
+                partial = self.index.partialmatch(id)
+                if partial and self.hasnode(partial):
+                    if maybewdir:
+                        # single 'ff...' match in radix tree, ambiguous with
+                        # wdir
+                        raise RevlogError
+                    return partial
                 if maybewdir:
-                    # single 'ff...' match in radix tree, ambiguous with wdir
-                    raise RevlogError
-                return partial
-            if maybewdir:
-                # no 'ff...' match in radix tree, wdir identified
-                raise error.WdirUnsupported
-            return None
-        except RevlogError:
-            # parsers.c radix tree lookup gave multiple matches
-            # fast path: for unfiltered changelog, radix tree is accurate
-            if not getattr(self, 'filteredrevs', None):
-                raise LookupError(id, self.indexfile,
-                                  _('ambiguous identifier'))
-            # fall through to slow path that filters hidden revisions
-        except (AttributeError, ValueError):
-            # we are pure python, or key was too short to search radix tree
-            pass
+                    # no 'ff...' match in radix tree, wdir identified
+                    raise error.WdirUnsupported
+                return None
+            except RevlogError:
+                # parsers.c radix tree lookup gave multiple matches
+                # fast path: for unfiltered changelog, radix tree is accurate
+                if not getattr(self, 'filteredrevs', None):
+                    raise LookupError(id, self.indexfile,
+                                      _('ambiguous identifier'))
+                # fall through to slow path that filters hidden revisions
+            except (AttributeError, ValueError):
+                # we are pure python, or key was too short to search radix
+                # tree
+                pass
 
         if id in self._pcache:
             return self._pcache[id]
@@ -1111,7 +1459,15 @@ class revlog(object):
                 # hex(node)[:...]
                 l = len(id) // 2  # grab an even number of digits
                 prefix = bin(id[:l * 2])
-                nl = [e[7] for e in self.index if e[7].startswith(prefix)]
+                if nm is not None:
+                    # revisions added after the nodemap was written
+                    index = self.index
+                    nl = nm.prefixmatches(prefix)
+                    nl.extend(index[r][7]
+                              for r in xrange(nm.tiprev + 1, len(index) - 1)
+                              if index[r][7].startswith(prefix))
+                else:
+                    nl = [e[7] for e in self.index if e[7].startswith(prefix)]
                 nl = [n for n in nl if hex(n).startswith(id) and
                       self.hasnode(n)]
                 if len(nl) > 0:
@@ -1198,6 +1554,33 @@ class revlog(object):
         else:
             self._chunkcache = offset, data
 
+    def _mmapdata(self, end):
+        """Return a mmap of the data file covering at least ``end`` bytes.
+
+        Returns None if the data file should not be mmapped.
+        """
+        m = self._datamap
+        if m is False:
+            return None
+        if m is None or len(m) < end:
+            try:
+                fp = self.opener(self.datafile)
+            except IOError as inst:
+                if inst.errno != errno.ENOENT:
+                    raise
+                return None
+            try:
+                size = self.opener.fstat(fp).st_size
+                if size < self._mmapdatathreshold:
+                    self._datamap = False
+                    return None
+                if size < end:
+                    return None
+                m = self._datamap = util.mmapread(fp)
+            finally:
+                fp.close()
+        return m
+
     def _readsegment(self, offset, length, df=None):
         """Load a segment of raw data from the revlog.
 
@@ -1209,6 +1592,14 @@ class revlog(object):
 
         Returns a str or buffer of raw byte data.
         """
+        # A file handle is passed while the revlog is being written to, its
+        # content may not have reached the mapped file yet.
+        if (df is None and self._mmapdatathreshold is not None and
+            not self._inline):
+            m = self._mmapdata(offset + length)
+            if m is not None:
+                return util.buffer(m, offset, length)
+
         if df is not None:
             closehandle = False
         else:
@@ -1314,6 +1705,9 @@ class revlog(object):
         This function is similar to calling ``self._chunk()`` multiple times,
         but is faster.
 
+        With sparse reads enabled, the revisions are read in several groups
+        skipping large spans of unrelated data (see ``_slicechunk()``).
+
         Returns a list with decompressed data for each requested revision.
         """
         if not revs:
@@ -1327,20 +1721,27 @@ class revlog(object):
         l = []
         ladd = l.append
 
-        try:
-            offset, data = self._getsegmentforrevs(revs[0], revs[-1], df=df)
-        except OverflowError:
-            # issue4215 - we can't cache a run of chunks greater than
-            # 2G on Windows
-            return [self._chunk(rev, df=df) for rev in revs]
+        if not self._withsparseread:
+            slicedchunks = (revs,)
+        else:
+            slicedchunks = _slicechunk(self, revs)
 
         decomp = self.decompress
-        for rev in revs:
-            chunkstart = start(rev)
-            if inline:
-                chunkstart += (rev + 1) * iosize
-            chunklength = length(rev)
-            ladd(decomp(buffer(data, chunkstart - offset, chunklength)))
+        for revschunk in slicedchunks:
+            try:
+                offset, data = self._getsegmentforrevs(revschunk[0],
+                                                       revschunk[-1], df=df)
+            except OverflowError:
+                # issue4215 - we can't cache a run of chunks greater than
+                # 2G on Windows
+                return [self._chunk(rev, df=df) for rev in revs]
+
+            for rev in revschunk:
+                chunkstart = start(rev)
+                if inline:
+                    chunkstart += (rev + 1) * iosize
+                chunklength = length(rev)
+                ladd(decomp(buffer(data, chunkstart - offset, chunklength)))
 
         return l
 
@@ -1358,6 +1759,30 @@ class revlog(object):
         else:
             return rev - 1
 
+    def issnapshot(self, rev):
+        """tells whether rev is a snapshot
+
+        A snapshot is either a full text or, with generaldelta, a delta
+        against another snapshot that is not a parent of the revision (an
+        "intermediate snapshot").
+        """
+        index = self.index
+        while rev != nullrev:
+            e = index[rev]
+            base = e[3]
+            if base == rev:
+                return True
+            if not self._generaldelta or base == e[5] or base == e[6]:
+                return False
+            rev = base
+        return True
+
+    def snapshotdepth(self, rev):
+        """number of snapshots rev is based on; 0 for a full snapshot"""
+        if not self.issnapshot(rev):
+            raise ProgrammingError('revision %d not a snapshot' % rev)
+        return len(self._deltachain(rev)[0]) - 1
+
     def revdiff(self, rev1, rev2):
         """return or calculate a delta between two revisions
 
@@ -1409,6 +1834,14 @@ class revlog(object):
 
             cachedrev = self._cache[1]
 
+        revcache = self._revisioncache
+        if rawtext is None and revcache is not None:
+            rawtext = revcache.get(self._revisioncachekey, node)
+            if rawtext is not None:
+                if rev is None:
+                    rev = self.rev(node)
+                self._cache = (node, rev, rawtext)
+
         # look up what we need to read
         if rawtext is None:
             if rev is None:
@@ -1418,6 +1851,15 @@ class revlog(object):
             if stopped:
                 rawtext = self._cache[2]
 
+            if revcache is not None:
+                # start from the closest revision of the chain with a
+                # cached text
+                i, basetext = revcache.findbase(self._revisioncachekey,
+                                                 chain, self.node)
+                if basetext is not None:
+                    chain = chain[i + 1:]
+                    rawtext = basetext
+
             # drop cache to save memory
             self._cache = None
 
@@ -1425,9 +1867,16 @@ class revlog(object):
             if rawtext is None:
                 rawtext = bytes(bins[0])
                 bins = bins[1:]
+                if revcache is not None and bins:
+                    # the base of the chain is likely shared with other
+                    # revisions
+                    revcache.insert(self._revisioncachekey,
+                                     self.node(chain[0]), rawtext)
 
             rawtext = mdiff.patches(rawtext, bins)
             self._cache = (node, rev, rawtext)
+            if revcache is not None:
+                revcache.insert(self._revisioncachekey, node, rawtext)
 
         if flags is None:
             if rev is None:
@@ -1440,6 +1889,110 @@ class revlog(object):
 
         return text
 
+    def revisions(self, revs, raw=False, _df=None):
+        """iterate over the uncompressed texts of ``revs``, in order
+
+        This is equivalent to calling ``revision()`` for each revision, but
+        the reads of consecutive revisions are planned together: the chunks
+        of their delta chains are read and decompressed once, and the text of
+        a revision already built is reused as the start of the chains going
+        through it.
+
+        ``raw`` has the same meaning as for ``revision()``. Like it, the
+        texts found in the revision cache are not rebuilt, and the texts
+        built are added to it.
+        """
+        # texts already built, other chains can start from them
+        texts = util.lrucachedict(_revisionsbatchsize,
+                                  maxcost=_revisionstextsize)
+        if self._cache:
+            texts.insert(self._cache[1], self._cache[2],
+                         cost=len(self._cache[2]))
+        revcache = self._revisioncache
+
+        batch = []
+        planned = set()
+        chunkrevs = set()
+        for rev in revs:
+            if rev == nullrev:
+                chain = []
+            else:
+                chain = self._deltachain(rev)[0]
+                if (revcache is not None and rev not in planned and
+                    rev not in texts):
+                    # start from the cached text of the revision or of the
+                    # closest revision of its chain
+                    i = len(chain) - 1
+                    text = revcache.get(self._revisioncachekey,
+                                        self.node(rev))
+                    if text is None:
+                        i, text = revcache.findbase(self._revisioncachekey,
+                                                    chain, self.node)
+                    if text is not None:
+                        texts.insert(chain[i], text, cost=len(text))
+            # only the part of the chain not built by then is read
+            for i in xrange(len(chain) - 1, -1, -1):
+                if chain[i] in planned or chain[i] in texts:
+                    chunkrevs.update(chain[i + 1:])
+                    break
+            else:
+                chunkrevs.update(chain)
+            batch.append((rev, chain))
+            planned.add(rev)
+            if len(chunkrevs) >= _revisionsbatchsize:
+                for text in self._buildrevisions(batch, chunkrevs, texts,
+                                                 raw, _df):
+                    yield text
+                batch = []
+                planned = set()
+                chunkrevs = set()
+        for text in self._buildrevisions(batch, chunkrevs, texts, raw, _df):
+            yield text
+
+    def _buildrevisions(self, batch, chunkrevs, texts, raw, df):
+        """build the texts of a batch of revisions, see revisions()
+
+        ``batch`` is a list of ``(rev, chain)``, ``chunkrevs`` are the
+        revisions whose chunks are needed and ``texts`` the texts already
+        built.
+        """
+        revcache = self._revisioncache
+        needed = sorted(chunkrevs)
+        chunks = {}
+        chunks.update(zip(needed, self._chunks(needed, df=df)))
+        for rev, chain in batch:
+            if rev == nullrev:
+                yield ""
+                continue
+
+            basetext = None
+            for i in xrange(len(chain) - 1, -1, -1):
+                basetext = texts.get(chain[i])
+                if basetext is not None:
+                    chain = chain[i + 1:]
+                    break
+            missing = [r for r in chain if r not in chunks]
+            if missing:
+                # the text the chain was planned to start from was evicted
+                chunks.update(zip(missing, self._chunks(missing, df=df)))
+
+            bins = [chunks[r] for r in chain]
+            if basetext is None:
+                basetext = bytes(bins[0])
+                bins = bins[1:]
+            rawtext = mdiff.patches(basetext, bins)
+            texts.insert(rev, rawtext, cost=len(rawtext))
+
+            node = self.node(rev)
+            if chain and revcache is not None:
+                revcache.insert(self._revisioncachekey, node, rawtext)
+            self._cache = (node, rev, rawtext)
+            text, validatehash = self._processflags(rawtext, self.flags(rev),
+                                                    'read', raw=raw)
+            if validatehash:
+                self.checkhash(text, node, rev=rev)
+            yield text
+
     def hash(self, text, p1, p2):
         """Compute a node hash.
 
@@ -1639,18 +2192,7 @@ class revlog(object):
 
     def compress(self, data):
         """Generate a possibly-compressed representation of data."""
-        if not data:
-            return '', data
-
-        compressed = self._compressor.compress(data)
-
-        if compressed:
-            # The revlog compressor added the header in the returned data.
-            return '', compressed
-
-        if data[0:1] == '\0':
-            return '', data
-        return 'u', data
+        return _compress(self._compressor, data)
 
     def decompress(self, data):
         """Decompress a revlog chunk.
@@ -1700,7 +2242,7 @@ class revlog(object):
         except KeyError:
             try:
                 engine = util.compengines.forrevlogheader(t)
-                compressor = engine.revlogcompressor()
+                compressor = engine.revlogcompressor(self._compengineopts)
                 self._decompressors[t] = compressor
             except KeyError:
                 raise RevlogError(_('unknown compression type %r') % t)
@@ -1732,14 +2274,62 @@ class revlog(object):
 
         return True
 
+    def _snapshotdelta(self, p1r, p2r, textlen, tested, builddelta):
+        """find a delta against a snapshot of the parents' delta chains
+
+        The snapshots the parents are based on are tried, the deepest
+        first, and the first acceptable delta is used. A delta against a
+        snapshot of depth ``d`` is an intermediate snapshot of depth
+        ``d + 1``; it is only good if its size is at most ``textlen >> (d + 1)``
+        and smaller than its base (when that base is an intermediate snapshot
+        itself), so that a chain of snapshots stays smaller than a fulltext.
+
+        Returns the delta as built by ``builddelta``, or None.
+        """
+        index = self.index
+        candidates = []
+        for p in (p1r, p2r):
+            if p == nullrev:
+                continue
+            chain = self._deltachain(p)[0]
+            # the snapshots of a chain are at its start
+            depth = 0
+            for r in chain:
+                e = index[r]
+                if depth and (e[3] == e[5] or e[3] == e[6]):
+                    break
+                candidates.append((-depth, r))
+                depth += 1
+        for negdepth, r in sorted(set(candidates)):
+            if r in tested:
+                continue
+            tested.add(r)
+            depth = 1 - negdepth
+            if textlen >> depth == 0:
+                continue
+            d = builddelta(r)
+            if not self._isgooddelta(d, textlen):
+                continue
+            deltalen = d[1]
+            if deltalen > textlen >> depth:
+                continue
+            if depth > 1 and deltalen >= self.length(r):
+                continue
+            return d
+        return None
+
     def _addrevision(self, node, rawtext, transaction, link, p1, p2, flags,
-                     cachedelta, ifh, dfh, alwayscache=False):
+                     cachedelta, ifh, dfh, alwayscache=False,
+                     compresseddelta=None):
         """internal function to add revisions to the log
 
         see addrevision for argument descriptions.
 
         note: "addrevision" takes non-raw text, "_addrevision" takes raw text.
 
+        ``compresseddelta`` is an optional ``_compressionjob`` compressing
+        the delta of ``cachedelta``.
+
         invariants:
         - rawtext is optional (can be None); if not set, cachedelta must be set.
           if both are set, they must correspond to each other.
@@ -1787,8 +2377,11 @@ class revlog(object):
 
         def builddelta(rev):
             # can we use the cached delta?
+            compressed = None
             if cachedelta and cachedelta[0] == rev:
                 delta = cachedelta[1]
+                if compresseddelta is not None:
+                    compressed = compresseddelta.result()
             else:
                 t = buildtext()
                 if self.iscensored(rev):
@@ -1803,7 +2396,9 @@ class revlog(object):
                         fh = dfh
                     ptext = self.revision(rev, _df=fh, raw=True)
                     delta = mdiff.textdiff(ptext, t)
-            header, data = self.compress(delta)
+            if compressed is None:
+                compressed = self.compress(delta)
+            header, data = compressed
             deltalen = len(header) + len(data)
             chainbase = self.chainbase(rev)
             dist = deltalen + offset - self.start(chainbase)
@@ -1861,7 +2456,13 @@ class revlog(object):
                         pdeltas.append(pd)
                 if pdeltas:
                     delta = min(pdeltas, key=lambda x: x[1])
-            if delta is None and prev not in tested:
+            if self._intermediatesnapshots and self._generaldelta:
+                # deltas against prev would be mistaken for snapshots, try
+                # to store an intermediate snapshot instead of a fulltext.
+                if delta is None:
+                    delta = self._snapshotdelta(p1r, p2r, textlen, tested,
+                                                builddelta)
+            elif delta is None and prev not in tested:
                 # other approach failed try against prev to hopefully save us a
                 # fulltext.
                 candidatedelta = builddelta(prev)
@@ -1921,8 +2522,22 @@ class revlog(object):
             ifh.write(data[0])
             ifh.write(data[1])
             self.checkinlinesize(transaction, ifh)
+        if self._usenodemap:
+            nodemapmod.setupupdate(transaction, self)
+
+    def compressionpool(self):
+        """return a pool compressing deltas ahead for addgroup(), or None
+
+        None is returned unless ``experimental.addgroup-compression-threads``
+        is set. The caller must close the pool.
+        """
+        if self._addgroupthreads > 0:
+            return _compressionpool(self._compengine, self._compengineopts,
+                                    self._addgroupthreads)
+        return None
 
-    def addgroup(self, deltas, linkmapper, transaction, addrevisioncb=None):
+    def addgroup(self, deltas, linkmapper, transaction, addrevisioncb=None,
+                 compressionpool=None):
         """
         add a delta group
 
@@ -1932,6 +2547,10 @@ class revlog(object):
 
         If ``addrevisioncb`` is defined, it will be called with arguments of
         this revlog and the node that was added.
+
+        When enabled, the deltas are compressed ahead by a pool of threads
+        while they are added in order. ``compressionpool`` is a pool from
+        ``compressionpool()`` to use rather than starting one for this group.
         """
 
         nodes = []
@@ -1953,9 +2572,20 @@ class revlog(object):
             if dfh:
                 dfh.flush()
             ifh.flush()
+        pool = compressionpool
+        if pool is not None and (pool.compengine != self._compengine or
+                                 pool.compengineopts != self._compengineopts):
+            pool = None
+        ownpool = None
+        if pool is None:
+            pool = ownpool = self.compressionpool()
+        if pool is not None:
+            deltas = pool.compressahead(deltas)
+        else:
+            deltas = ((data, None) for data in deltas)
         try:
             # loop through our set of deltas
-            for data in deltas:
+            for data, compressed in deltas:
                 node, p1, p2, linknode, deltabase, delta, flags = data
                 link = linkmapper(linknode)
                 flags = flags or REVIDX_DEFAULT_FLAGS
@@ -2000,7 +2630,8 @@ class revlog(object):
                 self._addrevision(node, None, transaction, link,
                                   p1, p2, flags, (baserev, delta),
                                   ifh, dfh,
-                                  alwayscache=bool(addrevisioncb))
+                                  alwayscache=bool(addrevisioncb),
+                                  compresseddelta=compressed)
 
                 if addrevisioncb:
                     addrevisioncb(self, node)
@@ -2013,6 +2644,8 @@ class revlog(object):
                     ifh = self.opener(self.indexfile, "a+",
                                       checkambig=self._checkambig)
         finally:
+            if ownpool is not None:
+                ownpool.close()
             if dfh:
                 dfh.close()
             ifh.close()
@@ -2102,11 +2735,18 @@ class revlog(object):
         self._cache = None
         self._chaininfocache = {}
         self._chunkclear()
+        self._datamap = None
         for x in xrange(rev, len(self)):
             del self.nodemap[self.node(x)]
 
         del self.index[rev:-1]
 
+        # the persistent nodemap may reference stripped revisions
+        self._persistentnodemap = None
+        if self._usenodemap:
+            self._nodemapdocket = None
+            nodemapmod.setupupdate(transaction, self)
+
     def checksize(self):
         expected = 0
         if len(self):
@@ -18,6 +18,8 @@
 
 from __future__ import absolute_import
 
+import hashlib
+
 from .i18n import _
 from . import (
     error,
@@ -413,10 +415,58 @@ def _picklabels(defaults, overrides):
         result[i] = override
     return result
 
+def mergeargs(localtext, basetext, othertext, localpath, otherpath, **opts):
+    """return the arguments of mergetext() for the merge simplemerge() runs on
+    these texts and paths"""
+    mode = opts.get('mode','merge')
+    name_a, name_b, name_base = None, None, None
+    if mode != 'union':
+        name_a, name_b, name_base = _picklabels([localpath, otherpath, None],
+                                                opts.get('label', []))
+
+    extrakwargs = {
+            "localorother": opts.get("localorother", None),
+            'minimize': True,
+        }
+    if mode == 'union':
+        extrakwargs['start_marker'] = None
+        extrakwargs['mid_marker'] = None
+        extrakwargs['end_marker'] = None
+    elif name_base is not None:
+        extrakwargs['base_marker'] = '|||||||'
+        extrakwargs['name_base'] = name_base
+        extrakwargs['minimize'] = False
+    return basetext, localtext, othertext, name_a, name_b, extrakwargs
+
+def mergekey(basetext, localtext, othertext, name_a, name_b, extrakwargs):
+    """return a key identifying the result of mergetext() for these
+    arguments"""
+    s = hashlib.sha1()
+    for text in (basetext, localtext, othertext):
+        s.update('%d\0' % len(text))
+        s.update(text)
+    s.update(pycompat.sysbytes(repr((name_a, name_b,
+                                     sorted(extrakwargs.items())))))
+    return s.hexdigest()
+
+def mergetext(basetext, localtext, othertext, name_a, name_b, extrakwargs):
+    """merge three texts
+
+    Returns the merged text and whether the merge had conflicts.
+    """
+    m3 = Merge3Text(basetext, localtext, othertext)
+    mergedtext = ''.join(m3.merge_lines(name_a=name_a, name_b=name_b,
+                                        **pycompat.strkwargs(extrakwargs)))
+    return mergedtext, bool(m3.conflicts)
+
 def simplemerge(ui, localctx, basectx, otherctx, **opts):
     """Performs the simplemerge algorithm.
 
     The merged result is written into `localctx`.
+
+    The ``premerged`` option can hold a (merge key, merged text, conflicts)
+    tuple computed ahead of time, reused if mergekey() gives that key for the
+    texts merged.
     """
     def readctx(ctx):
         # Merges were always run in the working copy before, which means
@@ -429,12 +479,6 @@ def simplemerge(ui, localctx, basectx, otherctx, **opts):
         return _verifytext(ctx.decodeddata(), ctx.path(), ui, opts)
 
     mode = opts.get('mode','merge')
-    name_a, name_b, name_base = None, None, None
-    if mode != 'union':
-        name_a, name_b, name_base = _picklabels([localctx.path(),
-                                                 otherctx.path(), None],
-                                                opts.get('label', []))
-
     try:
         localtext = readctx(localctx)
         basetext = readctx(basectx)
@@ -442,30 +486,18 @@ def simplemerge(ui, localctx, basectx, otherctx, **opts):
     except error.Abort:
         return 1
 
-    m3 = Merge3Text(basetext, localtext, othertext)
-    extrakwargs = {
-            "localorother": opts.get("localorother", None),
-            'minimize': True,
-        }
-    if mode == 'union':
-        extrakwargs['start_marker'] = None
-        extrakwargs['mid_marker'] = None
-        extrakwargs['end_marker'] = None
-    elif name_base is not None:
-        extrakwargs['base_marker'] = '|||||||'
-        extrakwargs['name_base'] = name_base
-        extrakwargs['minimize'] = False
-
-    mergedtext = ""
-    for line in m3.merge_lines(name_a=name_a, name_b=name_b,
-                               **pycompat.strkwargs(extrakwargs)):
-        if opts.get('print'):
-            ui.fout.write(line)
-        else:
-            mergedtext += line
+    args = mergeargs(localtext, basetext, othertext, localctx.path(),
+                     otherctx.path(), **opts)
+    premerged = opts.get('premerged')
+    if premerged is not None and premerged[0] == mergekey(*args):
+        mergedtext, conflicts = premerged[1:]
+    else:
+        mergedtext, conflicts = mergetext(*args)
 
-    if not opts.get('print'):
+    if opts.get('print'):
+        ui.fout.write(mergedtext)
+    else:
         localctx.write(mergedtext, localctx.flags())
 
-    if m3.conflicts and not mode == 'union':
+    if conflicts and not mode == 'union':
         return 1
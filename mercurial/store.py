@@ -316,7 +316,7 @@ def _calcmode(vfs):
     return mode
 
 _data = ('data meta 00manifest.d 00manifest.i 00changelog.d 00changelog.i'
-         ' phaseroots obsstore')
+         ' phaseroots obsstore zstd-dictionary')
 
 class basicstore(object):
     '''base class for local repository stores'''
@@ -530,7 +530,7 @@ class fncachestore(basicstore):
                     raise
 
     def copylist(self):
-        d = ('data meta dh fncache phaseroots obsstore'
+        d = ('data meta dh fncache phaseroots obsstore zstd-dictionary'
              ' 00manifest.d 00manifest.i 00changelog.d 00changelog.i')
         return (['requires', '00changelog.i'] +
                 ['store/' + f for f in d.split()])
@@ -178,7 +178,12 @@ def allowservergeneration(repo):
 
 # This is it's own function so extensions can override it.
 def _walkstreamfiles(repo):
-    return repo.store.walk()
+    for entry in repo.store.walk():
+        yield entry
+    # revlogs compressed with a zstd dictionary cannot be read without it
+    if repo.svfs.exists('zstd-dictionary'):
+        size = repo.svfs.stat('zstd-dictionary').st_size
+        yield 'zstd-dictionary', 'zstd-dictionary', size
 
 def generatev1(repo):
     """Emit content for version 1 of a streaming clone.
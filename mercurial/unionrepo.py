@@ -69,7 +69,8 @@ class unionrevlog(revlog.revlog):
             p1node = self.revlog2.node(p1rev)
             p2node = self.revlog2.node(p2rev)
 
-            e = (flags, None, None, base,
+            # sizes are unknown: revisions are read from revlog2
+            e = (flags, -1, -1, base,
                  link, self.rev(p1node), self.rev(p2node), node)
             self.index.insert(-1, e)
             self.nodemap[node] = n
@@ -114,6 +115,10 @@ class unionrevlog(revlog.revlog):
             # already cached
         return text
 
+    def revisions(self, revs, raw=False):
+        for rev in revs:
+            yield self.revision(rev, raw=raw)
+
     def baserevision(self, nodeorrev):
         # Revlog subclasses may override 'revision' method to modify format of
         # content retrieved from revlog. To use unionrevlog with such class one
@@ -70,13 +70,15 @@ def supporteddestrequirements(repo):
 
     Extensions should monkeypatch this to add their custom requirements.
     """
-    return {
+    supported = {
         'dotencode',
         'fncache',
         'generaldelta',
         'revlogv1',
         'store',
+        localrepo.ZSTDDICTIONARY_REQUIREMENT,
     }
+    return supported | _compressionrequirements()
 
 def allowednewrequirements(repo):
     """Obtain requirements that can be added to a repository during upgrade.
@@ -88,11 +90,26 @@ def allowednewrequirements(repo):
     bad additions because the whitelist approach is safer and will prevent
     future, unknown requirements from accidentally being added.
     """
-    return {
+    allowed = {
         'dotencode',
         'fncache',
         'generaldelta',
+        localrepo.ZSTDDICTIONARY_REQUIREMENT,
     }
+    return allowed | _compressionrequirements()
+
+def _compressionrequirements():
+    """requirements of the available revlog compression engines
+
+    Every revision is recompressed during an upgrade, so the engine can
+    change.
+    """
+    reqs = set()
+    for name in util.compengines:
+        engine = util.compengines[name]
+        if engine.available() and engine.revlogheader():
+            reqs.add('exp-compression-%s' % name)
+    return reqs
 
 deficiency = 'deficiency'
 optimisation = 'optimization'
@@ -281,6 +298,22 @@ class removecldeltachain(formatvariant):
     def fromconfig(repo):
         return True
 
+@registerformatvariant
+class zstddictionary(requirementformatvariant):
+    name = localrepo.ZSTDDICTIONARY_REQUIREMENT
+
+    _requirement = localrepo.ZSTDDICTIONARY_REQUIREMENT
+
+    default = False
+
+    description = _('small revisions compress poorly on their own; '
+                    'repository is larger and reads more data than it '
+                    'could')
+
+    upgrademessage = _('revisions will be compressed with a zstd dictionary '
+                       'trained from the repository content; repository '
+                       'size and read I/O should decrease')
+
 def finddeficiencies(repo):
     """returns a list of deficiencies that the repo suffer from"""
     deficiencies = []
@@ -391,6 +424,53 @@ def _revlogfrompath(repo, path):
         # vanilla revlog.
         return revlog.revlog(repo.svfs, path)
 
+# ratio between the size of the data a zstd dictionary is trained from and the
+# size of the dictionary
+_zstdsamplesratio = 100
+# revisions larger than this compress well enough without a dictionary
+_zstdmaxsamplesize = 128 * 1024
+
+def _trainzstddictionary(ui, srcrepo, dstrepo):
+    """train the zstd dictionary of ``dstrepo`` from ``srcrepo`` revlogs
+
+    The samples are the uncompressed chunks of revisions spread evenly over
+    the content of the store.
+    """
+    size = ui.configbytes('experimental', 'format.zstd-dictionary.size')
+    revlogs = []
+    total = 0
+    for unencoded, encoded, st in srcrepo.store.walk():
+        if unencoded.endswith('.d'):
+            continue
+        rl = _revlogfrompath(srcrepo, unencoded)
+        if len(rl):
+            revlogs.append(rl)
+            total += rl.end(len(rl) - 1)
+
+    # pick the revision crossing every stride bytes of stored data
+    stride = max(total / float(size * _zstdsamplesratio), 1.0)
+    samples = []
+    pos = 0
+    for rl in revlogs:
+        for rev in rl:
+            start = pos
+            pos += rl.length(rev)
+            if int(start / stride) == int(pos / stride):
+                continue
+            chunk = bytes(rl._chunk(rev))
+            if chunk and len(chunk) <= _zstdmaxsamplesize:
+                samples.append(chunk)
+
+    data = util.compengines['zstd'].traindictionary(size, samples)
+    if data is None:
+        ui.write(_('not enough data to train a zstd dictionary; revisions '
+                   'will be compressed without one\n'))
+        return
+    ui.write(_('trained a zstd dictionary of %s from %d revisions\n') %
+             (util.bytecount(len(data)), len(samples)))
+    dstrepo.svfs.write('zstd-dictionary', data)
+    dstrepo.svfs.options['zstd.dictionary'] = data
+
 def _copyrevlogs(ui, srcrepo, dstrepo, tr, deltareuse, aggressivemergedeltas):
     """Copy revlogs between 2 repos."""
     revcount = 0
@@ -560,6 +640,9 @@ def _filterstorefile(srcrepo, dstrepo, requirements, path, mode, st):
     # Skip other skipped files.
     if path in ('lock', 'fncache'):
         return False
+    # The zstd dictionary is trained again, or dropped.
+    if path == 'zstd-dictionary':
+        return False
 
     return True
 
@@ -595,6 +678,9 @@ def _upgraderepo(ui, srcrepo, dstrepo, requirements, actions):
     else:
         deltareuse = revlog.revlog.DELTAREUSEALWAYS
 
+    if localrepo.ZSTDDICTIONARY_REQUIREMENT in requirements:
+        _trainzstddictionary(ui, srcrepo, dstrepo)
+
     with dstrepo.transaction('upgrade') as tr:
         _copyrevlogs(ui, srcrepo, dstrepo, tr, deltareuse,
                      'redeltamultibase' in actions)
@@ -807,6 +893,16 @@ def upgraderepo(ui, repo, run=False, optimize=None):
             dstrepo = localrepo.localrepository(repo.baseui,
                                                 path=tmppath,
                                                 create=True)
+            # Delta chain limits may come from the hgrc of the repository,
+            # which the temporary repository does not read.
+            for key in ('maxchainlen', 'maxdeltachainspan'):
+                if key in repo.svfs.options:
+                    dstrepo.svfs.options[key] = repo.svfs.options[key]
+            # So may the compression engine of the new requirements.
+            for r in newreqs:
+                if r.startswith('exp-compression-'):
+                    dstrepo.svfs.options['compengine'] = (
+                        r[len('exp-compression-'):])
 
             with dstrepo.wlock(), dstrepo.lock():
                 backuppath = _upgraderepo(ui, repo, dstrepo, newreqs,
@@ -666,7 +666,7 @@ class _lrucachenode(object):
     Holds a reference to nodes on either side as well as a key-value
     pair for the dictionary entry.
     """
-    __slots__ = (u'next', u'prev', u'key', u'value')
+    __slots__ = (u'next', u'prev', u'key', u'value', u'cost')
 
     def __init__(self):
         self.next = None
@@ -674,10 +674,13 @@ class _lrucachenode(object):
 
         self.key = _notset
         self.value = None
+        self.cost = 0
 
     def markempty(self):
         """Mark the node as emptied."""
         self.key = _notset
+        self.value = None
+        self.cost = 0
 
 class lrucachedict(object):
     """Dict that caches most recent accesses and sets.
@@ -690,8 +693,12 @@ class lrucachedict(object):
     we recycle head.prev and make it the new head. Cache accesses result in
     the node being moved to before the existing head and being marked as the
     new head node.
+
+    Items can be inserted with a cost using ``insert()``. If ``maxcost`` is
+    set, the oldest items are evicted when the total cost of the items
+    exceeds it. The most recently inserted item is never evicted.
     """
-    def __init__(self, max):
+    def __init__(self, max, maxcost=0):
         self._cache = {}
 
         self._head = head = _lrucachenode()
@@ -699,6 +706,8 @@ class lrucachedict(object):
         head.next = head
         self._size = 1
         self._capacity = max
+        self.totalcost = 0
+        self.maxcost = maxcost
 
     def __len__(self):
         return len(self._cache)
@@ -718,12 +727,18 @@ class lrucachedict(object):
         self._movetohead(node)
         return node.value
 
-    def __setitem__(self, k, v):
+    def insert(self, k, v, cost=0):
+        """Insert a new item in the cache with optional cost value."""
         node = self._cache.get(k)
         # Replace existing value and mark as newest.
         if node is not None:
+            self.totalcost -= node.cost
             node.value = v
+            node.cost = cost
+            self.totalcost += cost
             self._movetohead(node)
+            if self.maxcost:
+                self._enforcecostlimit()
             return
 
         if self._size < self._capacity:
@@ -734,17 +749,27 @@ class lrucachedict(object):
 
         # At capacity. Kill the old entry.
         if node.key is not _notset:
+            self.totalcost -= node.cost
             del self._cache[node.key]
 
         node.key = k
         node.value = v
+        node.cost = cost
+        self.totalcost += cost
         self._cache[k] = node
         # And mark it as newest entry. No need to adjust order since it
         # is already self._head.prev.
         self._head = node
 
+        if self.maxcost:
+            self._enforcecostlimit()
+
+    def __setitem__(self, k, v):
+        self.insert(k, v)
+
     def __delitem__(self, k):
         node = self._cache.pop(k)
+        self.totalcost -= node.cost
         node.markempty()
 
         # Temporarily mark as newest item before re-adjusting head to make
@@ -767,16 +792,44 @@ class lrucachedict(object):
             n = n.next
 
         self._cache.clear()
+        self.totalcost = 0
 
     def copy(self):
-        result = lrucachedict(self._capacity)
+        result = lrucachedict(self._capacity, maxcost=self.maxcost)
+        # Empty nodes are the oldest ones, skip them.
         n = self._head.prev
+        while n.key is _notset and n is not self._head:
+            n = n.prev
         # Iterate in oldest-to-newest order, so the copy has the right ordering
         for i in range(len(self._cache)):
-            result[n.key] = n.value
+            result.insert(n.key, n.value, cost=n.cost)
             n = n.prev
         return result
 
+    def _enforcecostlimit(self):
+        """Evict the oldest items until the total cost is acceptable.
+
+        Eviction goes down to 3/4 of ``maxcost`` so that a cache at its
+        limit does not need to evict on every insertion.
+        """
+        if len(self) <= 1 or self.totalcost <= self.maxcost:
+            return
+
+        targetcost = int(self.maxcost * 0.75)
+
+        # Empty nodes are the oldest ones, find the oldest item.
+        n = self._head.prev
+        while n.key is _notset:
+            n = n.prev
+
+        # Nodes are emptied in place: walking towards the head keeps
+        # empty nodes at the tail of the list.
+        while len(self) > 1 and self.totalcost > targetcost:
+            del self._cache[n.key]
+            self.totalcost -= n.cost
+            n.markempty()
+            n = n.prev
+
     def _movetohead(self, node):
         """Mark a node as the newest, making it the new head.
 
@@ -3425,6 +3478,9 @@ class compressionengine(object):
         data or raise a ``RevlogError``.
 
         The object is reusable but is not thread safe.
+
+        ``opts`` is a dict of engine specific options. Engines ignore the
+        options they do not know about.
         """
         raise NotImplementedError()
 
@@ -3675,13 +3731,19 @@ class _zstdengine(compressionengine):
         return chunkbuffer(dctx.read_from(fh))
 
     class zstdrevlogcompressor(object):
-        def __init__(self, zstd, level=3):
+        def __init__(self, zstd, level=3, dictdata=None):
+            kwargs = {}
+            if dictdata:
+                # Frames compressed with a dictionary record its id. Frames
+                # compressed without one can still be decompressed.
+                kwargs['dict_data'] = zstd.ZstdCompressionDict(dictdata)
             # Writing the content size adds a few bytes to the output. However,
             # it allows decompression to be more optimal since we can
             # pre-allocate a buffer to hold the result.
             self._cctx = zstd.ZstdCompressor(level=level,
-                                             write_content_size=True)
-            self._dctx = zstd.ZstdDecompressor()
+                                             write_content_size=True,
+                                             **kwargs)
+            self._dctx = zstd.ZstdDecompressor(**kwargs)
             self._compinsize = zstd.COMPRESSION_RECOMMENDED_INPUT_SIZE
             self._decompinsize = zstd.DECOMPRESSION_RECOMMENDED_INPUT_SIZE
 
@@ -3737,9 +3799,29 @@ class _zstdengine(compressionengine):
                                         str(e))
 
     def revlogcompressor(self, opts=None):
+        """``opts`` may define the compression ``level`` and ``dictdata``,
+        a dictionary as returned by ``traindictionary()``."""
         opts = opts or {}
         return self.zstdrevlogcompressor(self._module,
-                                         level=opts.get('level', 3))
+                                         level=opts.get('level', 3),
+                                         dictdata=opts.get('dictdata'))
+
+    def traindictionary(self, size, samples):
+        """Train a compression dictionary of ``size`` bytes from ``samples``.
+
+        Small pieces of data compress poorly on their own. Compressing them
+        with a dictionary built from similar data avoids that.
+
+        Returns the dictionary data, or None if the samples are not enough
+        to train a dictionary.
+        """
+        zstd = self._module
+        try:
+            data = zstd.train_dictionary(size, samples).as_bytes()
+        except zstd.ZstdError:
+            return None
+        # training may also fail silently
+        return data or None
 
 compengines.register(_zstdengine())
 
@@ -33,6 +33,29 @@ def _normpath(f):
         f = f.replace('//', '/')
     return f
 
+def _readrevisions(fl, revs):
+    """read the texts of ``revs`` in bulk
+
+    Yields the exception raised when reading each revision, or None. The
+    text is left in the revlog cache. A batch of revisions fails as a whole
+    when one of its chunks is damaged, so after an error the revisions left
+    are read one at a time to report the error on the damaged ones only.
+    """
+    done = 0
+    try:
+        for text in fl.revisions(revs):
+            yield None
+            done += 1
+        return
+    except Exception:
+        pass
+    for rev in revs[done:]:
+        try:
+            fl.revision(rev)
+            yield None
+        except Exception as inst:
+            yield inst
+
 class verifier(object):
     # The match argument is always None in hg core, but e.g. the narrowhg
     # extension will pass in a matcher here.
@@ -371,6 +394,10 @@ class verifier(object):
             self.checklog(fl, f, lr)
             seen = {}
             rp = None
+            skipflags = self.skipflags
+            readrevs = _readrevisions(fl, [i for i in fl if not
+                                           (skipflags and
+                                            skipflags & fl.flags(i))])
             for i in fl:
                 revisions += 1
                 n = fl.node(i)
@@ -433,7 +460,10 @@ class verifier(object):
                     if skipflags:
                         skipflags &= fl.flags(i)
                     if not skipflags:
-                        fl.read(n) # side effect: read content and do checkhash
+                        # side effect: read content and do checkhash
+                        exc = next(readrevs)
+                        if exc is not None:
+                            raise exc
                         rp = fl.renamed(n)
                     # the "L1 == L2" check
                     l1 = fl.rawsize(i)
@@ -277,6 +277,13 @@ class abstractvfs(object):
         to ``__call__``/``open`` to result in the file possibly being closed
         asynchronously, on a background thread.
         """
+        # Sharing a background file closer between threads is complex, and
+        # using one per thread would risk running out of file descriptors.
+        # Only the main thread gets to use one.
+        if not isinstance(threading.currentThread(), threading._MainThread):
+            yield
+            return
+
         # This is an arbitrary restriction and could be changed if we ever
         # have a use case.
         vfs = getattr(self, 'vfs', self)
@@ -413,7 +420,8 @@ class vfs(abstractvfs):
                                     ' valid for checkambig=True') % mode)
             fp = checkambigatclosing(fp)
 
-        if backgroundclose:
+        if (backgroundclose and
+            isinstance(threading.currentThread(), threading._MainThread)):
             if not self._backgroundfilecloser:
                 raise error.Abort(_('backgroundclose can only be used when a '
                                   'backgroundclosing context manager is active')
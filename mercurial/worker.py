@@ -10,7 +10,9 @@ from __future__ import absolute_import
 import errno
 import os
 import signal
+import struct
 import sys
+import threading
 
 from .i18n import _
 from . import (
@@ -18,6 +20,7 @@ from . import (
     error,
     pycompat,
     scmutil,
+    selectors2,
     util,
 )
 
@@ -58,35 +61,102 @@ if pycompat.osname == 'posix':
 else:
     _startupcost = 1e30
 
-def worthwhile(ui, costperop, nops):
+# threads share the memory of the process, so starting one costs little
+_threadstartupcost = 0.001
+
+def worthwhile(ui, costperop, nops, threaded=False):
     '''try to determine whether the benefit of multiple processes can
     outweigh the cost of starting them'''
     linear = costperop * nops
     workers = _numworkers(ui)
-    benefit = linear - (_startupcost * workers + linear / workers)
+    startupcost = _threadstartupcost if threaded else _startupcost
+    benefit = linear - (startupcost * workers + linear / workers)
     return benefit >= 0.15
 
-def worker(ui, costperarg, func, staticargs, args):
+def _usethreads(ui, iobound):
+    '''decide whether the work should be run in threads rather than in
+    forked processes'''
+    backend = ui.config('worker', 'backend')
+    if backend == 'thread' or _platformworker is None:
+        return True
+    elif backend == 'process':
+        return False
+    elif backend != 'auto':
+        raise error.Abort(_('worker.backend must be one of auto, process '
+                            'or thread'))
+    return iobound
+
+def worker(ui, costperarg, func, staticargs, args, iobound=False):
     '''run a function, possibly in parallel in multiple worker
-    processes.
+    processes or threads.
 
     returns a progress iterator
 
     costperarg - cost of a single task
 
-    func - function to run
+    func - function to run, which must be safe to run in a thread and
+    yield picklable results
 
     staticargs - arguments to pass to every invocation of the function
 
     args - arguments to split into chunks, to pass to individual
     workers
+
+    iobound - whether the function spends most of its time in I/O or
+    (de)compression, which release the GIL. Such work is run in threads,
+    sparing the cost of forking a large process.
     '''
-    if worthwhile(ui, costperarg, len(args)):
+    threaded = _usethreads(ui, iobound)
+    if worthwhile(ui, costperarg, len(args), threaded=threaded):
+        if threaded:
+            return _threadedworker(ui, func, staticargs, args)
         return _platformworker(ui, func, staticargs, args)
     return func(*staticargs + (args,))
 
+# results are sent on the worker pipes as pickles preceded by their length
+_resultheader = struct.Struct('>I')
+
+def _writeresult(fd, result):
+    '''send a result on a worker pipe, retrying interrupted and short writes'''
+    data = util.pickle.dumps(result, util.pickle.HIGHEST_PROTOCOL)
+    data = _resultheader.pack(len(data)) + data
+    offset = 0
+    while offset < len(data):
+        try:
+            offset += os.write(fd, util.buffer(data, offset))
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+def _readexactly(fd, size):
+    '''read size bytes from a worker pipe, or less at its end'''
+    chunks = []
+    while size > 0:
+        try:
+            chunk = os.read(fd, size)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _readresult(fd):
+    '''read a result sent by _writeresult(), raising EOFError at the end of
+    the pipe'''
+    header = _readexactly(fd, _resultheader.size)
+    if not header:
+        raise EOFError
+    size = _resultheader.unpack(header)[0]
+    data = _readexactly(fd, size)
+    if len(header) < _resultheader.size or len(data) < size:
+        raise error.Abort(_('truncated result from worker process'))
+    return util.pickle.loads(data)
+
 def _posixworker(ui, func, staticargs, args):
-    rfd, wfd = os.pipe()
     workers = _numworkers(ui)
     oldhandler = signal.getsignal(signal.SIGINT)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -135,7 +205,12 @@ def _posixworker(ui, func, staticargs, args):
     oldchldhandler = signal.signal(signal.SIGCHLD, sigchldhandler)
     ui.flush()
     parentpid = os.getpid()
+    pipes = []
     for pargs in partition(args, workers):
+        # every worker sends its pickled results on its own pipe, so writes
+        # larger than PIPE_BUF are not interleaved with those of the others
+        rfd, wfd = os.pipe()
+        pipes.append((rfd, wfd))
         # make sure we use os._exit in all worker code paths. otherwise the
         # worker may do some clean-ups which could cause surprises like
         # deadlock. see sshpeer.cleanup for example.
@@ -151,9 +226,12 @@ def _posixworker(ui, func, staticargs, args):
                 signal.signal(signal.SIGCHLD, oldchldhandler)
 
                 def workerfunc():
+                    for r, w in pipes[:-1]:
+                        os.close(r)
+                        os.close(w)
                     os.close(rfd)
-                    for i, item in func(*(staticargs + (pargs,))):
-                        os.write(wfd, '%d %s\n' % (i, item))
+                    for result in func(*(staticargs + (pargs,))):
+                        _writeresult(wfd, result)
                     return 0
 
                 ret = scmutil.callcatch(ui, workerfunc)
@@ -172,8 +250,10 @@ def _posixworker(ui, func, staticargs, args):
                 finally:
                     os._exit(ret & 255)
         pids.add(pid)
-    os.close(wfd)
-    fp = os.fdopen(rfd, pycompat.sysstr('rb'), 0)
+    selector = selectors2.DefaultSelector()
+    for rfd, wfd in pipes:
+        os.close(wfd)
+        selector.register(rfd, selectors2.EVENT_READ)
     def cleanup():
         signal.signal(signal.SIGINT, oldhandler)
         waitforworkers()
@@ -184,9 +264,17 @@ def _posixworker(ui, func, staticargs, args):
                 os.kill(os.getpid(), -status)
             sys.exit(status)
     try:
-        for line in util.iterfile(fp):
-            l = line.split(' ', 1)
-            yield int(l[0]), l[1][:-1]
+        openpipes = len(pipes)
+        while openpipes > 0:
+            for key, events in selector.select():
+                try:
+                    result = _readresult(key.fd)
+                except EOFError:
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    openpipes -= 1
+                    continue
+                yield result
     except: # re-raises
         killworkers()
         cleanup()
@@ -203,6 +291,71 @@ def _posixexitstatus(code):
     elif os.WIFSIGNALED(code):
         return -os.WTERMSIG(code)
 
+def _threadedworker(ui, func, staticargs, args):
+    workers = _numworkers(ui)
+    # hand out contiguous chunks in order, so that results can be streamed
+    # in the order of the arguments and files are visited mostly in order
+    size = max(1, -(-len(args) // (workers * 4)))
+    chunks = [args[i:i + size] for i in range(0, len(args), size)]
+    taskqueue = util.queue()
+    for task in enumerate(chunks):
+        taskqueue.put(task)
+    resultqueue = util.queue()
+    interrupted = threading.Event()
+
+    def run():
+        while not interrupted.is_set():
+            try:
+                n, chunk = taskqueue.get_nowait()
+            except util.empty:
+                return
+            try:
+                for res in func(*(staticargs + (chunk,))):
+                    resultqueue.put((n, 'result', res))
+                    if interrupted.is_set():
+                        return
+            except: # re-raises in the main thread
+                resultqueue.put((n, 'error', sys.exc_info()))
+                return
+            resultqueue.put((n, 'done', None))
+
+    ui.flush()
+    threads = []
+    for i in range(min(workers, len(chunks))):
+        t = threading.Thread(target=run, name='worker')
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    buffered = {}
+    done = set()
+    current = 0
+    try:
+        while current < len(chunks):
+            try:
+                # wait with a timeout, so that signals are not held off
+                n, kind, value = resultqueue.get(timeout=0.1)
+            except util.empty:
+                continue
+            if kind == 'error':
+                pycompat.raisewithtb(value[1], value[2])
+            elif kind == 'done':
+                done.add(n)
+            elif n == current:
+                yield value
+                continue
+            else:
+                buffered.setdefault(n, []).append(value)
+            while current in done:
+                current += 1
+                for value in buffered.pop(current, ()):
+                    yield value
+    finally:
+        interrupted.set()
+        for t in threads:
+            t.join()
+
+_platformworker = None
 if pycompat.osname != 'nt':
     _platformworker = _posixworker
     _exitstatus = _posixexitstatus
@@ -28,6 +28,15 @@ def pack_dirstate(fakenow, orig, dmap, copymap, pl, now):
 
     return orig(dmap, copymap, pl, fakenow)
 
+def treewrite(fakenow, orig, dmap, st, now):
+    # same as pack_dirstate() above, for the tree dirstate format
+    actualnow = int(now)
+    for f, e in dmap.iteritems():
+        if e[0] == 'n' and e[3] == actualnow:
+            dmap[f] = parsers.dirstatetuple(e[0], e[1], e[2], -1)
+
+    return orig(dmap, st, fakenow)
+
 def fakewrite(ui, func):
     # fake "now" of 'pack_dirstate' only if it is invoked while 'func'
 
@@ -45,15 +54,19 @@ def fakewrite(ui, func):
 
     orig_pack_dirstate = parsers.pack_dirstate
     orig_dirstate_getfsnow = dirstate._getfsnow
+    orig_treewrite = dirstate.treedirstatemap.write
     wrapper = lambda *args: pack_dirstate(fakenow, orig_pack_dirstate, *args)
+    treewrapper = lambda *args: treewrite(fakenow, orig_treewrite, *args)
 
     parsers.pack_dirstate = wrapper
     dirstate._getfsnow = lambda *args: fakenow
+    dirstate.treedirstatemap.write = treewrapper
     try:
         return func()
     finally:
         parsers.pack_dirstate = orig_pack_dirstate
         dirstate._getfsnow = orig_dirstate_getfsnow
+        dirstate.treedirstatemap.write = orig_treewrite
 
 def _poststatusfixup(orig, workingctx, status, fixup):
     ui = workingctx.repo().ui
@@ -653,6 +653,14 @@ def has_virtualenv():
 def has_fsmonitor():
     return 'HGFSMONITOR_TESTS' in os.environ
 
+@check("inotify", "inotify file watching")
+def has_inotify():
+    try:
+        from hgext.fsmonitor import inotifywatcher
+        return inotifywatcher.supported()
+    except ImportError:
+        return False
+
 @check("fuzzywuzzy", "Fuzzy string matching library")
 def has_fuzzywuzzy():
     try:
@@ -568,6 +568,44 @@ Test clone with special '@' bookmark:
   0aae7cf88f0d
   $ cd "$TESTTMP"
 
+#if zstd
+
+Repositories compressed with a zstd dictionary are cloned with it
+
+  $ hg init zstddict
+  $ cd zstddict
+  $ for i in `$PYTHON $TESTDIR/seq.py 40`; do
+  >   for f in a b c; do
+  >     $PYTHON -c "for j in range(40): print('line %d of %s in revision $i' % (j, '$f'))" > $f
+  >   done
+  >   hg -q commit -A -m "revision $i"
+  > done
+  $ hg debugupgraderepo --run \
+  >   --config experimental.format.compression=zstd \
+  >   --config experimental.format.zstd-dictionary=yes \
+  >   --config experimental.format.zstd-dictionary.size=4k 2>&1 | grep '^trained'
+  trained a zstd dictionary of * from 200 revisions (glob)
+  $ cd ..
+
+  $ hg clone -q zstddict zstddict-local
+  $ hg -R zstddict-local verify -q
+
+  $ hg clone --uncompressed -e "\"$PYTHON\" \"$TESTDIR/dummyssh\"" \
+  >   --config server.uncompressed=yes ssh://user@dummy/zstddict \
+  >   zstddict-stream
+  streaming all changes
+  6 files to transfer, * of data (glob)
+  transferred * in * seconds (*/sec) (glob)
+  searching for changes
+  no changes found
+  updating to branch default
+  3 files updated, 0 files merged, 0 files removed, 0 files unresolved
+  $ grep zstd-dictionary zstddict-stream/.hg/requires
+  exp-zstd-dictionary
+  $ hg -R zstddict-stream verify -q
+
+#endif
+
 
 Testing failures:
 
@@ -755,6 +755,70 @@ unix domain socket:
   killed!
   $ rm .hg/server.log
 
+ workers inherit the dirstate read by the main process, which reads it again
+ when it is idle after a worker changed it:
+
+  $ cat <<EOF > $TESTTMP/dirstateread.py
+  > import os
+  > from mercurial import dirstate, extensions
+  > def read(orig, self):
+  >     res = orig(self)
+  >     with open('$TESTTMP/dirstatereads', 'a') as f:
+  >         f.write('%d %s\n' % (os.getpid(), 'c' in self))
+  >     return res
+  > def uisetup(ui):
+  >     extensions.wrapfunction(dirstate.dirstatemap, 'read', read)
+  > EOF
+  $ hg init ../preload
+  $ cd ../preload
+  $ touch -t 200001010000 a
+  $ hg commit -qAm a
+  $ cat <<EOF >> .hg/hgrc
+  > [extensions]
+  > dirstateread = $TESTTMP/dirstateread.py
+  > EOF
+  >>> from __future__ import print_function
+  >>> import os, time
+  >>> from hgclient import check, readchannel, runcommand, unixserver
+  >>> server = unixserver('.hg/server.sock', '.hg/server.log')
+  >>> def readers():
+  ...     reads = open(os.environ['TESTTMP'] + '/dirstatereads').readlines()
+  ...     return [l.split() for l in reads]
+  >>> def status(conn):
+  ...     readchannel(conn)
+  ...     runcommand(conn, ['status'])
+  >>> check(status, server.connect)
+  *** runcommand status
+  >>> check(status, server.connect)
+  *** runcommand status
+  >>> print(set(int(pid) for pid, c in readers()) == set([server.server.pid]))
+  True
+  >>> os.system('echo b > b; hg add -q b')
+  0
+  >>> check(status, server.connect)
+  *** runcommand status
+  A b
+  >>> def add(conn):
+  ...     readchannel(conn)
+  ...     runcommand(conn, ['add', 'c'])
+  >>> os.system('echo c > c')
+  0
+  >>> check(add, server.connect)
+  *** runcommand add c
+  >>> for i in range(100):
+  ...     if ['%d' % server.server.pid, 'True'] in readers():
+  ...         break
+  ...     time.sleep(0.1)
+  >>> reads = len(readers())
+  >>> check(status, server.connect)
+  *** runcommand status
+  A b
+  A c
+  >>> print(readers()[reads:])
+  []
+  >>> server.shutdown()
+  $ cd ../repo
+
  if server crashed before hello, traceback will be sent to 'e' channel as
  last ditch:
 
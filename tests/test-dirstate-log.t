@@ -0,0 +1,99 @@
+  $ cat >> $HGRCPATH <<EOF
+  > [experimental]
+  > format.dirstatelog = yes
+  > EOF
+
+  $ hg init repo
+  $ cd repo
+  $ grep dirstatelog .hg/requires
+  exp-dirstatelog
+  $ "$PYTHON" -c "
+  > for i in range(400):
+  >     open('file%03d' % i, 'w').write('%03d\\n' % i)
+  > "
+  $ hg add -q
+  $ touch -t 200001010000 file*
+  $ hg commit -qm initial
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9640
+
+Refreshed timestamps are appended to the log
+
+  $ touch -t 200101010000 file000 file001
+  $ hg status
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9640
+  .hg/dirstate.log: size=128
+  $ hg debugstate --nodates | grep 'file00[01]'
+  n 644          4 set                 file000
+  n 644          4 set                 file001
+
+So are other changes
+
+  $ echo new > new
+  $ hg add new
+  $ hg copy file002 copy
+  $ hg forget file003
+  $ hg status -C
+  A copy
+    file002
+  A new
+  R file003
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9640
+  .hg/dirstate.log: size=417
+  $ hg debugstate --nodates | grep -v 'n 644          4 set '
+  a   0         -1 unset               copy
+  r   0          0 set                 file003
+  a   0         -1 unset               new
+  copy: file002 -> copy
+  $ hg revert -q file003 copy
+  $ hg status -C
+  A new
+  ? copy
+  $ hg debugstate --nodates | grep -v 'n 644          4 '
+  a   0         -1 unset               new
+
+An interrupted append is ignored
+
+  $ cp .hg/dirstate.log $TESTTMP/dirstate.log
+  $ hg forget new
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9640
+  .hg/dirstate.log: size=* (glob)
+  $ "$PYTHON" -c "import os; os.ftruncate(os.open('.hg/dirstate.log', os.O_RDWR), os.path.getsize('$TESTTMP/dirstate.log') + 30)"
+  $ hg status
+  A new
+  ? copy
+  $ hg forget new
+  $ hg status
+  ? copy
+  ? new
+
+The dirstate is rewritten once the log gets too large
+
+  $ touch -t 200201010000 file*
+  $ hg status
+  ? copy
+  ? new
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9640
+
+Transactions rewrite the dirstate
+
+  $ hg add -q new
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9640
+  .hg/dirstate.log: size=* (glob)
+  $ hg commit -qm new
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9660
+  $ hg add -q copy
+  $ hg rollback -q
+  $ f --size .hg/dirstate*
+  .hg/dirstate: size=9660
+  $ hg status
+  A new
+  ? copy
+
+  $ cd ..
@@ -0,0 +1,107 @@
+#require inotify unix-socket
+
+  $ cat >> $HGRCPATH <<EOF
+  > [extensions]
+  > fsmonitor =
+  > [fsmonitor]
+  > backend = inotify
+  > EOF
+
+  $ cat > $TESTTMP/clock.py <<EOF
+  > import struct
+  > data = open('.hg/fsmonitor.state', 'rb').read()
+  > print(data[struct.calcsize('>I'):].split('\0')[1])
+  > EOF
+
+  $ hg init repo
+  $ cd repo
+  $ hg debugfsmonitorwatcher --daemon --pid-file ../watcher.pid
+  $ cat ../watcher.pid >> $DAEMON_PIDS
+
+The first status walks the working copy, and keeps the clock of the watcher
+
+  $ mkdir -p dir/sub
+  $ echo a > a
+  $ echo b > dir/b
+  $ echo c > dir/sub/c
+  $ hg status
+  ? a
+  ? dir/b
+  ? dir/sub/c
+  $ "$PYTHON" $TESTTMP/clock.py
+  c:*.*.1:* (glob)
+  $ hg commit -qAm 0
+  $ hg status
+
+Changes are picked up from the journal of the watcher
+
+  $ echo aa > a
+  $ rm dir/b
+  $ mkdir -p new/sub
+  $ echo d > new/sub/d
+  $ ln -s a link
+  $ hg status
+  M a
+  ! dir/b
+  ? link
+  ? new/sub/d
+  $ hg add -q new
+  $ echo dd > new/sub/d
+  $ hg status
+  M a
+  A new/sub/d
+  ! dir/b
+  ? link
+  $ hg status dir
+  ! dir/b
+
+Moving a directory makes the watcher start over
+
+  $ mv dir moved
+  $ hg status
+  M a
+  A new/sub/d
+  ! dir/b
+  ! dir/sub/c
+  ? link
+  ? moved/sub/c
+  $ "$PYTHON" $TESTTMP/clock.py
+  c:*.*.2:* (glob)
+  $ echo c2 > moved/sub/c
+  $ mv moved dir
+  $ hg status
+  M a
+  M dir/sub/c
+  A new/sub/d
+  ! dir/b
+  ? link
+  $ hg status --config extensions.fsmonitor=!
+  M a
+  M dir/sub/c
+  A new/sub/d
+  ! dir/b
+  ? link
+
+Only one watcher runs for a working copy
+
+  $ hg debugfsmonitorwatcher
+  abort: a watcher is already running for $TESTTMP/repo
+  [255]
+
+The watcher is started when it is not running
+
+  $ "$PYTHON" -c "import os, signal; os.kill(int(open('../watcher.pid').read()), signal.SIGTERM)"
+  $ hg revert -q --all --no-backup
+  $ hg status
+  ? link
+  ? new/sub/d
+  $ hg debugfsmonitorwatcher
+  abort: a watcher is already running for $TESTTMP/repo
+  [255]
+
+Other backends are refused
+
+  $ hg status --config fsmonitor.backend=other
+  fsmonitor: unknown backend 'other'
+  ? link
+  ? new/sub/d
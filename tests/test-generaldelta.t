@@ -349,3 +349,43 @@ test maxdeltachainspan
       50      2857      58     49      50 467f8e30a066 9fff62ea0624 000000000000
       51      2915      58     17      51 346db97283df a33416e52d91 000000000000
       52      2973      58     51      52 4e003fd4d5cd 346db97283df 000000000000
+
+Compressing incoming deltas in background threads stores the same data
+
+  $ hg init threads-source
+  $ cd threads-source
+  $ for i in 1 2 3 4 5 6 7 8 9 10; do
+  >   $PYTHON -c "import sys; sys.stdout.write(''.join('%d line %d\n' % (n, n * $i) for n in range(200)))" > a
+  >   echo $i >> b
+  >   hg ci -qAm $i
+  > done
+  $ hg bundle -q -a ../threads.hg
+  $ cd ..
+  $ hg init threads-serial
+  $ hg -R threads-serial unbundle -q threads.hg
+  $ hg init threads-parallel
+  $ hg -R threads-parallel unbundle -q threads.hg \
+  >   --config experimental.addgroup-compression-threads=3
+  $ for f in 00changelog.i 00manifest.i data/a.i data/b.i; do
+  >   cmp threads-serial/.hg/store/$f threads-parallel/.hg/store/$f
+  > done
+  $ hg -R threads-parallel verify -q
+
+A single pool of threads compresses the deltas of every revlog
+
+  $ cat > $TESTTMP/countpools.py << EOF
+  > from mercurial import extensions, revlog
+  > def compressionpool(orig, self):
+  >     pool = orig(self)
+  >     if pool is not None:
+  >         print('compression pool started by %s' % self.indexfile)
+  >     return pool
+  > def uisetup(ui):
+  >     extensions.wrapfunction(revlog.revlog, 'compressionpool',
+  >                             compressionpool)
+  > EOF
+  $ hg init threads-pool
+  $ hg -R threads-pool unbundle -q threads.hg \
+  >   --config experimental.addgroup-compression-threads=3 \
+  >   --config extensions.countpools=$TESTTMP/countpools.py
+  compression pool started by 00changelog.i
@@ -932,6 +932,7 @@ Test list of internal help commands
                  print merge state
    debugnamecomplete
                  complete "names" - tags, open branch names, bookmark names
+   debugnodemap  show the state of the persistent nodemaps of the repository
    debugobsolete
                  create arbitrary obsolete marker
    debugoptADV   (no help text available)
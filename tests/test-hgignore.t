@@ -337,3 +337,82 @@ Windows paths are accepted on input
   $ hg up -qC .
 
 #endif
+
+Ignore patterns can be sorted in buckets of names, suffixes and rooted paths,
+which are cached along with the remaining regexps
+
+  $ cd $TESTTMP
+  $ hg init bucketed
+  $ cd bucketed
+  $ cat >> .hg/hgrc <<EOF
+  > [experimental]
+  > bucketed-ignore = yes
+  > EOF
+  $ touch .hg/testhgignorerel
+  $ mkdir -p build/x src/build sub a/b
+  $ cat > .hgignore <<EOF
+  > syntax: glob
+  > build
+  > *.pyc
+  > re:^a/b/
+  > re:^foo.*bar$
+  > subinclude:sub/.hgignore
+  > syntax: invalid
+  > EOF
+  $ echo inner > sub/.hgignore
+  $ touch build/x/f src/build/g x.pyc a/b/c a/bc foo fooXbar sub/inner sub/ok
+  $ hg status
+  $TESTTMP/bucketed/.hgignore: ignoring invalid syntax 'invalid' (glob)
+  ? .hgignore
+  ? a/bc
+  ? foo
+  ? sub/.hgignore
+  ? sub/ok
+  $ hg debugignore
+  $TESTTMP/bucketed/.hgignore: ignoring invalid syntax 'invalid' (glob)
+  <ignorematcher names=['build'] suffixes=['.pyc'] prefixes=['a/b/'] regexes=['^foo.*bar$'] subincludes=[('sub/', '$TESTTMP/bucketed/sub', 'include:$TESTTMP/bucketed/sub/.hgignore')]>
+  $ cat .hg/cache/ignore
+  1 [0-9a-f]{40} (re)
+  warning $TESTTMP/bucketed/.hgignore: ignoring invalid syntax \'invalid\'\n
+  name build
+  suffix .pyc
+  prefix a/b/
+  re ^foo.*bar$
+  subinclude sub/\x00$TESTTMP/bucketed/sub\x00include:$TESTTMP/bucketed/sub/.hgignore (esc)
+
+The cache is used as long as the ignore files do not change, and gives the
+same results
+
+  $ cp .hg/cache/ignore $TESTTMP/ignorecache
+  $ echo 'name foo' >> .hg/cache/ignore
+  $ hg status --ignored foo
+  $TESTTMP/bucketed/.hgignore: ignoring invalid syntax 'invalid' (glob)
+  I foo
+  $ cp $TESTTMP/ignorecache .hg/cache/ignore
+  $ hg status --ignored
+  $TESTTMP/bucketed/.hgignore: ignoring invalid syntax 'invalid' (glob)
+  I a/b/c
+  I build/x/f
+  I fooXbar
+  I src/build/g
+  I sub/inner
+  I x.pyc
+  $ hg status --ignored --config experimental.bucketed-ignore=no
+  $TESTTMP/bucketed/.hgignore: ignoring invalid syntax 'invalid' (glob)
+  I a/b/c
+  I build/x/f
+  I fooXbar
+  I src/build/g
+  I sub/inner
+  I x.pyc
+
+  $ echo ok >> sub/.hgignore
+  $ hg status
+  $TESTTMP/bucketed/.hgignore: ignoring invalid syntax 'invalid' (glob)
+  ? .hgignore
+  ? a/bc
+  ? foo
+  ? sub/.hgignore
+  $ grep -c subinclude .hg/cache/ignore
+  1
+  $ cd ..
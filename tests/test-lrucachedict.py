@@ -73,5 +73,36 @@ def test_lrucachedict():
     for k in list(iter(d)):
         print("d['%s']: %s" % (k, d[k]))
 
+    # test cost limits
+    d = util.lrucachedict(10, maxcost=100)
+    d.insert('a', 'va4', cost=40)
+    d.insert('b', 'vb4', cost=40)
+    print("\nTotal cost of 'a' and 'b': %d" % d.totalcost)
+
+    # the oldest items are evicted down to 3/4 of the maximal cost
+    print("\nOnly 'b' and 'c' should be present:")
+    d.insert('c', 'vc4', cost=30)
+    printifpresent(d, ['a', 'b', 'c'])
+    print("total cost: %d" % d.totalcost)
+
+    # replacing an item updates the total cost
+    d.insert('d', 'vd4', cost=10)
+    d.insert('c', 'vc4_new', cost=20)
+    print("\nReplaced 'c', total cost: %d" % d.totalcost)
+    del d['d']
+    print("deleted 'd', total cost: %d" % d.totalcost)
+
+    # the most recently inserted item is never evicted
+    print("\nOnly 'e' should be present:")
+    d.insert('e', 've4', cost=200)
+    printifpresent(d, ['c', 'e'])
+
+    dc = d.copy()
+    print("\nThe copy should only contain 'e':")
+    printifpresent(dc, ['c', 'e'], 'dc')
+    print("copy total cost: %d" % dc.totalcost)
+    d.clear()
+    print("cleared total cost: %d" % d.totalcost)
+
 if __name__ == '__main__':
     test_lrucachedict()
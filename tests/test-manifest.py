@@ -321,6 +321,32 @@ class basemanifesttests(object):
             }
         self.assertEqual(want, pruned.diff(short, clean=True))
 
+    def testManifestDiffScattered(self):
+        MISSING = (None, b'')
+        lines = A_HUGE_MANIFEST.splitlines(True)[:1000]
+        left = self.parsemanifest(b''.join(lines))
+        changed = list(lines)
+        want = {}
+        for i in (0, 1, 2, 500, 998):
+            f, n = changed[i][:-1].split(b'\0')
+            changed[i] = b'%s\0%s\n' % (f, HASH_3)
+            want[f] = ((binascii.unhexlify(n[:40]), n[40:]), (BIN_HASH_3, b''))
+        for i in (3, 250, 251, 999):
+            f, n = changed[i][:-1].split(b'\0')
+            changed[i] = b''
+            want[f] = ((binascii.unhexlify(n[:40]), n[40:]), MISSING)
+        added = lines[700].split(b'\0')[0] + b'-new'
+        changed.insert(701, added + b'\0' + HASH_1 + b'x\n')
+        want[added] = (MISSING, (BIN_HASH_1, b'x'))
+        changed.append(b'z-new\0' + HASH_2 + b'\n')
+        want[b'z-new'] = (MISSING, (BIN_HASH_2, b''))
+        right = self.parsemanifest(b''.join(changed))
+        self.assertEqual(want, left.diff(right))
+        reverse = dict((f, (e2, e1)) for f, (e1, e2) in want.items())
+        self.assertEqual(reverse, right.diff(left))
+        self.assertEqual({}, left.diff(left.copy()))
+        self.assertEqual({}, left.diff(self.parsemanifest(b''.join(lines))))
+
     def testReversedLines(self):
         backwards = b''.join(
             l + b'\n' for l in reversed(A_SHORT_MANIFEST.split(b'\n')) if l)
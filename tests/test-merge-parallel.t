@@ -0,0 +1,122 @@
+#require no-windows
+
+Text merges run in worker processes with merge.parallel, files are still
+resolved in order
+
+  $ cat >> $HGRCPATH <<EOF
+  > [merge]
+  > parallel = True
+  > [worker]
+  > numcpus = 2
+  > EOF
+
+  $ hg init repo
+  $ cd repo
+  $ for i in `$PYTHON $TESTDIR/seq.py 40`; do
+  >   $PYTHON $TESTDIR/seq.py $i `expr $i + 5` > f$i
+  > done
+  $ hg ci -qAm base
+  $ for i in `$PYTHON $TESTDIR/seq.py 40`; do
+  >   echo local >> f$i
+  > done
+  $ hg ci -qm local
+  $ hg up -q 0
+  $ for i in `$PYTHON $TESTDIR/seq.py 40`; do
+  >   (echo other; $PYTHON $TESTDIR/seq.py `expr $i + 1` `expr $i + 5`) > f$i
+  > done
+  $ (echo other; $PYTHON $TESTDIR/seq.py 4 7; echo conflict) > f3
+  $ (echo other; $PYTHON $TESTDIR/seq.py 18 21; echo conflict) > f17
+  $ hg ci -qm other
+
+The merged texts are returned by the workers, the main process only merges
+the texts of conflicting files again, when running the merge tool after their
+premerge
+
+  $ cat > $TESTTMP/mergetext.py <<EOF
+  > import os
+  > from mercurial import extensions, simplemerge
+  > mainpid = os.getpid()
+  > def mergetext(orig, *args):
+  >     with open('$TESTTMP/textmerges', 'a') as f:
+  >         f.write('%s\n' % (os.getpid() == mainpid and 'main' or 'worker'))
+  >     return orig(*args)
+  > def uisetup(ui):
+  >     extensions.wrapfunction(simplemerge, 'mergetext', mergetext)
+  > EOF
+
+  $ hg up -q 1
+  $ hg merge --config extensions.mergetext=$TESTTMP/mergetext.py 2 \
+  >   | grep -v '^merging f'
+  warning: conflicts while merging f17! (edit, then use 'hg resolve --mark')
+  warning: conflicts while merging f3! (edit, then use 'hg resolve --mark')
+  0 files updated, 38 files merged, 0 files removed, 2 files unresolved
+  use 'hg resolve' to retry unresolved file merges or 'hg update -C .' to abandon
+  $ sort $TESTTMP/textmerges | uniq -c
+  \s*2 main (re)
+  \s*40 worker (re)
+  $ hg resolve -l | grep '^U'
+  U f17
+  U f3
+  $ cat f1
+  other
+  2
+  3
+  4
+  5
+  6
+  local
+  $ cat f3
+  other
+  4
+  5
+  6
+  7
+  <<<<<<< working copy: dfa31d367378 - test: local
+  8
+  local
+  =======
+  conflict
+  >>>>>>> merge rev:    211b2f7b297c - test: other
+
+The results match the ones of sequential merges
+
+  $ hg diff --nodates > ../parallel.diff
+  $ hg up -qC 1
+  $ hg merge --config merge.parallel=False 2 > /dev/null 2>&1
+  [1]
+  $ hg diff --nodates | cmp - ../parallel.diff
+
+Only the files merged by the premerge of an internal tool are merged ahead of
+time
+
+  $ rm $TESTTMP/textmerges
+  $ hg up -qC 1
+  $ hg merge --config extensions.mergetext=$TESTTMP/mergetext.py \
+  >   --tool :local 2 | grep -v '^merging f'
+  0 files updated, 40 files merged, 0 files removed, 0 files unresolved
+  (branch merge, don't forget to commit)
+  $ test -f $TESTTMP/textmerges
+  [1]
+  $ hg up -qC 1
+  $ hg merge --config extensions.mergetext=$TESTTMP/mergetext.py \
+  >   --config merge-tools.true.premerge=False --tool true 2 \
+  >   | grep -v '^merging f'
+  0 files updated, 40 files merged, 0 files removed, 0 files unresolved
+  (branch merge, don't forget to commit)
+  $ test -f $TESTTMP/textmerges
+  [1]
+  $ cat >> $HGRCPATH <<EOF
+  > [merge-patterns]
+  > f1* = :other
+  > EOF
+  $ hg up -qC 1
+  $ HGMERGE= hg merge --config extensions.mergetext=$TESTTMP/mergetext.py 2 \
+  >   | grep -v '^merging f'
+  warning: conflicts while merging f3! (edit, then use 'hg resolve --mark')
+  0 files updated, 39 files merged, 0 files removed, 1 files unresolved
+  use 'hg resolve' to retry unresolved file merges or 'hg update -C .' to abandon
+  $ sort $TESTTMP/textmerges | uniq -c
+  \s*1 main (re)
+  \s*29 worker (re)
+
+  $ cd ..
@@ -209,6 +209,34 @@ def runtest() :
             # pure version doesn't support this
             break
 
+    # Check that inserted entries, heads and truncation behave like the
+    # original Python implementation.
+    ix = parsers.parse_index2(data_non_inlined, False)[0]
+    py_ix = py_parseindex(data_non_inlined, False)[0]
+    if ix.headrevs() != [3]:
+        print("Unexpected heads %r" % ix.headrevs())
+    for e in [(0, 1, 2, 3, 4, 1, -1, '1' * 20),
+              (0, 5, 6, 7, 8, 4, 2, '2' * 20)]:
+        ix.insert(-1, e)
+        py_ix.insert(-1, e)
+    if list(ix) != py_ix:
+        print("Index with inserted entries differs!")
+    if ix.headrevs() != [3, 5]:
+        print("Unexpected heads with inserted entries %r" % ix.headrevs())
+    if ix.headrevsfiltered(frozenset([5])) != [3, 4]:
+        print("Unexpected filtered heads %r"
+              % ix.headrevsfiltered(frozenset([5])))
+    del ix[5:-1]
+    del py_ix[5:-1]
+    if list(ix) != py_ix:
+        print("Index truncated in inserted entries differs!")
+    ix = parsers.parse_index2(data_non_inlined, False)[0]
+    py_ix = py_parseindex(data_non_inlined, False)[0]
+    del ix[2:-1]
+    del py_ix[2:-1]
+    if list(ix) != py_ix or ix.headrevs() != [1]:
+        print("Truncated index differs!")
+
     print("done")
 
 runtest()
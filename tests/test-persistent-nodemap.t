@@ -0,0 +1,104 @@
+===================================
+Test the persistent on-disk nodemap
+===================================
+
+  $ cat >> $HGRCPATH << EOF
+  > [experimental]
+  > persistent-nodemap = yes
+  > [extensions]
+  > strip =
+  > EOF
+
+  $ hg init test-repo
+  $ cd test-repo
+  $ hg debugnodemap
+  00changelog.i: no valid nodemap
+  00manifest.i: no valid nodemap
+
+The nodemap is written by the transaction adding revisions
+
+  $ for i in 0 1 2 3 4; do
+  >   echo $i > f$i
+  >   hg ci -qAm "commit $i"
+  > done
+  $ ls .hg/store | grep '^00.*\.nd\?$'
+  00changelog.n
+  00changelog.nd
+  00manifest.n
+  00manifest.nd
+  $ hg debugnodemap
+  00changelog.i: 5 entries (1 sorted), tip 4
+  00manifest.i: 5 entries (1 sorted), tip 4
+
+Lookups use it
+
+  $ hg log -r 'all()' -T '{rev}:{node|short} {shortest(node)}\n'
+  0:0a02ceb915ad 0a02
+  1:8979f70cc850 8979
+  2:22aff45ffd48 22af
+  3:04e7ab2a86f4 04e7
+  4:4186b2b17d86 4186
+  $ hg log -r 8979 -T '{rev}\n'
+  1
+  $ hg log -r 4186b2b17d86 -T '{rev}\n'
+  4
+
+A missing nodemap can be rebuilt, it is then fully sorted
+
+  $ rm .hg/store/00changelog.n
+  $ hg debugnodemap
+  00changelog.i: no valid nodemap
+  00manifest.i: 5 entries (1 sorted), tip 4
+  $ hg debugnodemap --update
+  00changelog.i: 5 entries (5 sorted), tip 4
+  00manifest.i: 5 entries (1 sorted), tip 4
+  $ hg debugnodemap --update --config experimental.persistent-nodemap=no
+  abort: persistent nodemaps are not enabled
+  (set experimental.persistent-nodemap)
+  [255]
+
+Revisions added without the nodemap enabled are found in the index
+
+  $ echo 5 > f5
+  $ hg ci -qAm "commit 5" --config experimental.persistent-nodemap=no
+  $ hg debugnodemap
+  00changelog.i: 5 entries (5 sorted), tip 4
+  00manifest.i: 5 entries (1 sorted), tip 4
+  $ hg log -r tip -T '{rev}:{shortest(node)}\n'
+  5:4b22
+
+A nodemap not matching the index is ignored and rewritten
+
+  $ hg strip -q -r 3 --config experimental.persistent-nodemap=no
+  $ hg debugnodemap
+  00changelog.i: no valid nodemap
+  00manifest.i: no valid nodemap
+  $ hg log -r 'all()' -T '{rev}:{node|short}\n'
+  0:0a02ceb915ad
+  1:8979f70cc850
+  2:22aff45ffd48
+  $ echo 6 > f6
+  $ hg ci -qAm "commit 6"
+  $ hg debugnodemap
+  00changelog.i: 4 entries (4 sorted), tip 3
+  00manifest.i: 4 entries (4 sorted), tip 3
+
+Stripping with the nodemap enabled keeps it valid
+
+  $ hg strip -q -r 1
+  $ hg debugnodemap
+  00changelog.i: 1 entries (1 sorted), tip 0
+  00manifest.i: 1 entries (1 sorted), tip 0
+
+Rolling back restores the previous nodemap
+
+  $ echo 7 > f7
+  $ hg ci -qAm "commit 7"
+  $ hg debugnodemap
+  00changelog.i: 2 entries (1 sorted), tip 1
+  00manifest.i: 2 entries (1 sorted), tip 1
+  $ hg rollback -q
+  $ hg debugnodemap
+  00changelog.i: 1 entries (1 sorted), tip 0
+  00manifest.i: 1 entries (1 sorted), tip 0
+  $ hg verify -q
@@ -0,0 +1,182 @@
+#require symlink execbit
+  $ cat << EOF >> $HGRCPATH
+  > [extensions]
+  > rebase=
+  > [rebase]
+  > experimental.inmemory=1
+  > [alias]
+  > tglog = log -G --template "{rev}: {node|short} '{desc}' {branches}\n"
+  > EOF
+
+Rebase a simple DAG:
+  $ hg init repo1
+  $ cd repo1
+  $ echo a > a
+  $ hg commit -qAm 'a'
+  $ echo b > b
+  $ hg commit -qAm 'b'
+  $ hg up -q 0
+  $ echo c > c
+  $ hg commit -qAm 'c'
+  $ echo d > d
+  $ hg commit -qAm 'd'
+  $ hg up -q 1
+  $ ln -s b e
+  $ chmod +x a
+  $ hg cp a f
+  $ hg commit -qAm 'e'
+  $ hg tglog
+  @  4: 5e033dc7136f 'e'
+  |
+  | o  3: 34a9919932c1 'd'
+  | |
+  | o  2: d36c0562f908 'c'
+  | |
+  o |  1: d2ae7f538514 'b'
+  |/
+  o  0: cb9a9f314b8b 'a'
+  
+
+  $ hg up -q 3
+
+The working directory is left alone while the changesets are merged in memory
+
+  $ touch -t 200001010000 c d
+  $ hg rebase --debug -r 4 -d 3 | grep -e 'in memory' -e 'rebasing'
+  rebasing 4:5e033dc7136f "e" (tip)
+   merge in memory on top of 3:34a9919932c1
+  $ ls -l c d | grep -c 2000
+  2
+  $ hg log -r . -T '{rev}\n'
+  3
+  $ hg status
+  $ hg tglog
+  o  4: * 'e' (glob)
+  |
+  @  3: 34a9919932c1 'd'
+  |
+  o  2: d36c0562f908 'c'
+  |
+  | o  1: d2ae7f538514 'b'
+  |/
+  o  0: cb9a9f314b8b 'a'
+  
+
+  $ hg cat -r 4 e
+  b (no-eol)
+  $ hg manifest -v -r 4
+  755 * a
+  644   c
+  644   d
+  644 @ e
+  755 * f
+  $ hg log -r 4 -T '{file_copies}\n'
+  f (a)
+  $ hg status --change 4
+  M a
+  A e
+  A f
+
+Moving the working directory parent updates it to its new location at the end
+
+  $ hg up -q 1
+  $ hg rebase -s 1 -d 4
+  rebasing 1:d2ae7f538514 "b"
+  saved backup bundle to $TESTTMP/repo1/.hg/strip-backup/d2ae7f538514-2953539b-rebase.hg (glob)
+  $ hg log -r . -T '{rev} {desc}\n'
+  4 b
+  $ cat b
+  b
+  $ hg status
+
+Changesets that end up empty are skipped
+
+  $ hg up -q 0
+  $ echo b > b
+  $ hg commit -qAm 'b again'
+  $ hg rebase -d 4
+  rebasing 5:* "b again" (tip) (glob)
+  note: rebase of 5:* created no changes to commit (glob)
+  saved backup bundle to $TESTTMP/repo1/.hg/strip-backup/*-rebase.hg (glob)
+  $ hg log -r . -T '{rev} {desc}\n'
+  4 b
+
+  $ cd ..
+
+Merges that conflict are run again in the working directory, once the
+changesets already rebased in memory are stripped:
+
+  $ hg init repo2
+  $ cd repo2
+  $ echo a > a
+  $ hg commit -qAm 'a'
+  $ echo x > x
+  $ hg commit -qAm 'x'
+  $ echo b > a
+  $ hg commit -qAm 'b'
+  $ hg up -q 0
+  $ echo c > a
+  $ hg commit -qAm 'c'
+  $ hg rebase -s 1 -d 3
+  rebasing 1:* "x" (glob)
+  rebasing 2:* "b" (glob)
+  merging a
+  hit merge conflicts; re-running rebase without in-memory merge
+  saved backup bundle to $TESTTMP/repo2/.hg/strip-backup/*-backup.hg (glob)
+  rebase aborted
+  rebasing 1:* "x" (glob)
+  rebasing 2:* "b" (glob)
+  merging a
+  warning: conflicts while merging a! (edit, then use 'hg resolve --mark')
+  unresolved conflicts (see hg resolve, then hg rebase --continue)
+  [1]
+  $ hg resolve -l
+  U a
+  $ echo resolved > a
+  $ hg resolve -qm a
+  continue: hg rebase --continue
+  $ hg rebase --continue
+  already rebased 1:* "x" as * (glob)
+  rebasing 2:* "b" (glob)
+  saved backup bundle to $TESTTMP/repo2/.hg/strip-backup/*-rebase.hg (glob)
+  $ hg log -G -T '{rev} {desc}\n'
+  o  3 b
+  |
+  o  2 x
+  |
+  @  1 c
+  |
+  o  0 a
+  
+  $ hg cat -r tip a x
+  resolved
+  x
+
+  $ cd ..
+
+Change/delete conflicts are only prompted for in the working directory
+
+  $ hg init repo3
+  $ cd repo3
+  $ echo a > a
+  $ echo b > b
+  $ hg commit -qAm 'a'
+  $ echo changed > a
+  $ hg commit -qAm 'change a'
+  $ hg up -q 0
+  $ hg rm a
+  $ hg commit -qAm 'remove a'
+  $ hg rebase -s 1 -d 2 --config ui.interactive=yes << EOF
+  > c
+  > EOF
+  rebasing 1:* "change a" (glob)
+  hit merge conflicts; re-running rebase without in-memory merge
+  rebase aborted
+  rebasing 1:* "change a" (glob)
+  other [source] changed a which local [dest] deleted
+  use (c)hanged version, leave (d)eleted, or leave (u)nresolved? c
+  saved backup bundle to $TESTTMP/repo3/.hg/strip-backup/*-rebase.hg (glob)
+  $ hg cat -r tip a
+  changed
+
+  $ cd ..
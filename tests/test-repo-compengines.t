@@ -75,4 +75,65 @@ with that engine or a requirement
       0x78 (x)  :   2 (100.00%)
       0x78 (x)  : 199 (100.00%)
 
+  $ cd ..
+
+Upgrading a repository to zstd can train a dictionary all revisions are
+compressed with
+
+  $ hg init dictionary
+  $ cd dictionary
+  $ for i in `$PYTHON $TESTDIR/seq.py 40`; do
+  >   for f in a b c; do
+  >     $PYTHON -c "for j in range(40): print('line %d of %s in revision $i' % (j, '$f'))" > $f
+  >   done
+  >   hg -q commit -A -m "revision $i"
+  > done
+
+  $ hg debugupgraderepo --run \
+  >   --config experimental.format.compression=zstd \
+  >   --config experimental.format.zstd-dictionary=yes \
+  >   --config experimental.format.zstd-dictionary.size=4k 2>&1 | grep zstd
+     added: exp-compression-zstd, exp-zstd-dictionary
+  exp-zstd-dictionary
+     revisions will be compressed with a zstd dictionary trained from the repository content; repository size and read I/O should decrease
+  trained a zstd dictionary of * from 200 revisions (glob)
+
+  $ cat .hg/requires
+  dotencode
+  exp-compression-zstd
+  exp-zstd-dictionary
+  fncache
+  generaldelta
+  revlogv1
+  store
+  $ test -f .hg/store/zstd-dictionary
+
+  $ echo 'line 0 of a in a new revision' > a
+  $ hg commit -m 'new revision'
+  $ hg debugrevlog -c | grep 0x28
+      0x28      :   41 (100.00%)
+      0x28      : * (100.00%) (glob)
+  $ hg verify -q
+  $ hg cat -r 20 b | head -1
+  line 0 of b in revision 21
+
+Without enough data, no dictionary is trained
+
+  $ hg init ../tiny
+  $ cd ../tiny
+  $ echo a > a
+  $ hg -q commit -A -m a
+  $ hg debugupgraderepo --run \
+  >   --config experimental.format.compression=zstd \
+  >   --config experimental.format.zstd-dictionary=yes 2>&1 | grep zstd
+     added: exp-compression-zstd, exp-zstd-dictionary
+  exp-zstd-dictionary
+     revisions will be compressed with a zstd dictionary trained from the repository content; repository size and read I/O should decrease
+  not enough data to train a zstd dictionary; revisions will be compressed without one
+  $ test -f .hg/store/zstd-dictionary
+  [1]
+  $ hg verify -q
+  $ hg cat a
+  a
+
 #endif
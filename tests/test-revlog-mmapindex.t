@@ -51,4 +51,19 @@ do not mmap index which is still less than 32k
   97
   96
 
+mmap data files larger than the threshold
+
+  $ $PYTHON -c "import hashlib; print '\\n'.join(hashlib.sha1(str(i)).hexdigest() for i in range(10000))" > big
+  $ hg commit -qAm big
+  $ ls .hg/store/data/big.*
+  .hg/store/data/big.d
+  .hg/store/data/big.i
+  $ hg cat big --config experimental.mmapdatathreshold=4k -o big.copy
+  mmapping $TESTTMP/a/.hg/store/data/big.d (glob)
+  $ cmp big big.copy
+
+do not mmap data files smaller than the threshold
+  $ hg cat big --config experimental.mmapdatathreshold=1m -o big.copy
+  $ cmp big big.copy
+
   $ cd ..
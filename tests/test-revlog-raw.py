@@ -286,6 +286,24 @@ def checkrevlog(rlog, expected):
                             abort('rev %d: corrupted %stext'
                                   % (rev, raw and 'raw' or ''))
 
+def checkrevisions(rlog, expected):
+    '''Check texts built in bulk by revlog.revisions() in various orders'''
+    revs = list(range(len(rlog)))
+    orders = [revs, revs[::-1], revs[::2] + revs[1::2], revs + revs,
+              [r for r in revs for i in range(2)]]
+    for revorder in orders:
+        for raw in [False, True]:
+            nlog = newrevlog()
+            for rev, t in zip(revorder, nlog.revisions(revorder, raw=raw)):
+                if t != expected[rev][int(raw)]:
+                    abort('rev %d: corrupted %stext in bulk'
+                          % (rev, raw and 'raw' or ''))
+            # revisions() leaves the last text in cache
+            rev = revorder[-1]
+            if nlog.revision(rev, raw=raw) != expected[rev][int(raw)]:
+                abort('rev %d: corrupted cached %stext'
+                      % (rev, raw and 'raw' or ''))
+
 def maintest():
     expected = rl = None
     with newtransaction() as tr:
@@ -293,6 +311,8 @@ def maintest():
         expected = writecases(rl, tr)
         checkrevlog(rl, expected)
         print('local test passed')
+        checkrevisions(rl, expected)
+        print('revisions test passed')
         # Copy via revlog.addgroup
         rl1 = addgroupcopy(rl, tr)
         checkrevlog(rl1, expected)
@@ -0,0 +1,101 @@
+Test the process wide cache of revision texts
+
+  $ cat >> $HGRCPATH << EOF
+  > [extensions]
+  > perf = $TESTDIR/../contrib/perf.py
+  > [format]
+  > generaldelta = yes
+  > EOF
+
+  $ hg init repo
+  $ cd repo
+  $ for i in 0 1 2 3 4 5 6 7 8 9; do
+  >   echo line$i >> f
+  >   hg ci -qAm $i
+  > done
+
+The cache is disabled by default
+
+  $ hg perfrevlogrevisions f 2>&1 | grep 'revision cache'
+  [1]
+
+Reading revisions in increasing order reuses the last revision read
+
+  $ hg perfrevlogrevisions -d 2 f \
+  >   --config experimental.revisioncachesize=1k 2>&1 | grep 'revision cache'
+  revision cache: 0 hits, 0 base hits, 5 misses, 234 bytes
+
+Reading them in reverse order starts chains at the cached bases
+
+  $ hg perfrevlogrevisions -d 2 --reverse f \
+  >   --config experimental.revisioncachesize=1k 2>&1 | grep 'revision cache'
+  revision cache: 0 hits, 1 base hits, 4 misses, 228 bytes
+
+The texts are evicted to honor the size of the cache
+
+  $ hg perfrevlogrevisions -d 1 --reverse f \
+  >   --config experimental.revisioncachesize=100 2>&1 | grep 'revision cache'
+  revision cache: 2 hits, 2 base hits, 7 misses, 84 bytes
+
+Cached texts are returned
+
+  $ hg annotate f --config experimental.revisioncachesize=1k
+  0: line0
+  1: line1
+  2: line2
+  3: line3
+  4: line4
+  5: line5
+  6: line6
+  7: line7
+  8: line8
+  9: line9
+  $ hg verify -q --config experimental.revisioncachesize=1k
+
+Reading revisions in bulk uses and fills the cache too
+
+  $ cat > $TESTTMP/bulkread.py << EOF
+  > from mercurial import registrar
+  > cmdtable = {}
+  > command = registrar.command(cmdtable)
+  > @command('debugbulkread', [], 'FILE')
+  > def debugbulkread(ui, repo, f):
+  >     fl = repo.file(f)
+  >     revs = list(fl)
+  >     for i in range(2):
+  >         fl._cache = None
+  >         texts = list(fl.revisions(revs))
+  >         revcache = fl._revisioncache
+  >         ui.write('%d texts, revision cache: %d hits, %d misses\n'
+  >                  % (len(texts), revcache.hits, revcache.misses))
+  > EOF
+  $ hg debugbulkread f --config extensions.bulkread=$TESTTMP/bulkread.py \
+  >   --config experimental.revisioncachesize=1k
+  10 texts, revision cache: 0 hits, 10 misses
+  10 texts, revision cache: 10 hits, 10 misses
+
+Clearing the caches of a revlog only drops its own texts
+
+  $ echo other > g
+  $ hg ci -qAm g
+  $ cat > $TESTTMP/clearcache.py << EOF
+  > from mercurial import registrar
+  > cmdtable = {}
+  > command = registrar.command(cmdtable)
+  > @command('debugclearcache', [], '')
+  > def debugclearcache(ui, repo):
+  >     fl, gl = repo.file('f'), repo.file('g')
+  >     fl.revision(len(fl) - 1)
+  >     gl.revision(0)
+  >     revcache = fl._revisioncache
+  >     ui.write('%d texts cached\n' % len(revcache))
+  >     fl.clearcaches()
+  >     ui.write('%d texts cached\n' % len(revcache))
+  >     cached = revcache.get(gl._revisioncachekey, gl.node(0)) is not None
+  >     ui.write('g cached: %s\n' % cached)
+  > EOF
+  $ hg debugclearcache --config extensions.clearcache=$TESTTMP/clearcache.py \
+  >   --config experimental.revisioncachesize=1k
+  3 texts cached
+  1 texts cached
+  g cached: True
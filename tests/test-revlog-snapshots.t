@@ -0,0 +1,57 @@
+Test intermediate snapshots in revlogs
+
+  $ cat >> $HGRCPATH << EOF
+  > [format]
+  > generaldelta = yes
+  > maxchainlen = 3
+  > EOF
+
+  $ hg init repo
+  $ cd repo
+  $ $TESTDIR/seq.py 1 1000 > f
+  $ hg -q commit -A -m base
+  $ for i in 1 2 3 4 5 6 7 8 9; do
+  >   echo line$i >> f
+  >   hg -q commit -m $i
+  > done
+
+Without intermediate snapshots, cutting a chain stores a fulltext
+
+  $ hg debugdeltachain f -T '{rev} {chainid} {chainlen} {prevrev} {deltatype} {snapdepth}\n'
+  0 1 1 -1 base 0
+  1 1 2 0 p1 -1
+  2 1 3 1 p1 -1
+  3 1 4 2 p1 -1
+  4 2 1 -1 base 0
+  5 2 2 4 p1 -1
+  6 2 3 5 p1 -1
+  7 2 4 6 p1 -1
+  8 3 1 -1 base 0
+  9 3 2 8 p1 -1
+
+With them, a delta against a snapshot of the chain is stored instead
+
+  $ hg clone -q --pull . ../snapshots --config experimental.intermediate-snapshots=yes
+  $ cd ../snapshots
+  $ hg debugdeltachain f -T '{rev} {chainid} {chainlen} {prevrev} {deltatype} {snapdepth}\n'
+  0 1 1 -1 base 0
+  1 1 2 0 p1 -1
+  2 1 3 1 p1 -1
+  3 1 4 2 p1 -1
+  4 1 2 0 snap 1
+  5 1 3 4 p1 -1
+  6 1 4 5 p1 -1
+  7 1 3 4 snap 2
+  8 1 4 7 p1 -1
+  9 1 4 7 snap 3
+  $ hg verify -q
+  $ cat f | tail -1
+  line9
+
+The storage stays close to the one of a delta only revlog
+
+  $ ls -l ../repo/.hg/store/data/f.i ../snapshots/.hg/store/data/f.i | awk '{print $5}'
+  6325
+  2674
+
+  $ cd ..
@@ -0,0 +1,93 @@
+Test sparse reads of revlog delta chains
+
+  $ cat >> $HGRCPATH << EOF
+  > [format]
+  > generaldelta = yes
+  > [experimental]
+  > sparse-read.min-gap-size = 1k
+  > maxdeltachainspan = 0
+  > EOF
+
+  $ cat > genfile.py << EOF
+  > import hashlib, sys
+  > seed, count = sys.argv[1], int(sys.argv[2])
+  > for i in range(count):
+  >     print hashlib.sha1(seed + str(i)).hexdigest()
+  > EOF
+
+Build a file whose delta chains are interleaved with large unrelated
+revisions: one head appends small changes, the other one rewrites the file.
+
+  $ hg init repo
+  $ cd repo
+  $ $PYTHON ../genfile.py base 100 > f
+  $ hg ci -qAm base
+  $ for i in 1 2 3; do
+  >   hg up -q 0
+  >   $PYTHON ../genfile.py rewrite$i 1000 > f
+  >   hg ci -qm rewrite$i
+  >   hg up -q 'max(desc(base) or desc(append))'
+  >   echo append$i >> f
+  >   hg ci -qm append$i
+  > done
+  $ hg log -T '{rev}:{desc} ' -r 'all()'
+  0:base 1:rewrite1 2:append1 3:rewrite2 4:append2 5:rewrite3 6:append3  (no-eol)
+
+Without sparse read, the whole span of the chain is read in one go
+
+  $ hg debugdeltachain f -T '{rev} {chainlen} {chainsize} {lindist}\n'
+  0 1 2365 2365
+  1 2 26498 26498
+  2 2 2385 26518
+  3 2 26517 50670
+  4 3 2405 50690
+  5 2 26489 74814
+  6 4 2425 74834
+
+With sparse read, the large gaps are skipped
+
+  $ hg debugdeltachain f --config experimental.sparse-read=yes \
+  >   -T '{rev} {chainlen} {readsize} {largestblock} {srchunks}\n'
+  0 1 2365 2365 1
+  1 2 26498 26498 1
+  2 2 2385 2365 2
+  3 2 50670 50670 1
+  4 3 2405 2365 3
+  5 2 74814 74814 1
+  6 4 2425 2365 4
+
+Revisions are read correctly
+
+  $ hg cat -r 6 f --config experimental.sparse-read=yes | tail -3
+  append1
+  append2
+  append3
+  $ hg verify -q --config experimental.sparse-read=yes
+
+A density threshold of zero never slices
+
+  $ hg debugdeltachain f --config experimental.sparse-read=yes \
+  >   --config experimental.sparse-read.density-threshold=0 \
+  >   -T '{rev} {srchunks}\n'
+  0 1
+  1 1
+  2 1
+  3 1
+  4 1
+  5 1
+  6 1
+
+Gaps smaller than the minimal gap size are not skipped
+
+  $ hg debugdeltachain f --config experimental.sparse-read=yes \
+  >   --config experimental.sparse-read.min-gap-size=1m \
+  >   -T '{rev} {srchunks}\n'
+  0 1
+  1 1
+  2 1
+  3 1
+  4 1
+  5 1
+  6 1
+
+  $ cd ..
@@ -607,3 +607,29 @@ using log status template, the copy information is displayed correctly.
   
 
   $ cd ..
+
+Files in the lookup state can be compared by several workers
+
+  $ hg init lookup
+  $ cd lookup
+  $ $PYTHON -c "
+  > for i in range(300):
+  >     open('f%03d' % i, 'w').write('%03d\\n' % i)
+  > "
+  $ hg commit -Aqm 0
+  $ echo modified > f005
+  $ echo 999 > f006
+  $ rm f007
+  $ touch -t 200001010000 f*
+  $ hg debugrebuilddirstate
+  $ hg debugstate | grep -c unset
+  300
+  $ hg status --config worker.numcpus=4
+  M f005
+  M f006
+  ! f007
+  $ hg debugstate | grep unset
+  n   0         -1 unset               f005
+  n   0         -1 unset               f006
+  n   0         -1 unset               f007
+  $ cd ..
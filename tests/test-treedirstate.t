@@ -0,0 +1,217 @@
+  $ cat >> $HGRCPATH <<EOF
+  > [experimental]
+  > format.treedirstate = yes
+  > EOF
+
+  $ cat > $TESTTMP/listdir.py <<EOF
+  > from mercurial import dirstate, extensions, util
+  > listed = []
+  > def listdir(orig, path, *args, **kwargs):
+  >     listed.append(path)
+  >     return orig(path, *args, **kwargs)
+  > def walk(orig, self, *args, **kwargs):
+  >     res = orig(self, *args, **kwargs)
+  >     for path in sorted(listed):
+  >         self._ui.write('listing /%s\n' % path[len(self._rootdir):])
+  >     del listed[:]
+  >     return res
+  > def uisetup(ui):
+  >     extensions.wrapfunction(util, 'listdir', listdir)
+  >     extensions.wrapfunction(dirstate.dirstate, 'walk', walk)
+  > EOF
+
+  $ hg init repo
+  $ cd repo
+  $ grep treedirstate .hg/requires
+  exp-treedirstate
+  $ cat >> .hg/hgrc <<EOF
+  > [extensions]
+  > listdir = $TESTTMP/listdir.py
+  > EOF
+
+  $ mkdir -p a/b c build
+  $ echo a > a/a
+  $ echo b > a/b/b
+  $ echo c > c/c
+  $ echo root > root
+  $ printf 'syntax: glob\nbuild\n' > .hgignore
+  $ touch build/out
+  $ hg add -q > /dev/null
+  $ touch -t 200001010000 .hgignore a/a a/b/b c/c root
+  $ hg commit -qm initial
+  $ hg cp c/c c/copy
+  $ hg debugstate --nodates
+  n 644         19 set                 .hgignore
+  n 644          2 set                 a/a
+  n 644          2 set                 a/b/b
+  n 644          2 set                 c/c
+  a   0         -1 unset               c/copy
+  n 644          5 set                 root
+  copy: c/c -> c/copy
+
+Directories are listed as long as their mtime is too recent to be recorded
+
+  $ hg status
+  listing /
+  listing /a
+  listing /a/b
+  listing /c
+  A c/copy
+  $ touch -t 200001010000 . a a/b c
+  $ hg status
+  listing /
+  listing /a
+  listing /a/b
+  listing /c
+  A c/copy
+
+Unchanged directories are not listed anymore
+
+  $ hg status
+  A c/copy
+  $ hg status c
+  A c/copy
+
+Changes to tracked files are still reported
+
+  $ echo modified > a/b/b
+  $ hg status
+  M a/b/b
+  A c/copy
+  $ hg revert -q a/b/b
+  $ rm a/b/b.orig
+  $ hg status
+  listing /a/b
+  A c/copy
+  $ touch -t 200001010000 a/b
+  $ hg status
+  listing /a/b
+  A c/copy
+  $ hg status
+  A c/copy
+
+New files change the mtime of their directory
+
+  $ echo unknown > a/unknown
+  $ hg status
+  listing /a
+  A c/copy
+  ? a/unknown
+  $ touch -t 200001010000 a
+  $ hg status
+  listing /a
+  A c/copy
+  ? a/unknown
+
+Forgotten files are reported as unknown
+
+  $ hg forget a/b/b
+  $ hg commit -qm forget
+  $ hg status
+  listing /a
+  listing /a/b
+  ? a/b/b
+  ? a/unknown
+
+The empty directory a/b was dropped from the dirstate when a/b/b was
+forgotten, so a is only recorded once a/b is
+
+  $ rm a/unknown a/b/b
+  $ touch -t 200001010000 a a/b
+  $ hg status
+  listing /a
+  listing /a/b
+  $ hg status
+  listing /a
+  $ hg status
+
+Changing the ignore files forgets the recorded mtimes
+
+  $ echo 'a/b/*' >> .hgignore
+  $ hg status
+  listing /
+  listing /a
+  listing /a/b
+  listing /c
+  M .hgignore
+
+The working copy is consistent after an update
+
+  $ hg update -q 0
+  $ hg status
+  listing /a/b
+  listing /c
+  M .hgignore
+  $ hg status --clean
+  C a/a
+  C a/b/b
+  C c/c
+  C root
+
+Case-folding lookups only load the directories along the paths
+
+  $ cat > $TESTTMP/fold.py <<EOF
+  > from mercurial import registrar
+  > cmdtable = {}
+  > command = registrar.command(cmdtable)
+  > @command('debugfold', [], 'PATH...')
+  > def debugfold(ui, repo, *paths):
+  >     dirstate = repo.dirstate
+  >     for path in paths:
+  >         folded = dirstate._normalize(path, False, True)
+  >         ui.write('%s -> %s\n' % (path, folded))
+  >     ui.write('loaded: %s\n' % ' '.join(sorted(dirstate._map._loadeddirs)))
+  > EOF
+  $ hg debugfold --config extensions.fold=$TESTTMP/fold.py A/B/B C/C
+  A/B/B -> a/b/b
+  C/C -> c/c
+  loaded:  a a/b c
+  $ hg debugfold --config extensions.fold=$TESTTMP/fold.py a/a A/B Missing/File
+  a/a -> a/a
+  A/B -> a/b
+  Missing/File -> Missing/File
+  loaded:  a
+
+Directories left without files are dropped from the fold map
+
+  $ cat > $TESTTMP/dropfold.py <<EOF
+  > from mercurial import registrar
+  > cmdtable = {}
+  > command = registrar.command(cmdtable)
+  > @command('debugdropfold', [], 'FILE DIR...')
+  > def debugdropfold(ui, repo, f, *dirs):
+  >     dirstate = repo.dirstate
+  >     dirfoldmap = dirstate._dirfoldmap
+  >     dirstate.drop(f)
+  >     for d in dirs:
+  >         ui.write('%s -> %s\n' % (d, dirfoldmap.get(d)))
+  > EOF
+  $ hg debugdropfold --config extensions.dropfold=$TESTTMP/dropfold.py \
+  >   a/b/b a a/b
+  a -> a
+  a/b -> None
+
+The non-normal files are known without loading the directories either
+
+  $ cat > $TESTTMP/nonnormal.py <<EOF
+  > from mercurial import registrar
+  > cmdtable = {}
+  > command = registrar.command(cmdtable)
+  > @command('debugnonnormal', [])
+  > def debugnonnormal(ui, repo):
+  >     dirstate = repo.dirstate
+  >     ui.write('non-normal: %s\n' % ' '.join(sorted(dirstate._nonnormalset)))
+  >     ui.write('loaded: %s\n' % ' '.join(sorted(dirstate._map._loadeddirs)))
+  > EOF
+  $ echo new > a/b/new
+  $ hg add a/b/new
+  $ hg remove c/c
+  $ hg debugnonnormal --config extensions.nonnormal=$TESTTMP/nonnormal.py
+  non-normal: a/b/new c/c
+  loaded: 
+  $ hg forget a/b/new
+  $ hg debugnonnormal --config extensions.nonnormal=$TESTTMP/nonnormal.py
+  non-normal: c/c
+  loaded: 
+
+  $ cd ..
@@ -352,3 +352,36 @@ store files with special filenames aren't encoded during copy
   the old repository will not be deleted; remove it to free up disk space once the upgraded repository is verified
 
   $ cd ..
+
+delta chains can be bounded by an upgrade
+
+  $ hg init long-chains
+  $ cd long-chains
+  $ $TESTDIR/seq.py 1 100 > f
+  $ hg -q commit -A -m base
+  $ for i in 1 2 3 4 5; do
+  >   echo $i >> f
+  >   hg -q commit -m $i
+  > done
+  $ hg debugdeltachain f -T '{rev} {chainlen}\n'
+  0 1
+  1 2
+  2 3
+  3 4
+  4 5
+  5 6
+
+  $ cat >> .hg/hgrc << EOF
+  > [format]
+  > maxchainlen = 2
+  > EOF
+  $ hg debugupgraderepo --run > /dev/null 2>&1
+  $ hg debugdeltachain f -T '{rev} {chainlen}\n'
+  0 1
+  1 2
+  2 3
+  3 1
+  4 2
+  5 3
+  $ hg verify -q
+  $ cd ..
@@ -265,6 +265,36 @@ Corrupt filelog base node to cause failure to read revision
 
   $ cd ..
 
+Only the damaged revision of a filelog read in bulk is reported
+
+  $ hg init corruptrev
+  $ cd corruptrev
+  $ for i in 0 1 2 3 4 5 6; do
+  >   "$PYTHON" -c "print('\n'.join(str(x * $i) for x in range(200)))" > f
+  >   hg ci -qAm $i
+  > done
+  $ hg debugindex f
+     rev    offset  length  delta linkrev nodeid       p1           p2
+       0         0      15     -1       0 1cbcad15e6a1 000000000000 000000000000
+       1        15     350      0       1 0a30c25a5eaf 1cbcad15e6a1 000000000000
+       2       365     647      1       2 82a3544b9320 0a30c25a5eaf 000000000000
+       3      1012     353     -1       3 82aa0fbfa645 82a3544b9320 000000000000
+       4      1365     584      3       4 fa8e0ef943fb 82aa0fbfa645 000000000000
+       5      1949     525      4       5 377ad300bf89 fa8e0ef943fb 000000000000
+       6      2474     374     -1       6 6c2e7183d109 377ad300bf89 000000000000
+
+Damage the data of revision 6, at offset 2474 + 7 * 64 in the inline revlog
+
+  $ printf abcd | dd conv=notrunc of=.hg/store/data/f.i bs=1 seek=2930 \
+  >   2> /dev/null
+  $ hg verify -q
+   f@6: unpacking 6c2e7183d109: revlog decompress error: * (glob)
+  1 integrity errors encountered!
+  (first damaged changeset appears to be 6)
+  [1]
+
+  $ cd ..
+
 test changelog without a manifest
 
   $ hg init b
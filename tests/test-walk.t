@@ -516,3 +516,39 @@ Test split patterns on overflow
   f  fennel     fennel     exact
   f  fenugreek  fenugreek  exact
   $ cd ..
+
+Subdirectories can be listed ahead of their traversal by several threads
+
+  $ cd t
+  $ mkdir -p mammals/Felidae beans/dried
+  $ echo lion > mammals/Felidae/lion
+  $ echo dried > beans/dried/black
+  $ hg debugwalk --config experimental.walk-threads=4 -X beans/kidney
+  matcher: <differencematcher m1=<alwaysmatcher>, m2=<includematcher includes='(?:beans\\/kidney(?:/|$))'>>
+  f  .hgignore                       .hgignore
+  f  beans/black                     beans/black
+  f  beans/borlotti                  beans/borlotti
+  f  beans/dried/black               beans/dried/black
+  f  beans/navy                      beans/navy
+  f  beans/pinto                     beans/pinto
+  f  beans/turtle                    beans/turtle
+  f  fennel                          fennel
+  f  fenugreek                       fenugreek
+  f  fiddlehead                      fiddlehead
+  f  listfile                        listfile
+  f  listfile0                       listfile0
+  f  mammals/Felidae/lion            mammals/Felidae/lion
+  f  mammals/Procyonidae/cacomistle  mammals/Procyonidae/cacomistle
+  f  mammals/Procyonidae/coatimundi  mammals/Procyonidae/coatimundi
+  f  mammals/Procyonidae/raccoon     mammals/Procyonidae/raccoon
+  f  mammals/skunk                   mammals/skunk
+  f  new                             new
+  f  overflow.list                   overflow.list
+  $ hg debugwalk --config experimental.walk-threads=4 'glob:mammals/**'
+  matcher: <patternmatcher patterns='(?:mammals\\/.*$)'>
+  f  mammals/Felidae/lion            mammals/Felidae/lion
+  f  mammals/Procyonidae/cacomistle  mammals/Procyonidae/cacomistle
+  f  mammals/Procyonidae/coatimundi  mammals/Procyonidae/coatimundi
+  f  mammals/Procyonidae/raccoon     mammals/Procyonidae/raccoon
+  f  mammals/skunk                   mammals/skunk
+  $ cd ..
@@ -24,9 +24,19 @@ Test UI worker interaction
   >         ui.status('run\n')
   >         yield 1, arg
   >     time.sleep(0.1) # easier to trigger killworkers code path
+  > def reverse(ui, args):
+  >     for arg in args:
+  >         # the last arguments are done first
+  >         time.sleep(0.02 * (8 - arg))
+  >         yield 1, arg
+  > def large(ui, args):
+  >     for arg in args:
+  >         yield 1, (arg, str(arg) * (1 << 20))
   > functable = {
   >     'abort': abort,
   >     'exc': exc,
+  >     'large': large,
+  >     'reverse': reverse,
   >     'runme': runme,
   > }
   > cmdtable = {}
@@ -38,7 +48,9 @@ Test UI worker interaction
   >     ui.status('start\n')
   >     runs = worker.worker(ui, cost, func, (ui,), range(8))
   >     for n, i in runs:
-  >         pass
+  >         if isinstance(i, tuple):
+  >             i = '%d, %d times %s' % (i[0], len(i[1]), i[1][0])
+  >         ui.debug('result %s\n' % i)
   >     ui.status('done\n')
   > EOF
   $ abspath=`pwd`/t.py
@@ -125,4 +137,64 @@ Workers should not do cleanups in all cases
   abort: known exception
   [255]
 
+Results larger than the pipe buffers are received whole
+
+  $ hg --config "extensions.t=$abspath" --config worker.numcpus=4 \
+  > test 100000.0 large --debug | grep result | sort
+  result 0, 1048576 times 0
+  result 1, 1048576 times 1
+  result 2, 1048576 times 2
+  result 3, 1048576 times 3
+  result 4, 1048576 times 4
+  result 5, 1048576 times 5
+  result 6, 1048576 times 6
+  result 7, 1048576 times 7
+
 #endif
+
+Workers can be threads
+
+  $ hg --config "extensions.t=$abspath" --config worker.backend=thread \
+  > test 100000.0
+  start
+  run
+  run
+  run
+  run
+  run
+  run
+  run
+  run
+  done
+
+Their results are received in order
+
+  $ hg --config "extensions.t=$abspath" --config worker.backend=thread \
+  > --config worker.numcpus=8 test 100000.0 reverse --debug | grep result
+  result 0
+  result 1
+  result 2
+  result 3
+  result 4
+  result 5
+  result 6
+  result 7
+
+Their exceptions are raised in the main thread
+
+  $ hg --config "extensions.t=$abspath" --config worker.backend=thread \
+  > --config worker.numcpus=8 test 100000.0 abort
+  start
+  abort: known exception
+  [255]
+
+  $ hg --config "extensions.t=$abspath" --config worker.backend=thread \
+  > --config worker.numcpus=8 test 100000.0 exc 2>&1 | egrep '^(Exception|  File.*t.py)'
+    File "$TESTTMP/t.py", line *, in t (glob)
+    File "$TESTTMP/t.py", line *, in exc (glob)
+  Exception: unknown exception
+
+  $ hg --config "extensions.t=$abspath" --config worker.backend=other test
+  start
+  abort: worker.backend must be one of auto, process or thread
+  [255]